@@ -2,7 +2,7 @@ from threading import Lock
 
 LOCK = Lock()
 
-__version__ = "20230208.0.BETA"
+__version__ = "20261019.0.BETA"
 
 from . import cli
 
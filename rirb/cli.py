@@ -9,20 +9,41 @@ import shutil
 import copy
 from functools import partial
 import io
+import queue
+import atexit
+from threading import Thread, Event
 
 from . import __version__, LOCK
 
 _TEMPDIR = False  # Just used in testing
 
 
+LOG_QUEUE_SIZE = 10_000  # Lines waiting to be written before log() blocks
+LOG_BATCH_SIZE = 1_000  # Most lines written per open of a log file
+LOG_FLUSH_TIMEOUT = 60  # seconds
+
+
 class Log:
+    """
+    The log. Lines are printed right away and written to the log files by a
+    background thread in batches (one open per batch rather than per line). Call
+    flush() before reading or copying the log files.
+    """
+
     def __init__(self):
-        pass
+        self.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.writer = None
 
     def _init(self, *, tmpdir, debugmode=False):
         self.tmpdir = tmpdir = Path(tmpdir)
         tmpdir.mkdir(parents=True, exist_ok=True)
 
+        with LOCK:
+            if not (self.writer and self.writer.is_alive()):
+                self.writer = Thread(target=self._write, name="log", daemon=True)
+                self.writer.start()
+                atexit.register(self.flush)
+
         self.set_mode(debugmode)  # call before debug
         debug(f"log started. {tmpdir = }")
 
@@ -49,30 +70,77 @@ class Log:
 
         t = ".".join(t) + ": "
 
-        with io.StringIO() as sio:
-            kwargs["file"] = sio
-            kwargs["end"] = ""
-
-            print(*args, **kwargs)
-
-            lines = sio.getvalue().split("\n")
-            lines = [t + line for line in lines]
+        if not kwargs and all(isinstance(arg, str) for arg in args):
+            text = " ".join(args)  # Same as print() but faster
+        else:
+            with io.StringIO() as sio:
+                kwargs["file"] = sio
+                kwargs["end"] = ""
 
-        lines = "\n".join(lines)
+                print(*args, **kwargs)
+                text = sio.getvalue()
 
-        del kwargs["file"]
+        lines = t + text.replace("\n", "\n" + t)
 
-        with LOCK:  # Append should be atomic but just in case, lock it along with print
+        # Lock so that the files are in the same order as what is printed
+        with LOCK:
             if __debug:
-                with open(self.debug_file, mode="at") as fobj:
-                    print(lines, file=fobj)
+                self._put(self.debug_file, lines)
                 if self.debugmode:
                     print(lines)
             else:
-                with open(self.log_file, mode="at") as fobj:
-                    print(lines, file=fobj)
+                self._put(self.log_file, lines)
                 print(lines)
 
+    def _put(self, path, lines):
+        """Queue lines for the writer or, if it isn't running, write them now"""
+        while self.writer and self.writer.is_alive():
+            try:
+                return self.queue.put((path, lines), timeout=1)
+            except queue.Full:  # Check that the writer didn't die while waiting
+                pass
+        self._append(path, [lines])
+
+    def flush(self):
+        """Wait until everything logged so far is written"""
+        if not (self.writer and self.writer.is_alive()):
+            return
+        done = Event()
+        self.queue.put(done)
+        done.wait(timeout=LOG_FLUSH_TIMEOUT)
+
+    def _write(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Keep the order of the files when grouping the lines by file
+            byfile, flushes = {}, []
+            for item in batch:
+                if isinstance(item, Event):
+                    flushes.append(item)
+                else:
+                    byfile.setdefault(item[0], []).append(item[1])
+
+            for path, lines in byfile.items():
+                self._append(path, lines)
+
+            for done in flushes:
+                done.set()
+
+    @staticmethod
+    def _append(path, lines):
+        try:
+            with open(path, mode="at", encoding="utf-8") as fobj:
+                fobj.write("\n".join(lines) + "\n")
+        except Exception as err:  # e.g. the tmpdir was removed. Never kill the writer
+            msg = f"Could not write to the log {str(path)!r}: {err!r}"
+            print(msg, file=sys.stderr)
+
     __call__ = log
 
     def debug(self, *args, **kwargs) -> None:
@@ -205,7 +273,7 @@ class Config:
         """
         Validate config
         """
-        from .rclone import FILTER_FLAGS
+        from .rclone import FILTER_FLAGS, PHASES, STALL_PHASES
 
         if self.src == "<<MUST SPECIFY>>":
             raise ConfigError("Must specify 'src'")
@@ -219,6 +287,16 @@ class Config:
             "reuse_hashes": {"size", "mtime", False, None},
             #             "hash_fail_fallback": {"size", "mtime", False, None},
             "cleanup_empty_dirs": {True, False, "auto"},
+            "metadata_only_updates": {True, False},
+            "resume_interrupted": {True, False},
+            "transfer_class_order": {"small-first", "large-first", None},
+            "transfer_parallel_classes": {True, False},
+            "dir_moves": {True, False},
+            "stream_new_files": {True, False},
+            "run_history": {True, False},
+            "economy": {True, False},
+            "rclone_log": {"full", "summary"},
+            "log_compression": {None, "gzip", "bz2", "xz"},
         }
 
         for key, values in allowed.items():
@@ -228,6 +306,16 @@ class Config:
                     f"Allowed values for '{key}' are {values}. Specified '{val}'"
                 )
 
+        for key, phases in [
+            ("call_timeouts", PHASES),
+            ("stall_timeouts", STALL_PHASES),  # The others do not report progress
+        ]:
+            badphases = set(self._config[key] or {}).difference(phases)
+            if badphases:
+                raise ConfigError(
+                    f"Unsupported phase(s) {badphases} in '{key}'. Allowed are {phases}"
+                )
+
         badflags = FILTER_FLAGS.intersection(self.rclone_flags)
         if badflags:
             raise ConfigError(
@@ -324,6 +412,17 @@ def cli(argv=None):
         ),
     )
 
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help=(
+            "Write a timeline of the phases and rclone calls to FILE in the Chrome "
+            "trace-event JSON format. Open it with chrome://tracing or "
+            "https://ui.perfetto.dev. Written before the logs are uploaded (so "
+            "even if that fails) and does not include it"
+        ),
+    )
+
     parser.add_argument(
         "--version", action="version", version="%(prog)s-" + __version__
     )
@@ -334,6 +433,8 @@ def cli(argv=None):
     cliconfig = parser.parse_args(argv)
     if cliconfig.init:
         cliconfig.dst_list = True
+    if cliconfig.trace:  # The config is parsed in its own directory
+        cliconfig.trace = os.path.abspath(cliconfig.trace)
 
     config = Config(cliconfig.configpath, debugmode=cliconfig.debug)
     config.cliconfig = cliconfig
@@ -350,6 +451,7 @@ def cli(argv=None):
 
         rirb = RIRB(config)
         rirb.run()
+        log.flush()
 
         # Delete the tempdir. This is ONLY done if run successfully!
         if not _TEMPDIR:  #  Do not do it while testing
@@ -367,6 +469,7 @@ def cli(argv=None):
         # Call fail_shell
         if config.fail_shell:
             log("Running 'fail_shell' commands. Note: May not get logged")
+            log.flush()  # So that LOGPATH is complete
             env = {
                 "LOGPATH": str(log.log_file.resolve()),
                 "DEBUGPATH": str(log.debug_file.resolve()),
@@ -377,6 +480,7 @@ def cli(argv=None):
 
         log("Attempting to upload logs. May fail")
         rirb.savelog(fail=True)
+        log.flush()
 
         if cliconfig.debug:
             raise
@@ -62,6 +62,19 @@ compare = "mtime"  # "size", "mtime", "hash"
 # `None` which means to use the same.
 dst_compare = None  # None means use `compare`
 
+# With `compare = "mtime"`, a file whose ModTime changed but whose content did not (e.g.
+# from `touch` or restoring files) is seen as modified. It is re-uploaded and the old
+# copy is moved to `back/`. If this is set, those files are also compared by their
+# hashes (stored or computed on the source) and, if they match, rclone is only asked to
+# update the ModTime on the destination. They are recorded as "touched" in the diffs and
+# are NOT backed up.
+#
+# This requires hashes on the source (they will be computed as needed). With
+# `reuse_hashes = "mtime"`, only the files with a changed ModTime get rehashed. If the
+# destination has no hash in common with the source or can't set the ModTime, rclone
+# can't update just the ModTime so they are treated as modified (and backed up).
+metadata_only_updates = False
+
 # When listing the destination directly from --dst-list, you can specify additional
 # flags that you may otherwise not need. For example, if the destination is S3, you
 # may with to include --fast-list
@@ -74,6 +87,84 @@ dst_list_rclone_flags = []
 # NOT RECOMENDED to change this!
 automatic_dst_list = True
 
+# Transfers are split into batches of at most `transfer_batch_size` files (and
+# `transfer_batch_bytes` bytes, if set). Each completed batch is recorded in a journal
+# (see `resume_interrupted`). Set to None for no limit.
+transfer_batch_size = 10000
+transfer_batch_bytes = None
+
+# Normally, nothing is transfered until the source is fully listed and compared. If
+# this is set, new files are transfered while the source is still being listed. Only
+# files that can't be modified or renamed are streamed: not in the previous file list
+# and, if tracking `renames`, no previous file has the same size. They are batched as
+# above (or sent after waiting a minute) and recorded in the journal. The diffs are
+# uploaded (and updated) before each batch so they are always ahead of the data.
+#
+# Not used with --dst-list, --dry-run, or --interactive. Streamed files do not use
+# `transfer_size_classes` or `adaptive_transfers`.
+stream_new_files = False
+
+# Transfers can be split by file size into classes that each get their own rclone
+# flags, e.g. many `--transfers` for small files and fewer transfers but more
+# `--multi-thread-streams` for large ones. Specify as a list of (max_size, flags)
+# where max_size is in bytes. Files larger than every max_size go into a final class
+# (which can be given flags with a max_size of None). These flags take precedence over
+# `rclone_flags`. None means a single class.
+#
+# Example:
+#   transfer_size_classes = [
+#       (1024**2, ["--transfers", "32", "--checkers", "64"]),  # <= 1 MiB
+#       (None, ["--transfers", "4", "--multi-thread-streams", "8"]),  # the rest
+#   ]
+transfer_size_classes = None
+
+# The order in which to do the size classes (and, with `--order-by`, the files within
+# them). Options are "small-first" (most files backed up the soonest), "large-first",
+# or None (smallest class first but the files are not ordered)
+transfer_class_order = None
+
+# Whether to run the size classes at the same time
+transfer_parallel_classes = False
+
+# Adaptively tune rclone's `--transfers` (and `--checkers` at twice that) between
+# transfer batches from the throughput in rclone's stats. Starting from the best of the
+# previous run, it is doubled or halved while the throughput improves and halved on any
+# errors (often throttling). Specify as a (min, max) range, e.g. (2, 32), or False to
+# disable. Each size class is tuned separately and the result is remembered per
+# destination in `<rclone cache dir>/rirb/tuning/`.
+#
+# Since it learns between batches, this is most useful with a smaller
+# `transfer_batch_size`. These flags take precedence over any `--transfers` and
+# `--checkers` in `rclone_flags` or `transfer_size_classes`.
+adaptive_transfers = False
+
+# Transfers, renames, and deletes are run with rclone's JSON log so that the files
+# that failed can be identified. Those files (and only those) are retried up to
+# `file_retries` times (after rclone's own `--retries`) with a backoff that starts at
+# `file_retry_backoff` seconds and doubles each time. The final outcome of any retried
+# file is logged.
+file_retries = 2
+file_retry_backoff = 10  # seconds
+
+# How the (JSON log) output of transfers, renames, and deletes is logged. "full" logs
+# every line. "summary" keeps the log short for large runs: only errors, warnings,
+# stats, and the count of files by message (e.g. "1234 file(s): Copied (new)") of
+# each call are logged. Each per-file line (as rclone's JSON) is instead written to
+# the gzipped `rclone_files.jsonl.gz` which is uploaded to `logs/<date>/`.
+rclone_log = "full"
+
+# Normally, an interrupted run means the next run needs --dst-list (see
+# `automatic_dst_list` above). If this is set and the journal of the interrupted run
+# is usable, the next run instead replays the completed work onto the previous file
+# list and only plans what is left. Files from an unfinished batch are re-checked by
+# rclone. The destination is not listed.
+#
+# The journal is kept in `<rclone cache dir>/rirb/journal/<_uuid>.jsonl` and uploaded
+# to `logs/<date>/journal.jsonl`. It can not be used if the run was interrupted during
+# the renames or deletes, or if it was a --dst-list run. In that case, it falls back
+# to the `automatic_dst_list` behavior.
+resume_interrupted = False
+
 # In order to make tracking an interrupted backup easier, the `backed_up_files.json.gz`
 # and `diffs.json.gz` files get uploaded *BEFORE* the main backup. The `curr.json.gz`
 # and `log.log` get uploaded afterwards. However, to ensure there are no mistakes, the
@@ -81,7 +172,7 @@ automatic_dst_list = True
 # completes.
 #
 # If this is False, it is still possible to identify incomplete backups by
-# the missing log.log file
+# the missing log.log (or compressed log, see `log_compression`) file
 prefix_incomplete_backups = True
 
 # Renames can be tracked if the file is unmodified other than the name.
@@ -102,6 +193,16 @@ prefix_incomplete_backups = True
 # Note that when using --dst-list, renames are NOT tracked.
 renames = False
 
+# Renamed directories are normally moved file-by-file on the destination. If this is
+# set (and the destination supports DirMove, e.g. local, SFTP, Drive), renames that
+# are verified to be a whole directory are done with a single server-side directory
+# move. A directory is only moved if every file in it (on the destination) was renamed
+# to the same place in the new directory, nothing else is added to the new directory,
+# and nothing remains in the old one. Everything else is moved file-by-file.
+#
+# See docs/Directory_Move_Optimization.md for the details and edge cases
+dir_moves = False
+
 # When doing mtime comparisons, what is the error to allow. Ideally, this
 # should be small since it is always on the same machine but some filesystems
 # have some slack.
@@ -127,6 +228,15 @@ reuse_hashes = "mtime"
 # AND hashes need to be computed, you can set the types. Specify as a single item
 # (e.g. hash_type = 'sha1') or as a tuple (e.g. hash_type = 'sha1','md5'). If None
 # (default), will do all possible
+#
+# If "auto", the hashes supported by the source and destination are queried and the
+# cheapest one common to both is used (measured with a quick benchmark if the source
+# is local). If there is no common hash, the cheapest source hash is used but the run
+# will fail right away if using --dst-list with a 'hash' compare. The decision is
+# cached in `<rclone cache dir>/rirb/hash_type/<_uuid>.json`.
+#
+# Note: Changing the hash type (including to "auto") on an existing backup means the
+# stored hashes may not be comparable for hash compares or renames.
 hash_type = None
 
 # Even if the hashes are not needed for compare or move-tracking, it can be helpful
@@ -141,6 +251,44 @@ get_hashes = False
 # clean up, you can separately run `rclone rmdirs dst:`
 cleanup_empty_dirs = False  # Options: {True, False, "auto"}
 
+# Independent steps of the backup can be run at the same time. For example, listing
+# the source while the previous file list is pulled, the transfers, renames, and
+# deletes (they touch different files), uploading the diffs and backup lists,
+# uploading logs to each `log_dest`, and removing empty directories. The order needed
+# to track an interrupted backup is kept regardless.
+#
+# This is how many steps can run at the same time in each stage (the probes, the
+# listings, the backup, and the log uploads). It is per stage and not a cap on the
+# whole run. Some steps run their own calls at the same time (the diff uploads and
+# removing directories, also up to this many, and `transfer_parallel_classes`) so
+# the total can be higher. The default of 1 runs everything except the parallel size
+# classes one after the other. Consider 4 if the remote handles concurrent calls well.
+max_concurrent_calls = 1
+
+# If any step fails, the other running rclone calls are stopped so that the run fails
+# right away. This also sets a deadline (in seconds) for the whole run after which
+# everything is stopped and the run fails (as an interrupted backup). None means no
+# deadline. Useful for runs on a schedule so that they do not overlap.
+max_run_time = None
+
+# Timeouts (in seconds) for individual rclone calls by phase. Phases are "listing"
+# (source and destination listings), "transfer" (each transfer batch), "move"
+# (renames, deletes/backups, and removing directories), "metadata" (the file lists,
+# diffs, journal, and logs), and "other" (e.g. probes of rclone and the backends).
+# A call that goes over is stopped. Transfer batches, deletes, and renames are then
+# retried (for the files they did not finish) as with `file_retries`. A directory that
+# can't be removed in time is left in place and any other call that goes over fails
+# the run. Phases that are not specified have no timeout.
+# Example: {"listing": 3600, "transfer": 4 * 3600}
+call_timeouts = {}
+
+# Stall detection (in seconds) by phase. If a call makes no progress (no bytes moved
+# and no files done per rclone's stats) for this long, it is stopped (and retried or
+# not as with `call_timeouts`). Only the "transfer" and "move" phases are allowed
+# since the others do not report progress. In "move", it applies to the deletes and
+# renames but not to removing directories. Example: {"transfer": 600}
+stall_timeouts = {}
+
 # The `curr.json.gz` file on the destination is always current, but to save time,
 # a local copy of the current file listing can also be stored. This saves a bit
 # of time (and bandwidth). It will be named from the _uuid. Will use
@@ -163,6 +311,42 @@ log_dest = None
 # log_dest = "/full/path/to/local"
 # log_dest = "/full/path/to/local", "remote:path/to/log"
 
+# Compress the log before it is saved to the remote and each `log_dest`. It is
+# compressed once and the name gets the suffix (e.g. `log.log.gz`). Options are
+# None, "gzip", "bz2", or "xz". The copies to the destinations are made at the same
+# time (up to `max_concurrent_calls`) and one that fails does not stop the others.
+log_compression = None
+
+# Write Prometheus metrics of each run (including failed ones) for the node_exporter
+# textfile collector. These include whether it succeeded, the run and phase times,
+# the number and size of the files (total, new, modified, etc), and the rclone call
+# stats. They are labeled by _uuid, src, and dst. Specify the path to the file (should
+# end in `.prom`) or a directory to write `rirb_<_uuid>.prom` in it. The file is
+# written atomically. None to not write them.
+prometheus_textfile = None
+
+# Keep a local history of the performance of each run in
+# `<rclone cache dir>/rirb/history.sqlite`. Each run is compared to the recent
+# successful runs to the same destination and phases that got much slower (without
+# more files to do) are logged as a "REGRESSION". With --dry-run or --interactive,
+# the transfer time is predicted from the past throughput.
+run_history = False
+
+# Minimize the remote API calls for metered remotes (e.g. S3 or B2 which bill per
+# transaction). The estimated calls by class (list, read, write) are always in the
+# summary, the profile, and the metrics. With economy:
+#
+#   - Traversals are planned with listing calls costing ECONOMY_LIST_COST (10) times
+#     a stat (S3 LIST vs GET or B2 class C vs B) rather than the same.
+#   - The journal is only uploaded after the deletes and renames rather than also
+#     after every transfer batch. The local journal is still updated (and is what
+#     `resume_interrupted` uses) but the remote copy can be behind.
+#   - The backend features are cached for 30 days rather than one.
+#
+# Also consider `prefix_incomplete_backups = False` which saves the moves of the
+# prefixed files at the end of each run.
+economy = False
+
 ## Pre-, Post- and fail- shell commands to run
 # Specify shell code to be evaluated before and/or after running rirb. Note
 # these are all run from the directory of this config (as with everything else).
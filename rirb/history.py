@@ -0,0 +1,190 @@
+"""
+Local history of run performance. Used to flag regressions against the recent runs
+and to predict transfer times
+"""
+import sqlite3
+import statistics
+from contextlib import closing
+from pathlib import Path
+
+from . import debug
+from . import utils
+
+BASELINE_RUNS = 10  # Number of recent successful runs in the baseline
+MIN_BASELINE_RUNS = 3  # Fewer than this is not a baseline
+
+REGRESSION_FACTOR = 3.0  # Flag phases that take this many times the baseline...
+MIN_PHASE_TIME = 10.0  # ...and at least this many seconds...
+FLAT_FACTOR = 1.5  # ...unless the amount of work grew by this much too
+
+MIN_TRANSFER_BYTES = 1024**2  # Smaller transfers say little about throughput
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    uuid TEXT,
+    dst TEXT,
+    now TEXT,
+    time REAL,
+    success INTEGER,
+    duration REAL,
+    files INTEGER,
+    bytes INTEGER,
+    transfer_files INTEGER,
+    transfer_bytes INTEGER,
+    transfer_time REAL,
+    rclone_calls INTEGER
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER REFERENCES runs(id),
+    name TEXT,
+    wall REAL,
+    rclone_calls INTEGER,
+    files INTEGER,
+    bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_dst ON runs(dst, success, time);
+"""
+
+RUN_COLUMNS = (
+    "uuid",
+    "dst",
+    "now",
+    "time",
+    "success",
+    "duration",
+    "files",
+    "bytes",
+    "transfer_files",
+    "transfer_bytes",
+    "transfer_time",
+    "rclone_calls",
+)
+PHASE_COLUMNS = ("name", "wall", "rclone_calls", "files", "bytes")
+
+
+def history_path(cachedir):
+    return Path(cachedir) / "rirb" / "history.sqlite"
+
+
+class History:
+    """
+    SQLite store of the runs (for all configs) and their top-level phases
+
+        >>> history = History(path)
+        >>> baseline = history.baseline(dst)
+        >>> history.add(run, phases)
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        with closing(self.connect()) as db, db:
+            db.executescript(SCHEMA)
+
+    def connect(self):
+        """Connect to the database. Close it when done. `with db` only commits"""
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def add(self, run, phases):
+        """
+        Add a run ({column: value}) and its phases ({name: {column: value}}).
+        Returns the run id
+        """
+        with closing(self.connect()) as db, db:
+            cols = ", ".join(RUN_COLUMNS)
+            marks = ", ".join("?" for _ in RUN_COLUMNS)
+            cur = db.execute(
+                f"INSERT INTO runs ({cols}) VALUES ({marks})",
+                [run.get(col) for col in RUN_COLUMNS],
+            )
+            run_id = cur.lastrowid
+            db.executemany(
+                "INSERT INTO phases (run_id, name, wall, rclone_calls, files, bytes) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    [run_id, name] + [phase.get(col) for col in PHASE_COLUMNS[1:]]
+                    for name, phase in phases.items()
+                ],
+            )
+        debug(f"Added run {run_id} to history {self.path}")
+        return run_id
+
+    def baseline(self, dst, n=BASELINE_RUNS):
+        """
+        Return the n most recent successful runs to dst (newest first). Each is a
+        dict with their phases in "phases"
+        """
+        with closing(self.connect()) as db, db:
+            runs = db.execute(
+                "SELECT * FROM runs WHERE dst = ? AND success = 1 "
+                "ORDER BY time DESC LIMIT ?",
+                (dst, n),
+            ).fetchall()
+            runs = [dict(run) for run in runs]
+            for run in runs:
+                rows = db.execute("SELECT * FROM phases WHERE run_id = ?", (run["id"],))
+                run["phases"] = {row["name"]: dict(row) for row in rows}
+        return runs
+
+
+def regressions(run, phases, baseline):
+    """
+    Return messages for the phases that took REGRESSION_FACTOR times their baseline
+    median while the amount of work (the files of the phase, or of the run) did not
+    grow by FLAT_FACTOR
+    """
+    if len(baseline) < MIN_BASELINE_RUNS:
+        debug(f"Only {len(baseline)} runs in the history. No baseline")
+        return []
+
+    msgs = []
+    base_files = statistics.median(b["files"] or 0 for b in baseline)
+    for name, phase in phases.items():
+        past = [b["phases"][name] for b in baseline if name in b["phases"]]
+        if len(past) < MIN_BASELINE_RUNS:
+            continue
+
+        wall = phase["wall"]
+        base_wall = statistics.median(p["wall"] for p in past)
+        if wall < MIN_PHASE_TIME or wall < REGRESSION_FACTOR * base_wall:
+            continue
+
+        # The work of the phase if it counts it. Otherwise the whole run
+        files, base = phase["files"], statistics.median(p["files"] for p in past)
+        if not (files and base):
+            files, base = run["files"], base_files
+        if base and files > FLAT_FACTOR * base:
+            continue  # Slower but also more to do
+
+        msgs.append(
+            f"Phase {name!r} took {utils.time_format(wall)} vs a baseline of "
+            f"{utils.time_format(base_wall)} ({wall / max(base_wall, 1e-3):0.1f}x) "
+            f"with {files} files vs {base:0.0f}"
+        )
+    return msgs
+
+
+def predict_transfer(baseline, nfiles, nbytes):
+    """
+    Predict how long it takes to transfer nfiles of nbytes from the median bytes
+    and files per second of the baseline. The slower of the two is used. Returns
+    (seconds, bytes per second) or None if there isn't enough history
+    """
+    past = [
+        b
+        for b in baseline
+        if (b["transfer_bytes"] or 0) >= MIN_TRANSFER_BYTES and b["transfer_time"]
+    ]
+    if not past:
+        return None
+
+    byte_rates = [b["transfer_bytes"] / b["transfer_time"] for b in past]
+    file_rates = [(b["transfer_files"] or 0) / b["transfer_time"] for b in past]
+    byte_rate, file_rate = statistics.median(byte_rates), statistics.median(file_rates)
+    dt = nbytes / byte_rate
+    if file_rate:
+        dt = max(dt, nfiles / file_rate)
+    return dt, byte_rate
@@ -3,12 +3,18 @@ import shutil
 import time, datetime
 from collections import defaultdict
 import subprocess
+import sqlite3
+import threading
 from pathlib import Path
 
 from . import log, debug
-from .rclone import Rclone
+from .rclone import Rclone, RunCancelled, FILE_LOG_NAME
+from .planner import plan_dir_moves
+from .streaming import NewFileStream
+from .metrics import Metrics
+from . import history
+from . import perf
 from . import utils
-from .utils import ReturnThread
 
 
 class RIRB:
@@ -34,8 +40,37 @@ class RIRB:
 
         self.rclone = Rclone(config)
 
+        # Everything still running is cancelled at the deadline
+        self.deadline = None
+        if config.max_run_time:
+            self.deadline = threading.Timer(
+                config.max_run_time,
+                self.rclone.cancel,
+                args=[f"max_run_time of {utils.time_format(config.max_run_time)}"],
+            )
+            self.deadline.daemon = True
+            self.deadline.start()
+
+        # Startup probes. The rclone cache dir is needed for the interrupt check
+        self.profiler = self.rclone.profiler
+        probes = utils.Pipeline(
+            config.max_concurrent_calls,
+            name="probes",
+            on_error=self.rclone.cancel,
+            profiler=self.profiler,
+        )
+        probes.add("version", self.rclone.version)
+        probes.add("cache_dir", self.rclone.local_cache_dir)
+        probes.run()
+
+        self.journal = None
         if self.rclone.init_check_interupt():
-            if config.automatic_dst_list or config.cliconfig.dst_list:
+            if config.resume_interrupted and not config.cliconfig.dst_list:
+                self.journal = self.check_journal(self.rclone.read_journal())
+
+            if self.journal:
+                log("Previous run did not complete. Resuming from its journal")
+            elif config.automatic_dst_list or config.cliconfig.dst_list:
                 log(
                     "Previous run did not complete. Moving to --dst-list mode (if not already set)"
                 )
@@ -48,36 +83,70 @@ class RIRB:
 
         self.run_shell(mode="pre")
 
-        self.loc_prev = self.rclone.pull_prev_list()
-
-        # Do this in its own thread so it can run at the same time as --dst-list.
-        # Joined after listing dst
-        log(f"Generating source file list: {repr(config.src)}")
-        cthread = ReturnThread(
-            target=self.rclone.list_source,
-            kwargs=dict(prev=self.loc_prev),
-        ).start()
+        self._begun = False
+        self._begin_lock = threading.Lock()
+        self.stream = None
+        stream = config.stream_new_files and self.can_stream()
+
+        # The listings and the previous list are run as soon as what they need is
+        # done. The source is listed without hashes (unless they are not reused)
+        # while the previous list is pulled and then the hashes are reused.
+        pipe = utils.Pipeline(
+            config.max_concurrent_calls,
+            name="startup",
+            on_error=self.rclone.cancel,
+            profiler=self.profiler,
+        )
+        needs_hash_type = []
+        if config.hash_type == "auto":
+            pipe.add("hash_type", self.set_auto_hash_type)
+            needs_hash_type = ["hash_type"]
+
+        pipe.add("prev", self.load_prev)
+        pipe.add("features", self.rclone.dst_features)
+
+        # Fail before any listing if there is no common hash for --dst-list
+        before_list = needs_hash_type if config.cliconfig.dst_list else []
+        if self.rclone.hashes_in_listing():
+            before_list = needs_hash_type
+        if stream:  # Needs the previous list to know what is new and to plan
+            before_list = before_list + ["prev", "features"]
+        pipe.add("list_src", self.list_source, stream=stream, after=before_list)
+        pipe.add(
+            "src_hashes",
+            self.add_source_hashes,
+            after=["list_src", "prev"] + needs_hash_type,
+        )
 
         if config.cliconfig.dst_list:
             log("Using --dst-list")
-            # Do this in its own thread while the above is also running
-            pthread = ReturnThread(target=self.rclone.list_dest).start()
-            self.prev = self.dst_prev = pthread.join()
+            pipe.add("list_dst", self.list_dest, after=needs_hash_type)
+        pipe.run()
+
+        if config.cliconfig.dst_list:
+            self.prev = self.dst_prev
         else:
             self.prev = self.loc_prev
             self.dst_prev = None
 
-        self.curr = cthread.join()
+        # Plan traversal and moves from what is currently on the destination
+        self.rclone.plan(self.prev)
 
         # Directories. Used in a few places
         self.curr_dirs = {os.path.dirname(file) for file in self.curr}
         self.prev_dirs = {os.path.dirname(file) for file in self.prev}
 
-        self.compare()  # sets self.new, self.modified, self.deleted
-        self.renames()  # sets self.renamed and updates self.new and self.deleted
+        # sets self.new, self.modified, self.touched, self.deleted
+        with self.profiler.phase("compare"):
+            self.compare()
+            self.profiler.count(files=len(self.curr))
+
+        # sets self.renamed and updates self.new and self.deleted
+        with self.profiler.phase("renames"):
+            self.renames()
 
         self.diffs = {}  # Just combined to be cleaner
-        for name in ["new", "modified", "deleted", "renamed"]:
+        for name in self.diff_names():
             val = getattr(self, name)
             self.diffs[name] = val
             debug(f"{name}: {val}")
@@ -88,14 +157,19 @@ class RIRB:
 
         if self.config.cliconfig.dry_run or self.config.cliconfig.interactive:
             log("Planned Actions")
-            for name in ["new", "modified", "deleted"]:
+            for name in self.diff_names():
+                if name == "renamed":
+                    continue
                 flist = getattr(self, name)
                 for file in sorted(flist, key=str.lower):
                     log(f"  {name}: {repr(file)}")
             key = lambda a: (a[0].lower(), a[1].lower())
             for s, d in sorted(self.renamed, key=key):
                 log(f"  rename: {repr(s)} --> {repr(d)}")
+            for s, d in sorted(self.dir_moves, key=key):
+                log(f"  directory move: {repr(s)} --> {repr(d)}")
 
+            self.predict_transfer()
             if self.config.cliconfig.dry_run:
                 return self.run_shell(mode="post")
 
@@ -103,32 +177,79 @@ class RIRB:
             if not cont.lower().startswith("y"):
                 return self.run_shell(mode="post")
 
-        # Now we start to modify the remote
-        self.rclone.set_check_interupt()
+        # Now we start to modify the remote (if streaming hasn't already)
+        self.begin_backup()
 
         log(f"Uploading actions to: {repr(config.dst)}")
 
-        # Upload the backed_up_files.json.gz and diffs.json.gz
+        # The backup is run as a pipeline where independent steps run at the same
+        # time. The order that matters for an interrupted backup is kept: the
+        # backed_up_files.json.gz and diffs.json.gz are uploaded before any data
+        # changes and curr.json.gz only after all of it. Transfers, renames, and
+        # deletes each touch different files so they can run together.
         self.backup_list = self.build_backup_file_lists()
-        self.rclone.upload_diffs_backups(
-            self.diffs, self.backup_list, prefix=config.prefix_incomplete_backups
+        pipe = utils.Pipeline(
+            config.max_concurrent_calls,
+            name="backup",
+            on_error=self.rclone.cancel,
+            profiler=self.profiler,
         )
 
-        # Main backup
-        self.rclone.transfer(
-            curr=self.curr, new=self.new, modified=self.modified, prev=self.prev
+        # The streamed transfers upload partial diffs so they must finish first
+        if self.stream:
+            pipe.add("stream", self.stream.finish)
+        pipe.add(
+            "diffs",
+            self.rclone.upload_diffs_backups,
+            self.diffs,
+            self.backup_list,
+            prefix=config.prefix_incomplete_backups,
+            after=["stream"] if self.stream else [],
+        )
+
+        # Main backup. Streamed files are already done
+        streamed = set(self.stream.files) if self.stream else set()
+        pipe.add(
+            "transfer",
+            self.rclone.transfer,
+            curr=self.curr,
+            new=[path for path in self.new if path not in streamed],
+            modified=self.modified,
+            prev=self.prev,
+            touched=self.touched,
+            verify=self.verify,
+            after=["diffs"],
         )
 
         # Moves and deletes (ay the file-by-file level)
-        self.rclone.rename(self.renamed)
-        self.rclone.delete(self.deleted)
+        pipe.add(
+            "rename",
+            self.rclone.rename,
+            self.renamed,
+            dir_moves=self.dir_moves,
+            after=["diffs"],
+        )
+        pipe.add("delete", self.rclone.delete, self.deleted, after=["diffs"])
+        data = ["transfer", "rename", "delete"]
 
         # These "finalize" the upload
-        self.rclone.upload_curr(self.curr)
+        pipe.add("curr", self.rclone.upload_curr, self.curr, after=data)
         if config.prefix_incomplete_backups:
-            self.rclone.remove_prefix_diffs_backups(backup=bool(self.backup_list))
+            pipe.add(
+                "prefix",
+                self.rclone.remove_prefix_diffs_backups,
+                backup=bool(self.backup_list),
+                after=["curr"],
+            )
 
-        self.rclone.rmdirs(curr_dirs=self.curr_dirs, prev_dirs=self.prev_dirs)
+        pipe.add(
+            "rmdirs",
+            self.rclone.rmdirs,
+            curr_dirs=self.curr_dirs,
+            prev_dirs=self.prev_dirs,
+            after=data,
+        )
+        pipe.run()
 
         log("Summary:")
         self.summary_text = self.summary()
@@ -141,36 +262,259 @@ class RIRB:
 
         self.savelog()
 
+    def check_journal(self, entries):
+        """Return the journal entries if the run can be resumed from them or None"""
+        config = self.config
+        if not entries:
+            log("No journal from the previous run")
+            return
+
+        start = entries[0]
+        if start.get("event") != "start" or (start.get("src"), start.get("dst")) != (
+            config.src,
+            config.dst,
+        ):
+            log("Journal of the previous run does not match this config")
+            return
+
+        if start.get("dst_list"):
+            log("Previous run used --dst-list. Can't resume from its journal")
+            return
+
+        # Transfer batches can be resumed but renames and deletes cannot. They are
+        # too ambiguous if interrupted part way.
+        unfinished = set()
+        for entry in entries:
+            if entry.get("stage") == "transfer":
+                continue
+            if entry.get("event") == "begin":
+                unfinished.add(entry["stage"])
+            elif entry.get("event") == "done":
+                unfinished.discard(entry["stage"])
+        if unfinished:
+            log(f"Previous run was interrupted during {sorted(unfinished)}")
+            return
+
+        return entries
+
+    def replay_journal(self):
+        """
+        Apply the completed work of the interrupted run to the previous file list so
+        that only the unfinished work is planned. Sets self.verify to the files of
+        any unfinished transfer batches.
+        """
+        prev = self.loc_prev
+        inflight = set()
+        ntrans = 0
+        for entry in self.journal:
+            event, stage = entry.get("event"), entry.get("stage")
+            if event == "begin" and stage == "transfer":
+                inflight.update(entry["files"])
+            elif event == "batch":
+                prev.update(entry["files"])
+                inflight.difference_update(entry["files"])
+                ntrans += len(entry["files"])
+            elif event == "done" and stage == "rename":
+                for src, dst in entry["renames"]:
+                    if src in prev:
+                        prev[dst] = prev.pop(src)
+            elif event == "done" and stage == "delete":
+                for path in entry["files"]:
+                    prev.pop(path, None)
+
+        self.verify = inflight
+        log(
+            f"Replayed journal: {ntrans} transfered files. "
+            f"{len(inflight)} files from interrupted batches to verify"
+        )
+
+    def load_prev(self):
+        """Pull the previous list and replay the journal (if resuming)"""
+        self.loc_prev = self.rclone.pull_prev_list()
+
+        self.verify = set()  # Files that may or may not have been transfered
+        if self.journal:
+            self.replay_journal()
+
+    def list_source(self, stream=False):
+        log(f"Generating source file list: {repr(self.config.src)}")
+        if not stream:
+            self.curr = self.rclone.list_source_files()
+            return
+
+        log("Streaming new files while listing")
+        self.rclone.plan(self.loc_prev)  # Planned again after the listings
+        self.stream = NewFileStream(
+            self.rclone, self.loc_prev, on_begin=self.begin_backup
+        )
+        try:
+            self.curr = self.rclone.list_source_files(on_file=self.stream.add)
+        except RunCancelled:
+            self.stream.finish()  # Raise the error of the stream if it cancelled
+            raise
+        finally:
+            self.stream.close()
+
+    def can_stream(self):
+        """Whether new files can be streamed while listing"""
+        cliconfig = self.config.cliconfig
+        if cliconfig.dst_list or cliconfig.dry_run or cliconfig.interactive:
+            log("Not streaming new files with --dst-list, --dry-run, or --interactive")
+            return False
+        return True
+
+    def begin_backup(self):
+        """Set the interrupt marker and start the journal. Only done once"""
+        with self._begin_lock:
+            if self._begun:
+                return
+            self._begun = True
+            self.rclone.set_check_interupt()
+            self.rclone.journal_start(carry=self.journal[1:] if self.journal else ())
+
+    def add_source_hashes(self):
+        self.curr = self.rclone.add_source_hashes(self.curr, prev=self.loc_prev)
+
+    def list_dest(self):
+        self.dst_prev = self.rclone.list_dest()
+
+    def set_auto_hash_type(self):
+        """
+        Set config.hash_type to the cheapest common hash. Fails before any listing
+        if a hash compare against the destination is needed and there is none. With
+        --init, there is nothing on the destination to compare to.
+        """
+        config = self.config
+        hash_type, common = self.rclone.auto_hash_type()
+
+        dst_compare = config.dst_compare if config.dst_compare else config.compare
+        dst_list = config.cliconfig.dst_list and not config.cliconfig.init
+        if dst_list and dst_compare == "hash" and not common:
+            raise NoCommonHashError(
+                "No common hash between src and dst. Change 'dst_compare'"
+            )
+
+        config.hash_type = [hash_type] if hash_type else None
+
     def savelog(self, fail=False):
+        if getattr(self, "deadline", None):
+            self.deadline.cancel()
+
         if fail:
+            # Any (fail-fast) cancellation is only for the backup itself
+            self.rclone.clear_cancel()
             failtxt = "FAILED_"
             logname = str(Path(self.logname).with_suffix(".FAILED.log"))
         else:
             failtxt = ""
             logname = self.logname
-        logdests = [utils.pathjoin(self.rclone.destpath.logs, f"{failtxt}log.log")]
+        suffix = ""
+        if codec := self.config.log_compression:
+            suffix = utils.COMPRESSORS[codec][1]
+        logdests = [
+            utils.pathjoin(self.rclone.destpath.logs, f"{failtxt}log.log{suffix}")
+        ]
         if self.config.log_dest:
             if isinstance(self.config.log_dest, str):
                 self.config.log_dest = [self.config.log_dest]
-            joined = (utils.pathjoin(d, logname) for d in self.config.log_dest)
+            joined = (utils.pathjoin(d, logname + suffix) for d in self.config.log_dest)
             logdests.extend(joined)
 
         debug(f"{logdests =}")
 
-        logfile = self.config.tmpdir / self.logname
+        self.update_history(fail=fail)
+
+        # Written before any upload so that a failed run to an unreachable
+        # destination still reports it
+        self.save_metrics(fail=fail)
+        if tracer := self.rclone.profiler.tracer:
+            tracer.write(
+                self.config.cliconfig.trace,
+                now=self.now,
+                src=self.config.src,
+                dst=self.config.dst,
+                failed=fail,
+            )
+
+        profiler = self.rclone.profiler
+        log("Profile:")
+        for line in profiler.summary():
+            log(f"  {line}")
+        log(f"  Total rclone time: {utils.time_format(self.rclone.rclonetime)}")
+
+        logfile = self.config.tmpdir / (self.logname + suffix)
         log("Saving logs to:")
         for logdest in logdests:
             log(f"  {logdest}")
+        if file_log := self.rclone.close_file_log():
+            log(f"Per-file rclone output is in {FILE_LOG_NAME} next to the log")
         log("--- End of log ---")
 
-        shutil.copy2(log.log_file, logfile)
-        for logdest in logdests:
-            self.rclone.copylog(logfile, logdest)
+        log.flush()
+        profile = self.save_profile(fail=fail)
+        with profiler.phase("log upload"):
+            # Compressed once for all of the destinations
+            if codec:
+                utils.compress_file(log.log_file, logfile, codec)
+            else:
+                shutil.copy2(log.log_file, logfile)
+
+            # A failed destination does not stop the others. Raised once all are done
+            pipe = utils.Pipeline(
+                self.config.max_concurrent_calls,
+                name="savelog",
+                profiler=profiler,
+                keep_going=True,
+            )
+            for logdest in logdests:
+                pipe.add(logdest, self.rclone.copylog, logfile, logdest)
+            if file_log:
+                rpath = utils.pathjoin(self.rclone.destpath.logs, FILE_LOG_NAME)
+                pipe.add(FILE_LOG_NAME, self.rclone.copylog, file_log, rpath)
+            rpath = utils.pathjoin(self.rclone.destpath.logs, "profile.json")
+            pipe.add("profile.json", self.rclone.copylog, profile, rpath)
+            try:
+                pipe.run()
+                upload_error = None
+            except Exception as err:
+                upload_error = err
+
+        if upload_error:
+            raise upload_error
+
+    def save_profile(self, fail=False):
+        """
+        Write profile.json to upload next to curr.json.gz. Returns its path. It is
+        written before the log upload so it does not include it
+        """
+        path = self.config.tmpdir / "profile.json"
+        self.rclone.profiler.write(
+            path,
+            now=self.now,
+            src=self.config.src,
+            dst=self.config.dst,
+            failed=fail,
+            rclone_time=round(self.rclone.rclonetime, 4),
+        )
+        return path
 
     def summary(self, actions=False):
         """Summary. If actions is True, does not include total or time"""
         res = [f"Total: {utils.summary_text(self.curr)}"] if not actions else []
-        for name in ["new", "modified", "deleted", "renamed"]:
+        for name, pp in self.summary_files().items():
+            res.append(f"{name.title()}: {utils.summary_text(pp)}")
+
+        if not actions:
+            dt = utils.time_format(time.time() - self.t0)
+            res.append(f"Elapsed Time: {dt}")
+            api = self.rclone.profiler.total.api
+            res.append(f"API Calls (est.): {perf.api_text(api)}")
+        return res
+
+    def summary_files(self):
+        """Return {name: {path: file}} of each diff list in the summary"""
+        res = {}
+        for name in self.diff_names():
             filelist = getattr(self, name)
             if name == "renamed":
                 if not self.config.renames:  # No need for renames if not tracking
@@ -178,17 +522,123 @@ class RIRB:
                 filelist = [s[1] for s in filelist]
 
             # Use if... rather that .get() to avoid eval
-            pp = {
+            res[name] = {
                 p: (vv if (vv := self.curr.get(p, None)) else self.prev.get(p, {}))
                 for p in filelist
             }
-            res.append(f"{name.title()}: {utils.summary_text(pp)}")
-
-        if not actions:
-            dt = utils.time_format(time.time() - self.t0)
-            res.append(f"Elapsed Time: {dt}")
         return res
 
+    def load_history(self):
+        """Return the History (or None if not used)"""
+        if not self.config.run_history:
+            return
+        if not (cdir := self.rclone.local_cache_dir()):
+            return
+        return history.History(history.history_path(cdir))
+
+    def update_history(self, fail=False):
+        """Flag regressions of this run against the history then add it"""
+        config = self.config
+        try:
+            if not (store := self.load_history()):
+                return
+
+            phases = self.rclone.profiler.top_phases()
+            transfer = [phases[n] for n in ["transfer", "stream"] if n in phases]
+            curr = getattr(self, "curr", None)  # If it failed before the listing
+            run = {
+                "uuid": config._uuid,
+                "dst": config.dst,
+                "now": self.now,
+                "time": time.time(),
+                "success": int(not fail),
+                "duration": time.time() - self.t0,
+                "files": len(curr) if curr is not None else None,
+                "bytes": sum(f.get("Size", 0) for f in curr.values()) if curr else 0,
+                "transfer_files": sum(p["files"] for p in transfer),
+                "transfer_bytes": sum(p["bytes"] for p in transfer),
+                # The time of the transfer calls. The wall time of "stream" is
+                # mostly waiting on the source listing
+                "transfer_time": sum(p["rclone_time"] for p in transfer),
+                "rclone_calls": self.rclone.profiler.total.rclone_calls,
+            }
+
+            if not fail:
+                baseline = store.baseline(config.dst)
+                for msg in history.regressions(run, phases, baseline):
+                    log(f"REGRESSION: {msg}")
+            store.add(run, phases)
+        except sqlite3.Error as err:  # Never fail a backup over it
+            log(f"WARNING: Could not update the run history: {err!r}")
+
+    def predict_transfer(self):
+        """Log the predicted transfer time of the planned actions"""
+        try:
+            if not (store := self.load_history()):
+                return
+            baseline = store.baseline(self.config.dst)
+        except sqlite3.Error as err:
+            log(f"WARNING: Could not read the run history: {err!r}")
+            return
+
+        files = {path: self.curr[path] for path in self.new + self.modified}
+        nbytes = sum(file.get("Size", 0) for file in files.values())
+        pred = history.predict_transfer(baseline, len(files), nbytes)
+        if pred is None:
+            log("Not enough run history to predict the transfer time")
+            return
+        dt, rate = pred
+        rate, unit = utils.bytes2human(rate)
+        log(
+            f"Predicted transfer time: {utils.time_format(dt)} for "
+            f"{utils.summary_text(files)} at {rate:0.2f} {unit}/s"
+        )
+
+    def save_metrics(self, fail=False):
+        """Write the prometheus_textfile (if set)"""
+        config = self.config
+        if not (path := config.prometheus_textfile):
+            return
+        path = Path(path)
+        if path.is_dir():
+            path = path / f"rirb_{config._uuid}.prom"
+
+        metrics = Metrics(uuid=config._uuid, src=config.src, dst=config.dst)
+        metrics.add("rirb_success", not fail, "Whether the last run succeeded")
+        metrics.add("rirb_last_run_timestamp_seconds", time.time(), "End of last run")
+        metrics.add("rirb_duration_seconds", time.time() - self.t0, "Run time")
+
+        # Not known if it failed before the comparison
+        if hasattr(self, "diffs"):
+            files = {"total": self.curr, **self.summary_files()}
+            for name, flist in files.items():
+                size = sum(file.get("Size", 0) for file in flist.values())
+                metrics.add("rirb_files", len(flist), "Number of files", kind=name)
+                metrics.add("rirb_bytes", size, "Size of the files", kind=name)
+
+        profiler = self.rclone.profiler
+        for name, phase in profiler.top_phases().items():
+            wall = phase["wall"]
+            metrics.add("rirb_phase_duration_seconds", wall, "Phase time", phase=name)
+
+        total = profiler.total
+        metrics.add("rirb_rclone_calls", total.rclone_calls, "Number of rclone calls")
+        metrics.add("rirb_rclone_seconds", total.rclone_time, "Total rclone call time")
+        metrics.add("rirb_rclone_bytes", total.bytes, "Bytes moved by rclone")
+        metrics.add("rirb_rclone_files", total.moved, "Files moved by rclone")
+        for cls in perf.API_CLASSES:
+            help = "Estimated remote API calls"
+            metrics.add("rirb_api_calls", total.api[cls], help, **{"class": cls})
+
+        metrics.write(path)
+
+    def diff_names(self):
+        """Names of the diff lists. 'touched' is only tracked if it is enabled"""
+        names = ["new", "modified", "deleted", "renamed"]
+        if self.config.metadata_only_updates:
+            names.insert(2, "touched")
+        return names
+
     def build_backup_file_lists(self):
         backup = {}
         for name in ["modified", "deleted"]:
@@ -211,8 +661,18 @@ class RIRB:
         # the backups.
         self.new = []
         self.modified = []
+        self.touched = []  # Only the ModTime changed. Not backed up
         self.deleted = list(set(self.prev) - set(curr))
 
+        self.touch_ok = False
+        if config.metadata_only_updates and attrib == "mtime":
+            self.touch_ok = self.rclone.modtime_update_support()
+            if not self.touch_ok:
+                log(
+                    "WARNING: metadata_only_updates is set but rclone can't update "
+                    "only the ModTime on the destination. Treating them as modified"
+                )
+
         for path, file in self.curr.items():
             try:
                 pfile = self.prev[path]
@@ -221,16 +681,37 @@ class RIRB:
                 continue
 
             try:
-                if not self.file_compare(file, pfile, attrib):
-                    self.modified.append(path)
+                if self.file_compare(file, pfile, attrib):
+                    continue
             except NoCommonHashError:
                 debug(f"Failed Compare {path}")
                 raise
 
+            if self.metadata_only(file, pfile):
+                self.touched.append(path)
+            else:
+                self.modified.append(path)
+
+    def metadata_only(self, file, pfile):
+        """
+        Return whether a file that failed the mtime compare has the same content
+        based on the hashes. Only if metadata_only_updates is set and the destination
+        supports it (see compare()).
+        """
+        if not self.touch_ok:
+            return False
+
+        try:
+            return self.file_compare(file, pfile, "hash")
+        except NoCommonHashError:
+            # Includes when one doesn't have hashes. Treat it as modified
+            return False
+
     def renames(self):
         """Track renames. ONLY uses local file-list"""
 
         self.renamed = []
+        self.dir_moves = []  # (srcdir, dstdir) covering some of self.renamed
         if not self.config.renames:
             log("Rename tracking disabled")
             return
@@ -273,6 +754,24 @@ class RIRB:
         self.new = list(set(self.new) - set(n for _, n in self.renamed))
         self.deleted = list(set(self.deleted) - set(d for d, _ in self.renamed))
 
+        if self.config.dir_moves and self.renamed:
+            self.plan_dir_moves()
+
+    def plan_dir_moves(self):
+        """
+        Find the renames that can be done as whole directory moves. Only when the
+        destination supports DirMove.
+        """
+        if not self.rclone.planner.has("DirMove"):
+            log("Destination does not support DirMove. Not using directory moves")
+            return
+
+        self.dir_moves, remaining = plan_dir_moves(self.renamed, self.prev, self.curr)
+        log(
+            f"Found {len(self.dir_moves)} directory move(s) for "
+            f"{len(self.renamed) - len(remaining)} of {len(self.renamed)} renames"
+        )
+
     def file_compare(self, file, pfile, attrib):
         """
         Return whether the file is the same based on attrib.
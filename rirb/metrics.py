@@ -0,0 +1,56 @@
+"""
+Prometheus metrics of a run for the node_exporter textfile collector
+"""
+import os
+from pathlib import Path
+
+from . import debug
+
+
+class Metrics:
+    """
+    Gauges in the Prometheus text exposition format. Every sample gets the common
+    labels.
+
+        >>> metrics = Metrics(uuid="...", src="src:", dst="dst:")
+        >>> metrics.add("rirb_files", 10, "Number of files", kind="new")
+        >>> metrics.write("rirb.prom")
+    """
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self.metrics = {}  # name: (help, [(labels, value)])
+
+    def add(self, name, value, help, **labels):
+        self.metrics.setdefault(name, (help, []))[1].append((labels, value))
+
+    def text(self):
+        lines = []
+        for name, (help, samples) in self.metrics.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                labels = {**self.labels, **labels}
+                labels = ",".join(f'{k}="{escape(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{{{labels}}} {float(value)!r}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Write atomically (so the collector never reads a partial file) by writing
+        to a temporary file in the same directory and renaming it
+        """
+        path = Path(path)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        try:
+            tmp.write_text(self.text())
+            os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok=True)
+        debug(f"Wrote metrics to {path}")
+
+
+def escape(value):
+    """Escape a label value"""
+    value = str(value)
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
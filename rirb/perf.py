@@ -0,0 +1,376 @@
+"""
+Per-phase performance profile of a run and an optional Chrome trace
+"""
+import os, sys
+import time
+import json
+import math
+import functools
+import threading
+from collections import Counter
+from threading import Lock, local
+
+try:
+    import resource
+except ImportError:  # Not on Windows
+    resource = None
+
+from . import log, debug
+from . import utils
+from .planner import PAGE_SIZE
+
+# Classes of remote API calls. Roughly S3 LIST, GET/HEAD, and PUT/COPY/DELETE or B2
+# class C, B, and A transactions
+API_CLASSES = ("list", "read", "write")
+LIST_COMMANDS = frozenset({"lsf", "lsjson", "ls", "lsl", "lsd", "size"})
+
+
+class Phase:
+    """
+    Measurements of one phase. The rclone counts (calls, time, bytes, files, and
+    estimated API calls) include those of any phases inside of it. The files also
+    count those listed and compared while moved is only the files that rclone
+    transferred, deleted, or renamed. The CPU time is of the Python thread that ran
+    it (rclone's own CPU is not included).
+    """
+
+    def __init__(self, name, parent=None, t0=0.0):
+        self.name = name
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent else 0
+        self.start = time.time() - t0  # relative to the profile start
+        self.wall = None
+        self.cpu = None
+        self.maxrss = None
+        self.error = None
+
+        self.rclone_calls = 0
+        self.rclone_time = 0.0
+        self.bytes = 0
+        self.files = 0
+        self.moved = 0
+        self.api = Counter()
+
+    def asdict(self):
+        return {
+            "name": self.name,
+            "parent": self.parent.name if self.parent else None,
+            "start": round(self.start, 4),
+            "wall": round(self.wall, 4) if self.wall is not None else None,
+            "cpu": round(self.cpu, 4) if self.cpu is not None else None,
+            "maxrss": self.maxrss,
+            "rclone_calls": self.rclone_calls,
+            "rclone_time": round(self.rclone_time, 4),
+            "bytes": self.bytes,
+            "files": self.files,
+            "moved": self.moved,
+            "api": {k: self.api[k] for k in API_CLASSES},
+            "error": self.error,
+        }
+
+
+class Profiler:
+    """
+    Record the phases of a run. Phases nest by thread. A phase started in a worker
+    thread needs its parent passed (or the function wrapped with inherit()) so that
+    its counts add to it.
+
+    If trace is set, the phases and anything passed to trace() are also recorded by
+    a Tracer (see `tracer`).
+
+        >>> profiler = Profiler()
+        >>> with profiler.phase("compare"):
+        ...     profiler.count(files=len(files))
+    """
+
+    def __init__(self, trace=False):
+        self.t0 = time.time()
+        self.phases = []
+        self.total = Phase("total")  # Every rclone call, even if not in a phase
+        self._local = local()
+        self._lock = Lock()
+        self.tracer = Tracer(self.t0) if trace else None
+
+    def current(self):
+        """Current phase of this thread (or None)"""
+        return getattr(self._local, "phase", None)
+
+    def phase(self, name, parent=None):
+        return _PhaseContext(self, name, parent)
+
+    def wrap(self, name, func, parent=None):
+        """Return func run as a phase"""
+
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with self.phase(name, parent=parent):
+                return func(*args, **kwargs)
+
+        return wrapped
+
+    def inherit(self, func):
+        """Wrap func (to be run in another thread) to count for the current phase"""
+        phase = self.current()
+
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            prev, self._local.phase = self.current(), phase
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.phase = prev
+
+        return wrapped
+
+    def count(
+        self, *, calls=0, rclone_time=0.0, nbytes=0, files=0, moved=0, api=None
+    ):
+        """Add to the current phase and every phase it is in"""
+        with self._lock:
+            for phase in [self.total, *self._chain(self.current())]:
+                phase.rclone_calls += calls
+                phase.rclone_time += rclone_time
+                phase.bytes += nbytes
+                phase.files += files
+                phase.moved += moved
+                phase.api.update(api or {})
+
+    @staticmethod
+    def _chain(phase):
+        while phase:
+            yield phase
+            phase = phase.parent
+
+    def record_call(self, dt, stats=None, api=None):
+        """
+        Record an rclone call that took dt seconds with its JSON log stats and
+        estimated API calls (see api_calls())
+        """
+        stats = stats or {}
+        files = sum(stats.get(k, 0) for k in ("transfers", "deletes", "renames"))
+        nbytes = stats.get("bytes", 0)
+        self.count(
+            calls=1, rclone_time=dt, nbytes=nbytes, files=files, moved=files, api=api
+        )
+
+    def top_phases(self):
+        """
+        Return {name: {wall, rclone_calls, rclone_time, files, bytes, api}} of the
+        finished top-level phases. Phases with the same name are added together
+        """
+        res = {}
+        for phase in self.phases:
+            if phase.parent or phase.wall is None:
+                continue
+            tot = res.setdefault(
+                phase.name,
+                {
+                    "wall": 0.0,
+                    "rclone_calls": 0,
+                    "rclone_time": 0.0,
+                    "files": 0,
+                    "bytes": 0,
+                },
+            )
+            tot.setdefault("api", Counter())
+            tot["wall"] += phase.wall
+            tot["rclone_calls"] += phase.rclone_calls
+            tot["rclone_time"] += phase.rclone_time
+            tot["files"] += phase.files
+            tot["bytes"] += phase.bytes
+            tot["api"].update(phase.api)
+        return res
+
+    def trace(self, name, t0, dt, *, cat, args=None):
+        """Add a span that started at t0 and took dt seconds to the trace (if any)"""
+        if self.tracer:
+            self.tracer.span(name, t0, dt, cat=cat, args=args)
+
+    def asdict(self, **metadata):
+        return {
+            **metadata,
+            "wall": round(time.time() - self.t0, 4),
+            "maxrss": maxrss(),
+            "api": {k: self.total.api[k] for k in API_CLASSES},
+            "phases": [phase.asdict() for phase in self.phases],
+        }
+
+    def write(self, path, **metadata):
+        with open(path, "wt") as fobj:
+            json.dump(self.asdict(**metadata), fobj, indent=1, ensure_ascii=False)
+        debug(f"Wrote profile to {path}")
+
+    def summary(self):
+        """Lines summarizing the phases. Nested ones are indented"""
+        lines = []
+        for phase in sorted(self.phases, key=lambda p: p.start):
+            if phase.wall is None:  # Still running
+                continue
+            name = "  " * phase.depth + phase.name
+            line = (
+                f"{name:<24} {phase.wall:8.2f} s wall {phase.cpu:8.2f} s cpu "
+                f"{phase.rclone_calls:4d} rclone calls {phase.rclone_time:8.2f} s"
+            )
+            if phase.files:
+                line += f" {phase.files} files"
+            if phase.bytes:
+                line += " {:0.2f} {}".format(*utils.bytes2human(phase.bytes))
+            if sum(phase.api.values()):
+                line += f" API {api_text(phase.api)}"
+            if phase.error:
+                line += " (FAILED)"
+            lines.append(line)
+
+        if rss := maxrss():
+            rss, unit = utils.bytes2human(rss)
+            lines.append(f"Peak memory (RSS): {rss:0.2f} {unit}")
+        return lines
+
+
+class _PhaseContext:
+    def __init__(self, profiler, name, parent):
+        self.profiler = profiler
+        self.name = name
+        self.parent = parent
+
+    def __enter__(self):
+        prof = self.profiler
+        self.prev = prof.current()
+        self.phase = Phase(self.name, parent=self.parent or self.prev, t0=prof.t0)
+        with prof._lock:
+            prof.phases.append(self.phase)
+        prof._local.phase = self.phase
+
+        self.wall0, self.cpu0 = time.time(), time.thread_time()
+        return self.phase
+
+    def __exit__(self, exc_type, exc, tb):
+        phase = self.phase
+        phase.wall = time.time() - self.wall0
+        phase.cpu = time.thread_time() - self.cpu0
+        phase.maxrss = maxrss()
+        if exc is not None:
+            phase.error = repr(exc)
+        self.profiler._local.phase = self.prev
+
+        args = {
+            k: v
+            for k, v in phase.asdict().items()
+            if k in {"rclone_calls", "bytes", "files", "error"}
+        }
+        self.profiler.trace(phase.name, self.wall0, phase.wall, cat="phase", args=args)
+        return False
+
+
+class Tracer:
+    """
+    Record spans in the Chrome trace-event JSON format (for chrome://tracing or
+    https://ui.perfetto.dev). Each thread is its own track named after the thread
+    so concurrent phases and rclone calls show side by side. Times are relative
+    to t0.
+    """
+
+    def __init__(self, t0):
+        self.t0 = t0
+        self.pid = os.getpid()
+        self.events = [
+            {
+                "ph": "M",
+                "name": "process_name",
+                "pid": self.pid,
+                "args": {"name": "rirb"},
+            }
+        ]
+        self.threads = set()
+        self._lock = Lock()
+
+    def span(self, name, t0, dt, *, cat, args=None):
+        tid = threading.get_ident()
+        tname = threading.current_thread().name
+        with self._lock:
+            if (tid, tname) not in self.threads:  # idents are reused by new threads
+                self.threads.add((tid, tname))
+                self.events.append(
+                    {
+                        "ph": "M",
+                        "name": "thread_name",
+                        "pid": self.pid,
+                        "tid": tid,
+                        "args": {"name": tname},
+                    }
+                )
+            self.events.append(
+                {
+                    "ph": "X",
+                    "name": name,
+                    "cat": cat,
+                    "ts": round((t0 - self.t0) * 1e6),
+                    "dur": round(dt * 1e6),
+                    "pid": self.pid,
+                    "tid": tid,
+                    "args": args or {},
+                }
+            )
+
+    def write(self, path, **metadata):
+        with self._lock:
+            trace = {
+                "traceEvents": list(self.events),
+                "displayTimeUnit": "ms",
+                "otherData": metadata,
+            }
+        with open(path, "wt") as fobj:
+            json.dump(trace, fobj, ensure_ascii=False)
+        debug(f"Wrote trace with {len(trace['traceEvents'])} events to {str(path)!r}")
+
+
+def api_calls(cmd, *, dst, stats=None, nout=0):
+    """
+    Estimate the remote API calls (by API_CLASSES) that an rclone call made to dst.
+    rclone does not report its requests so this is from the command and its stats
+    (or nout, the number of output lines of a listing). Calls not involving dst
+    (like listing a local source) count for nothing.
+
+    cmd : The rclone command without the executable
+    """
+    calls = Counter()
+    command, args = cmd[0], [str(arg) for arg in cmd[1:]]
+    if not any(arg.startswith(dst) for arg in args):
+        return calls
+
+    stats = stats or {}
+    if command in LIST_COMMANDS:
+        calls["list"] += max(1, math.ceil(nout / PAGE_SIZE))
+    elif command in {"copy", "move", "sync"}:
+        # Moves on most object stores are a copy and a delete
+        calls["write"] += stats.get("transfers", 0) + stats.get("deletes", 0)
+        calls["write"] += 2 * stats.get("renames", 0)
+        calls["read"] += stats.get("checks", 0)
+        calls["list"] += math.ceil(stats.get("listed", 0) / PAGE_SIZE)
+    elif command == "copyto":
+        if args[0].startswith(dst):  # download
+            calls["read"] += 1
+        else:  # Check and then upload
+            calls["read"] += 1
+            calls["write"] += 1
+    elif command == "moveto":
+        calls["read"] += 1
+        calls["write"] += 2
+    elif command in {"rmdir", "rmdirs"}:
+        calls["list"] += 1
+        calls["write"] += 1
+    elif command == "cat":
+        calls["read"] += 1
+    return calls
+
+
+def api_text(api):
+    return ", ".join(f"{k} {api[k]}" for k in API_CLASSES)
+
+
+def maxrss():
+    """Peak resident memory of this process so far (bytes) or None"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024  # bytes on macOS, else kB
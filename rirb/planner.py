@@ -0,0 +1,274 @@
+"""
+Plan how rclone traverses and moves files on the destination from its backend
+features and the known file listing
+"""
+import os
+import math
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from itertools import zip_longest
+
+from . import log, debug
+
+# Used when the backend features are not known
+NO_TRAVERSE_LIMIT = 50  # Something of a WAG
+
+PAGE_SIZE = 1000  # Entries per listing call. Typical of S3, B2, etc
+
+# Cost of a listing call relative to a read (stat) with economy. S3 LIST is 12.5x
+# a GET and B2 class C 10x a class B
+ECONOMY_LIST_COST = 10
+
+TRAVERSAL_FLAGS = {
+    "no-traverse": ["--no-traverse"],
+    "traverse": [],
+    "fast-list": ["--fast-list"],
+}
+
+
+class Planner:
+    """
+    Pick traversal and move strategies for the destination with a simple cost model
+    of the number of API calls.
+
+    features : The `rclone backend features` of the destination. None if unknown
+    listing : The files currently on the destination (relative to curr)
+    user_flags : The rclone_flags. If they already set the traversal, it is not planned
+    list_cost : Cost of a listing call relative to a stat (see economy)
+    """
+
+    def __init__(self, features, listing, user_flags=(), list_cost=1):
+        self.known = features is not None
+        self.list_cost = list_cost
+        self.can = (features or {}).get("Features", {})
+        self.user_set = {"--no-traverse", "--fast-list"}.intersection(user_flags)
+
+        # Number of entries directly in each directory (to list it) and in its
+        # whole subtree (to list it recursively with ListR)
+        self.entries = Counter()
+        self.subtree = Counter()
+        dirs = set()
+        for path in listing:
+            parent = os.path.dirname(path)
+            self.entries[parent] += 1
+            for anc in ancestors(parent):
+                self.subtree[anc] += 1
+            while parent and parent not in dirs:
+                dirs.add(parent)
+                grandparent = os.path.dirname(parent)
+                self.entries[grandparent] += 1
+                for anc in ancestors(grandparent):
+                    self.subtree[anc] += 1
+                parent = grandparent
+
+    def has(self, feature):
+        return bool(self.can.get(feature))
+
+    def estimate(self, files, base=""):
+        """
+        Return {strategy: estimated API calls} to find files (relative to base) on
+        the destination
+        """
+        est = {"no-traverse": len(files)}  # One stat (NewObject) each
+
+        # Only the directories leading to the files are listed
+        dirs = set()
+        for file in files:
+            dirs.update(ancestors(os.path.dirname(os.path.join(base, file)), stop=base))
+        est["traverse"] = sum(pages(self.entries[d]) for d in dirs)
+
+        if self.has("ListR"):
+            est["fast-list"] = pages(self.subtree[base])
+        return est
+
+    def traversal(self, files, *, base="", name=""):
+        """Return the rclone flags to find files (relative to base)"""
+        if self.user_set:
+            debug(f"Plan {name}: {self.user_set} set in rclone_flags")
+            return []
+
+        if not self.known:
+            flags = TRAVERSAL_FLAGS["traverse"]
+            if len(files) <= NO_TRAVERSE_LIMIT:
+                flags = TRAVERSAL_FLAGS["no-traverse"]
+            debug(f"Plan {name}: unknown features. Using {flags}")
+            return flags
+
+        est = self.estimate(files, base=base)
+        cost = {  # Only no-traverse doesn't list
+            k: v * (1 if k == "no-traverse" else self.list_cost) for k, v in est.items()
+        }
+        choice = min(cost, key=cost.get)  # Ties go to the first, no-traverse
+        others = ", ".join(f"{k}: {v}" for k, v in est.items() if k != choice)
+        log(f"Plan {name}: {choice} (est. {est[choice]} API calls vs {others})")
+        return TRAVERSAL_FLAGS[choice]
+
+    def move_strategy(self, nfiles, *, name=""):
+        """Log and return how nfiles will be moved on the destination"""
+        if self.has("Move"):
+            strategy, calls = "server-side move", nfiles
+        elif self.has("Copy"):
+            strategy, calls = "server-side copy and delete", 2 * nfiles
+        else:
+            strategy, calls = "download, upload, and delete", 3 * nfiles
+
+        if self.known:
+            log(f"Plan {name}: {strategy} (est. {calls} API calls)")
+        return strategy
+
+
+def plan_dir_moves(renames, prev, curr):
+    """
+    Find directory moves that do the same as some of the per-file renames. See
+    docs/Directory_Move_Optimization.md for the edge cases.
+
+    A directory S can be moved to D if:
+
+      - Every file under S on the destination (prev) is renamed to the same path
+        under D.
+      - No file will remain under S (curr).
+      - No file is currently under D (prev) and the only ones that will be there
+        (curr) are those from S.
+      - It doesn't overlap another directory move. The shallowest are used first.
+
+    Returns (dir_moves, remaining) where dir_moves is a list of (S, D) and remaining
+    are the renames not done by them.
+    """
+    rmap = dict(renames)
+    prev_sorted = sorted(prev)
+    curr_sorted = sorted(curr)
+
+    # Candidates are every pair of parents that share the rest of the path
+    candidates = set()
+    for src, dst in renames:
+        sparts, dparts = src.split("/"), dst.split("/")
+        for k in range(1, min(len(sparts), len(dparts))):
+            if sparts[-k] != dparts[-k]:
+                break
+            candidates.add(("/".join(sparts[:-k]), "/".join(dparts[:-k])))
+
+    verified = []
+    for sdir, ddir in candidates:
+        if overlaps(sdir, ddir) or ddir in prev or ddir in curr:
+            continue
+
+        moved = files_under(prev_sorted, sdir)
+        if not moved or files_under(curr_sorted, sdir):
+            continue
+        if any(rmap.get(file) != ddir + file[len(sdir) :] for file in moved):
+            continue
+        if files_under(prev_sorted, ddir):
+            continue
+        if set(files_under(curr_sorted, ddir)) != {rmap[file] for file in moved}:
+            continue
+        verified.append((sdir, ddir))
+
+    dir_moves = []
+    for sdir, ddir in sorted(verified, key=lambda sd: (sd[0].count("/"), sd)):
+        paths = [path for move in dir_moves for path in move]
+        if any(overlaps(a, b) for a in paths for b in (sdir, ddir)):
+            debug(f"Directory move {sdir!r} --> {ddir!r} overlaps another. Skipping")
+            continue
+        dir_moves.append((sdir, ddir))
+
+    done = set()
+    for sdir, _ in dir_moves:
+        done.update(files_under(prev_sorted, sdir))
+    remaining = [(src, dst) for src, dst in renames if src not in done]
+
+    return dir_moves, remaining
+
+
+def group_renames(renames):
+    """
+    Group renames into as few rclone calls as possible.
+
+    While directory renames are only done when verified (and opted into), we do
+    optimize the renames when (a) the file-name is the the same and (b) there is
+    more than one at a base directory. Consider:
+
+      "A/deep/sub/dir/file1.txt" --> "A/deeper/sub/dir/file1.txt"
+      "A/deep/sub/dir/file2.txt" --> "A/deeper/sub/dir/file2.txt"
+
+    The names ('file1.txt' and 'file2.txt') are the same and there are two moves
+    from "A/deep" to "A/deeper". Therefore, rather than call moveto twice, we do:
+
+      rclone move "A/deep" "A/deeper" --files-from files.txt
+
+    Where 'files.txt' is:
+       sub/dir/file1.txt
+       sub/dir/file2.txt"
+
+    A `move` keeps the path relative to its directories so any group of renames
+    done by one call must share the same (srcdir, dstdir). The only choices for a
+    rename are to split off more or less of the common ending. Splitting off all of
+    it (the shallowest directories) is the same for every rename that shares any
+    split since the rest of the common ending comes from the directories
+    themselves. So this is already the fewest calls. Reorganizations like
+    "2019/*/raw/..." --> "archive/2019/*/raw/..." are all one ("", "archive") group.
+
+    Returns (moveto, move) where moveto is a list of (src, dst) and move is a dict
+    of {(srcdir, dstdir): [files]}
+    """
+    moveto = []  # src,dst
+    move = defaultdict(list)
+
+    for src, dst in renames:
+        sparts = src.split("/")
+        dparts = dst.split("/")
+
+        # Need to zip_longest so that if one is shorter, you don't exhaust the
+        # loop before ixdiv increments
+        for ixdiv, (spart, dpart) in enumerate(
+            zip_longest(sparts[::-1], dparts[::-1])
+        ):
+            if spart != dpart:
+                break
+
+        if ixdiv == 0:  # different name. Must moveto
+            moveto.append((src, dst))
+            continue
+
+        srcdir = "/".join(sparts[:-ixdiv])
+        dstdir = "/".join(dparts[:-ixdiv])
+        file = "/".join(sparts[-ixdiv:])  # == dparts[-ixdiv:]
+        move[srcdir, dstdir].append(file)
+
+    # Now if only one item is being moved, we change it back to a moveto
+    # copy so I can modify move in place
+    for (srcdir, dstdir), files in move.copy().items():
+        if len(files) > 1:
+            continue
+        moveto.append((os.path.join(srcdir, files[0]), os.path.join(dstdir, files[0])))
+        del move[srcdir, dstdir]
+
+    return moveto, dict(move)
+
+
+def files_under(files_sorted, dirpath):
+    """Return the files (from a sorted list) under dirpath"""
+    lo = bisect_left(files_sorted, dirpath + "/")
+    hi = bisect_left(files_sorted, dirpath + "0")  # "0" comes right after "/"
+    return files_sorted[lo:hi]
+
+
+def overlaps(path1, path2):
+    """Whether path1 and path2 are the same or one is inside the other"""
+    return (
+        path1 == path2
+        or path1.startswith(path2 + "/")
+        or path2.startswith(path1 + "/")
+    )
+
+
+def ancestors(path, stop=""):
+    """Yield path and its parents up to and including stop"""
+    while True:
+        yield path
+        if path == stop or not path:
+            return
+        path = os.path.dirname(path)
+
+
+def pages(n):
+    return max(1, math.ceil(n / PAGE_SIZE))
@@ -9,11 +9,15 @@ from pathlib import Path
 import time
 import json
 import gzip as gz
-from collections import defaultdict
-from itertools import zip_longest
+import hashlib
+from collections import defaultdict, deque, Counter
+from threading import Lock, Thread, Event
 
 from . import log, debug
 from . import utils
+from . import tuning
+from . import perf
+from .planner import Planner, group_renames, ECONOMY_LIST_COST
 
 _TESTMODE = False
 _TEST_FAIL_LOC = None  # This will be used in testing to make it fail
@@ -32,7 +36,9 @@ FILTER_FLAGS = frozenset(
     }
 )
 
-NO_TRAVERSE_LIMIT = 50  # Something of a WAG
+MODTIME_NOT_SUPPORTED = 100 * 365 * 24 * 60 * 60 * 10**9  # rclone's Precision (ns)
+FEATURES_CACHE_TTL = 24 * 60 * 60  # seconds
+ECONOMY_FEATURES_CACHE_TTL = 30 * FEATURES_CACHE_TTL
 IGNORED_FILE_DATA = (
     "IsDir",
     "Name",
@@ -40,12 +46,37 @@ IGNORED_FILE_DATA = (
     "Tier",
 )
 MAX_CALL_LOG_LINES = 25  # Max number of lines on call() error
+MAX_STREAM_OUT_LINES = 1000  # Last lines of a streamed call that are kept
+FILE_LOG_NAME = "rclone_files.jsonl.gz"  # Per-file output with rclone_log = "summary"
+CANCEL_GRACE = 5  # seconds to wait for rclone to stop before killing it
+
+PHASES = frozenset({"listing", "transfer", "move", "metadata", "other"})
+STALL_PHASES = frozenset({"transfer", "move"})  # Their calls report progress (stats)
+WATCHDOG_INTERVAL = 1  # seconds
+PROGRESS_STATS = ("bytes", "transfers", "checks", "deletes", "renames")
+TRACE_CMD_LENGTH = 500  # Max characters of the command in a trace span
 
 
 class NoPreviousFileListError(ValueError):
     pass
 
 
+class RunCancelled(RuntimeError):
+    pass
+
+
+class CallTimeout(RuntimeError):
+    """
+    An rclone call that was stopped by the Watchdog. Not a CalledProcessError so
+    that it is never mistaken for a missing file. Has the JSON log result (if any)
+    """
+
+    def __init__(self, reason, result=None):
+        super().__init__(f"rclone call {reason}")
+        self.reason = reason
+        self.result = result
+
+
 class Rclone:
     """
     Main rclone interfacing object
@@ -55,6 +86,20 @@ class Rclone:
 
     def __init__(self, config):
         self.rclonetime = 0.0
+        trace = bool(getattr(config.cliconfig, "trace", None))  # --trace FILE
+        self.profiler = perf.Profiler(trace=trace)
+        self._features = {}
+        self._features_locks = {}  # remote: Lock so each is only looked up once
+        self._features_lock = Lock()
+        self.planner = Planner(None, {})  # Until plan() is called
+        self._journal_lock = Lock()
+        self._file_log = None  # Open on the first per-file line
+        self._file_log_lock = Lock()
+
+        # Running rclone calls so they can be cancelled
+        self._procs = set()
+        self._procs_lock = Lock()
+        self.cancelled = None  # The reason, if cancelled
 
         self.add_args = []
         if config.metadata:
@@ -72,7 +117,6 @@ class Rclone:
         for path, val in self.destpath.items():
             debug(f"Set path {path} = {val}")
         # self.destpath.backup =
-        self.call(["--version"], stream=True)
 
         self.metadata = {
             "timestamp": self.config.now,
@@ -80,6 +124,10 @@ class Rclone:
             "dest": self.config.dst,
         }
 
+    def version(self):
+        """Log the rclone version"""
+        self.call(["--version"], stream=True)
+
     def pull_prev_list(self):
         config = self.config
 
@@ -98,18 +146,7 @@ class Rclone:
 
         if not prevfile:
             try:
-                # First list all dirs
-                cmd = [
-                    "lsf",
-                    self.destpath.log_base,
-                    "--dirs-only",
-                    "--include",
-                    r"{{ \d{4}-\d{2}-\d{2}T\d{6} }}",  # regex. Not sure it's working but the end result works...
-                ]
-                rprevdirs = self.call(cmd)
-                rprevdir = sorted(
-                    ds for d in rprevdirs.split("\n") if (ds := d.strip())
-                )[-1]
+                rprevdir = self.latest_log_dir()
                 rprevfile = utils.pathjoin(
                     self.destpath.log_base, rprevdir, "curr.json.gz"
                 )
@@ -118,7 +155,9 @@ class Rclone:
 
                 cmd = ["copyto", rprevfile, prevfile]
                 cmd += ["--retries", "1"]
-                self.call(cmd, display_error=False, logstderr=False)
+                self.call(
+                    cmd, display_error=False, logstderr=False, phase="metadata"
+                )
 
             except subprocess.CalledProcessError as err:
                 raise NoPreviousFileListError(
@@ -128,6 +167,19 @@ class Rclone:
         with gz.open(prevfile) as fobj:
             return json.load(fobj)
 
+    def latest_log_dir(self):
+        """Return the name of the most recent directory in logs/"""
+        # First list all dirs
+        cmd = [
+            "lsf",
+            self.destpath.log_base,
+            "--dirs-only",
+            "--include",
+            r"{{ \d{4}-\d{2}-\d{2}T\d{6} }}",  # regex. Not sure it's working but the end result works...
+        ]
+        rprevdirs = self.call(cmd, phase="metadata")
+        return sorted(ds for d in rprevdirs.split("\n") if (ds := d.strip()))[-1]
+
     def _local_name(self):
         config = self.config
         if not config.use_local_cache:
@@ -185,24 +237,24 @@ class Rclone:
         if compare == "size":
             cmd += ["--no-modtime"]
         elif compare == "hash":
-            hash_flags = ["--hash"]
-            if config.hash_type:
-                if isinstance(config.hash_type, str):
-                    config.hash_type = [config.hash_type]
-                for htype in config.hash_type:
-                    hash_flags.extend(["--hash-type", htype])
-            cmd += hash_flags
+            cmd += self.hash_flags()
         else:  # compare == 'mtime':
             pass
 
         # Listing flags only for --dst-list
         cmd.extend(config.dst_list_rclone_flags)
 
+        # A recursive listing is always fewer API calls with ListR
+        features = (self.dst_features() or {}).get("Features", {})
+        if features.get("ListR") and "--fast-list" not in cmd + config.rclone_flags:
+            log("Plan dst list: fast-list")
+            cmd += ["--fast-list"]
+
         # Note we do NOT filter or anything like that! It should be the full listing.
         # We allow for an error if and only if this is also an --init run since there
         # may not be a destination to list
         try:
-            raw_files = self.call(cmd)
+            raw_files = self.call(cmd, phase="listing")
         except subprocess.CalledProcessError:
             if self.config.cliconfig.init:
                 log(
@@ -217,22 +269,47 @@ class Rclone:
         files = json.loads(raw_files)
         dst_prev = self.file_list2dict(files)
         debug(f"Read {len(files)} destination files")
+        self.profiler.count(files=len(files))
         return dst_prev
 
     def list_source(self, prev=None):
         """
         List SOURCE, optionally use previous for hashes, add metatada as needed
         """
-        config = self.config
+        return self.add_source_hashes(self.list_source_files(), prev=prev)
 
-        compute_hashes = any(
+    def compute_hashes(self):
+        """Whether source hashes are needed"""
+        config = self.config
+        return any(
             [
                 config.get_hashes,
                 config.compare == "hash",
                 config.renames == "hash",
+                (config.metadata_only_updates and config.compare == "mtime"),
             ]
         )
 
+    def hashes_in_listing(self):
+        """
+        Whether the hashes are computed in the source listing itself rather than
+        after reusing the previous ones. If so, the listing needs the hash_type
+        """
+        return self.compute_hashes() and not self.config.reuse_hashes
+
+    def hash_flags(self):
+        hash_type = self.config.hash_type or []
+        if isinstance(hash_type, str):
+            hash_type = [hash_type]
+        hash_flags = ["--hash"]
+        for htype in hash_type:
+            hash_flags.extend(["--hash-type", htype])
+        return hash_flags
+
+    def _source_list_cmd(self):
+        config = self.config
+        compute_hashes = self.compute_hashes()
+
         skip_modtime = not any(
             [  # Notice this is negated
                 config.get_modtime,
@@ -251,24 +328,55 @@ class Rclone:
         if skip_modtime:
             cmd.append("--no-modtime")
 
-        hash_flags = ["--hash"]
-        if config.hash_type:
-            if isinstance(config.hash_type, str):
-                config.hash_type = [config.hash_type]
-            for htype in config.hash_type:
-                hash_flags.extend(["--hash-type", htype])
+        # add_args (including --metadata) and rclone_flags will be added by call()
+        return cmd
 
-        if compute_hashes and not config.reuse_hashes:
-            cmd.extend(hash_flags)
+    def list_source_files(self, on_file=None):
+        """
+        List SOURCE. Hashes are only included if they will not be reused (see
+        add_source_hashes()) so this does not need the previous list
 
-        # add_args (including --metadata) and rclone_flags will be added by call()
+        If set, on_file(path, file) is called for each file as soon as it is listed
+        """
+        config = self.config
+        cmd = self._source_list_cmd()
+        if self.hashes_in_listing():
+            cmd.extend(self.hash_flags())
+        cmd += config.filter_flags
+
+        if not on_file:
+            files = json.loads(self.call(cmd, phase="listing"))
+            curr = self.file_list2dict(files)
+            debug(f"Read {len(files)} files")
+            self.profiler.count(files=len(curr))
+            return curr
+
+        # lsjson writes one file per line as it goes. Parse them as they come
+        curr = {}
 
-        files = self.call(cmd + config.filter_flags)
-        files = json.loads(files)
-        curr = self.file_list2dict(files)
-        debug(f"Read {len(files)} files")
+        def _line(line):
+            try:
+                file = json.loads(line.rstrip(","))
+            except ValueError:
+                return line if line not in {"[", "]"} else None
+            if not isinstance(file, dict):
+                return line
+            ((path, file),) = self.file_list2dict([file]).items()
+            curr[path] = file
+            on_file(path, file)
+
+        self.call(cmd, stream=True, on_line=_line, phase="listing")
+        debug(f"Read {len(curr)} files")
+        self.profiler.count(files=len(curr))
+        return curr
 
-        if not compute_hashes or (compute_hashes and not config.reuse_hashes):
+    def add_source_hashes(self, curr, prev=None):
+        """
+        Reuse the hashes from prev (as set by reuse_hashes) and compute the rest.
+        Modifies and returns curr
+        """
+        config = self.config
+        if not self.compute_hashes() or self.hashes_in_listing():
             return curr
 
         # Add back the hashes
@@ -312,12 +420,14 @@ class Rclone:
         flistpath = config.tmpdir / "relist.txt"
         flistpath.write_text("\n".join(update_list))
 
+        cmd = self._source_list_cmd()
         cmd.extend(("--files-from", str(flistpath)))
-        cmd.extend(hash_flags)
+        cmd.extend(self.hash_flags())
 
         log(f"Computing hashes for {len(update_list)} files")
-        files = json.loads(self.call(cmd))
+        files = json.loads(self.call(cmd, phase="listing"))
         curr.update(self.file_list2dict(files))
+        self.profiler.count(files=len(files))
 
         return curr
 
@@ -330,14 +440,15 @@ class Rclone:
             out[path] = file
         return out
 
-    def transfer(self, *, curr, new, modified, prev):
+    def transfer(self, *, curr, new, modified, prev, touched=(), verify=()):
         """
-        Transfer new and modified files.
+        Transfer new and modified files. Touched files only get their ModTime updated.
+        Each batch is recorded in the journal
         """
         if _TEST_FAIL_LOC == "transfer":  # Just used in testing
             raise ValueError("Failure created for testing!")
 
-        if not (new or modified or prev):
+        if not (new or modified or touched or prev):
             debug("Nothing to transfer")
             return
 
@@ -350,33 +461,199 @@ class Rclone:
         # what is already there (from `prev`). The `new` and `diff-size` files
         # are transfered with `--size-only` (fast!) and the same-size are transfered
         # with `--ignore-times`.
+        #
+        # The transfers are also split into batches that get recorded in the journal
+        # so that an interrupted run can be resumed.
+        #
+        # Touched files (metadata_only_updates) are known to have the same content so
+        # they are transfered with the default size and ModTime check. Rclone will then
+        # verify the hash and only update the ModTime on the destination. Files are
+        # only touched if the destination supports that (see modtime_update_support).
+        #
+        # Files in `verify` may or may not have been transfered by an interrupted run
+        # so they are also transfered with the default checks. If they were already
+        # updated, rclone will skip them rather than back up the new version.
         same_size = {
             path for path in modified if curr[path]["Size"] == prev[path]["Size"]
         }
         diff_size = set(modified) - same_size
+        verify = same_size.intersection(verify)
 
-        cmd0 = ["copy", self.config.src, self.destpath.curr]
-        cmd0 += ["-v", "--stats-one-line", "--log-format", ""]  # What to show
-        cmd0 += ["--backup-dir", self.destpath.back]  # Let rclone do the backups
+        cmd0 = self.transfer_cmd()
 
         log("Transfering Files")
 
         flag_lists = (
-            ("--ignore-times", same_size),  # Always Transfer
-            ("--size-only", diff_size.union(new)),  # We KNOW they do not match size
+            (["--ignore-times"], same_size - verify),  # Always Transfer
+            (["--size-only"], diff_size.union(new)),  # We KNOW they do not match size
+            ([], verify.union(touched)),  # Let rclone decide (or update the ModTime)
         )
-        for ii, (flag, flist) in enumerate(flag_lists):
-            debug(f"Transfer {len(flist)} with '{flag}'")
-            if not flist:
-                continue
 
-            flistpath = self.config.tmpdir / f"transfer_{ii}.txt"
-            flistpath.write_text("\n".join(flist))
+        # Each size class gets its own batches so that it can use its own flags
+        classes = self.size_classes()
+        work = defaultdict(list)  # class index: [(flags, batch), ...]
+        for flags, flist in flag_lists:
+            debug(f"Transfer {len(flist)} with {flags}")
+            for cc, cfiles in enumerate(self.split_size_classes(flist, curr)):
+                if cfiles:  # Only classes with files get scheduled (and logged)
+                    work[cc].extend(
+                        (flags, batch) for batch in self.batches(cfiles, curr)
+                    )
+
+        order = sorted(work, reverse=self.config.transfer_class_order == "large-first")
+
+        tuners = self.transfer_tuners(len(classes))
+
+        def _transfer_class(cc):
+            max_size, cflags = classes[cc]
+            tuner = tuners.get(cc)
+            if priority := self.config.transfer_class_order:
+                direction = "descending" if priority == "large-first" else "ascending"
+                cflags = cflags + ["--order-by", f"size,{direction}"]
+
+            if len(classes) > 1:
+                label = utils.bytes2human(max_size) if max_size else None
+                label = f"<= {label[0]:0.2f} {label[1]}" if label else "largest"
+                log(f"Size class {cc + 1} ({label}): {len(work[cc])} batches {cflags}")
+
+            for jj, (flags, batch) in enumerate(work[cc]):
+                if len(work[cc]) > 1:
+                    log(f"Transfer batch {jj + 1}/{len(work[cc])}: {len(batch)} files")
+
+                cmd = cmd0 + flags
+                cmd += self.planner.traversal(batch, name=f"transfer batch {jj + 1}")
+
+                bflags = cflags + (tuner.flags() if tuner else [])
+                t0 = time.time()
+                res = self._transfer_batch(
+                    cmd, batch, curr, name=f"transfer_{cc}.{jj}", flags=bflags
+                )
+                if tuner:
+                    tuner.update(res.stats, time.time() - t0)
+
+        if self.config.transfer_parallel_classes and len(order) > 1:
+            # The first failure stops the other classes rather than waiting for them
+            pipe = utils.Pipeline(len(order), name="class", on_error=self.cancel)
+            _transfer = self.profiler.inherit(_transfer_class)
+            for cc in order:
+                pipe.add(f"size class {cc + 1}", _transfer, cc)
+            pipe.run()
+        else:
+            for cc in order:
+                _transfer_class(cc)
+
+        if tuners:
+            transfers = {str(cc): tuner.best[0] for cc, tuner in tuners.items()}
+            tuning.save_tuning(self.tuning_path(), self.config.dst, transfers)
+
+    def transfer_cmd(self):
+        """Base command to transfer files (with --files-from) to curr"""
+        cmd = ["copy", self.config.src, self.destpath.curr]
+        cmd += ["-v", "--stats-one-line", "--log-format", ""]  # What to show
+        cmd += ["--backup-dir", self.destpath.back]  # Let rclone do the backups
+        return cmd
+
+    def tuning_path(self):
+        return tuning.tuning_path(self.local_cache_dir(), self.config.dst)
+
+    def transfer_tuners(self, nclasses):
+        """
+        Return {class index: TransferTuner} if adaptive_transfers is set. They start
+        from the remembered best for this destination
+        """
+        if not self.config.adaptive_transfers:
+            return {}
+        lo, hi = self.config.adaptive_transfers
+        prev = tuning.load_tuning(self.tuning_path())
+        debug(f"Remembered tuning: {prev}")
+        return {
+            cc: tuning.TransferTuner(
+                lo,
+                hi,
+                start=prev.get(str(cc)),
+                name=f"[{cc + 1}]" if nclasses > 1 else "",
+            )
+            for cc in range(nclasses)
+        }
+
+    def _transfer_batch(self, cmd, batch, curr, *, name, flags=None):
+        """
+        Transfer a single batch and record it in the journal. Returns the
+        call_files() result
+        """
+        with self.profiler.phase(f"batch {name}"):
+            self.journal("begin", stage="transfer", files=batch)
+            try:
+                res = self.call_files(
+                    cmd, batch, name=name, flags=flags, phase="transfer"
+                )
+            except (subprocess.CalledProcessError, CallTimeout) as err:
+                # Record the files that did make it before failing
+                outcomes = getattr(err, "outcomes", {})
+                done = [p for p in batch if outcomes.get(p, "").startswith("ok")]
+                if done:
+                    self.journal(
+                        "batch",
+                        stage="transfer",
+                        files={path: curr[path] for path in done},
+                        upload=not self.config.economy,
+                    )
+                raise
+            self.journal(
+                "batch",
+                stage="transfer",
+                files={path: curr[path] for path in batch},
+                upload=not self.config.economy,
+            )
 
-            cmd = cmd0 + ["--files-from", str(flistpath), flag]
-            if len(flist) <= NO_TRAVERSE_LIMIT:
-                cmd += ["--no-traverse"]
-            self.call(cmd, stream=True)
+            if _TEST_FAIL_LOC == "transfer_batch":  # Just used in testing
+                raise ValueError("Failure created for testing!")
+            return res
+
+    def size_classes(self):
+        """
+        Return the [(max_size, flags), ...] of transfer_size_classes sorted by size.
+        The last one always has a max_size of None (no limit)
+        """
+        classes = self.config.transfer_size_classes or []
+        classes = sorted(
+            ((max_size, list(flags)) for max_size, flags in classes),
+            key=lambda c: float("inf") if c[0] is None else c[0],
+        )
+        if not classes or classes[-1][0] is not None:
+            classes.append((None, []))
+        return classes
+
+    def split_size_classes(self, files, curr):
+        """Split files into a list for each size class"""
+        classes = self.size_classes()
+        res = [[] for _ in classes]
+        for path in files:
+            size = curr[path].get("Size", 0)
+            for cc, (max_size, _) in enumerate(classes):
+                if max_size is None or size <= max_size:
+                    res[cc].append(path)
+                    break
+        return res
+
+    def batches(self, files, curr):
+        """
+        Split files into sorted batches of at most transfer_batch_size files and
+        transfer_batch_bytes bytes (if set). Always at least one file per batch
+        """
+        maxnum = self.config.transfer_batch_size or float("inf")
+        maxbytes = self.config.transfer_batch_bytes or float("inf")
+
+        batch, size = [], 0
+        for path in sorted(files):
+            fsize = curr[path].get("Size", 0)
+            if batch and (len(batch) >= maxnum or size + fsize > maxbytes):
+                yield batch
+                batch, size = [], 0
+            batch.append(path)
+            size += fsize
+        if batch:
+            yield batch
 
     def delete(self, files):
         """
@@ -391,70 +668,50 @@ class Rclone:
         # always transfer, and do not traverse
         cmd += ["--no-check-dest", "--ignore-times", "--no-traverse"]
 
-        flistpath = self.config.tmpdir / "move.txt"
-        flistpath.write_text("\n".join(files))
-
-        cmd += ["--files-from", str(flistpath)]
-
         log("Deleting Files")
-        self.call(cmd, stream=True)
+        self.planner.move_strategy(len(files), name="delete")
+        self.journal("begin", stage="delete")
+        self.call_files(cmd, files, name="move", phase="move")
+        self.journal("done", stage="delete", files=list(files), upload=True)
 
-    def rename(self, renames):
+    def rename(self, renames, dir_moves=()):
+        """
+        Rename files. Any dir_moves, (srcdir, dstdir), must have been verified to
+        cover all of the renames under them (see planner.plan_dir_moves). They are
+        done as a single directory move and the rest are done by file.
+        """
         if not renames:
             return
         log(f"Renaming {len(renames)} files")
+        self.journal("begin", stage="rename")
 
-        # While we do not try to optimize for directory renames (too risky and too
-        # many edge cases), we do optimize the renames when (a) the file-name is the
-        # the same and (b) there is more than one at a base directory. Consider:
-        #
-        #   "A/deep/sub/dir/file1.txt" --> "A/deeper/sub/dir/file1.txt"
-        #   "A/deep/sub/dir/file2.txt" --> "A/deeper/sub/dir/file2.txt"
-        #
-        # The names ('file1.txt' and 'file2.txt') are the same and there are two moves
-        # from "A/deep" to "A/deeper". Therefore, rather than call moveto twice, we do:
-        #
-        #   rclone move "A/deep" "A/deeper" --files-from files.txt
-        #
-        # Where 'files.txt' is:
-        #    sub/dir/file1.txt
-        #    sub/dir/file2.txt"
-
-        moveto = []  # src,dst
-        move = defaultdict(list)
-
-        for src, dst in renames:
-            src, dst = Path(src), Path(dst)
-            sparts = src.parts
-            dparts = dst.parts
-
-            # Need to zip_longest so that if one is shorter, you don't exhaust the
-            # loop before ixdiv increments
-            for ixdiv, (spart, dpart) in enumerate(
-                zip_longest(sparts[::-1], dparts[::-1])
-            ):
-                if spart != dpart:
-                    break
-
-            if ixdiv == 0:  # different name. Must moveto
-                moveto.append((str(src), str(dst)))
-                continue
-
-            srcdir = os.path.join(*sparts[:-ixdiv]) if sparts[:-ixdiv] else ""
-            dstdir = os.path.join(*dparts[:-ixdiv]) if dparts[:-ixdiv] else ""
-            file = os.path.join(*sparts[-ixdiv:])  # == dparts[-ixdiv:]
-            # break
-            move[srcdir, dstdir].append(file)
+        all_renames = renames
+        for ii, (srcdir, dstdir) in enumerate(dir_moves):
+            log(f"Directory Move {repr(srcdir)} --> {repr(dstdir)}")
+            cmd = [
+                "move",
+                utils.pathjoin(self.destpath.curr, srcdir),
+                utils.pathjoin(self.destpath.curr, dstdir),
+                "--delete-empty-src-dirs",
+                "--log-level",
+                "INFO",
+                "--stats-one-line",
+                "--log-format",
+                "",
+            ]
+            self.call_files(cmd, name=f"dirmove_{ii}", phase="move")
+
+        if dir_moves:
+            srcdirs = {srcdir for srcdir, _ in dir_moves}
+            renames = [
+                (src, dst)
+                for src, dst in renames
+                if not srcdirs.intersection(map(str, Path(src).parents))
+            ]
 
-        # Now if only one item is being moved, we change it back to a moveto
-        # copy so I can modify move in place
-        for (srcdir, dstdir), files in move.copy().items():
-            if len(files) > 1:
-                continue
-            src = os.path.join(srcdir, files[0])
-            dst = os.path.join(dstdir, files[0])
-            moveto.append((src, dst))
-            del move[srcdir, dstdir]
+        # Renames that share a directory mapping are grouped into a single
+        # `move --files-from` call. See planner.group_renames()
+        moveto, move = group_renames(renames)
 
         debug(f"grouped moves moveto: {moveto}")
         debug(f"grouped moves move: {dict(move)}")
@@ -463,10 +720,12 @@ class Rclone:
         flags += ["--stats-one-line", "--log-format", ""]
 
         # We know in all cases, the dest doesn't exists. So never check dest,
-        # always transfer, and do not traverse. I am NOT CERTAIN about whether
-        # --no-traverse is the right answer. It depends on how many files...
+        # always transfer, and do not traverse. With --no-check-dest, rclone does
+        # not list the source either so there is nothing to plan.
         flags += ["--no-check-dest", "--ignore-times", "--no-traverse"]
 
+        self.planner.move_strategy(len(renames), name="rename")
+
         for sourcefile, destfile in moveto:
             cmd = [
                 "moveto",
@@ -475,25 +734,22 @@ class Rclone:
             ] + flags
 
             log(f"Move {repr(sourcefile)} --> {repr(destfile)}")
-            self.call(cmd, stream=True)
+            self.call_files(cmd, name=sourcefile, phase="move")
 
         for ii, ((srcdir, dstdir), files) in enumerate(move.items()):
             log(f"Grouped Move {repr(srcdir)} --> {repr(dstdir)}")
             for file in files:
                 log(f"  {repr(file)}")
 
-            flistpath = self.config.tmpdir / f"move_{ii}.txt"
-            flistpath.write_text("\n".join(files))
-
             cmd = [
                 "move",
                 utils.pathjoin(self.destpath.curr, srcdir),
                 utils.pathjoin(self.destpath.curr, dstdir),
-                "--files-from",
-                str(flistpath),
             ] + flags
 
-            self.call(cmd, stream=True)
+            self.call_files(cmd, files, name=f"move_{ii}", phase="move")
+
+        self.journal("done", stage="rename", renames=list(all_renames), upload=True)
 
     def rmdirs(self, *, curr_dirs, prev_dirs):
         if not self.config.cleanup_empty_dirs or (
@@ -501,39 +757,54 @@ class Rclone:
         ):
             return
 
-        rmdirs0 = prev_dirs - curr_dirs
-
         # Originally, I sorted by length to get the deepest first but I can
         # actually get the root of them so that I can call rmdirs (with the `s`)
         # and let that go deep
+        roots = utils.root_dirs(prev_dirs - curr_dirs)
+        if not roots:
+            return
 
         cmd0 = ["rmdirs"]
         cmd0 += ["--log-level", "INFO"]  # same as -v
         cmd0 += ["--stats-one-line", "--log-format", ""]
         cmd0 += ["--retries", "1"]
 
-        rmdirs = []
-        for diritem in sorted(rmdirs0):
-            # See if it's parent is already there. This can 100% be improved
-            # since the list is sorted. See https://stackoverflow.com/q/7380629/3633154
-            # for example. But it's not worth it here
-            if any(diritem.startswith(f"{rmdir}/") for rmdir in rmdirs):
-                continue  # ^^^ Add the / so it gets child dirs only
-
-            rmdirs.append(diritem)
-
+        def _rmdir(diritem):
+            debug(f"Removing Directory '{diritem}' (if empty)")
+            cmd = cmd0 + [utils.pathjoin(self.destpath.curr, diritem)]
             try:
-                log(f"Removing Directory '{diritem}' (if empty)")
-                cmd = cmd0 + [utils.pathjoin(self.destpath.curr, diritem)]
-                self.call(cmd, stream=True)
-            except subprocess.CalledProcessError:
+                self.call(cmd, display_error=False, phase="move")
+            except subprocess.CalledProcessError as err:
                 # This is likely due to the file not existing. It is acceptable
                 # for this error since even if it was something else, not
                 # properly removing empty dirs is acceptable
                 #
                 # Recent tests do not seem to trigger this with rmdirs. Just rmdir.
                 # Consider removing
-                log(f"Could not delete '{diritem}'. Must not be empty")
+                return diritem, err.stderr.strip()
+            except RunCancelled:
+                raise
+            except Exception as err:  # e.g. CallTimeout. Also acceptable
+                return diritem, str(err)
+
+        workers = max(1, min(self.config.max_concurrent_calls or 1, len(roots)))
+        log(f"Removing {len(roots)} directories (if empty) with {workers} call(s)")
+        # Failures are returned (it's best effort). Only a cancelled run stops it
+        pipe = utils.Pipeline(workers, name="rmdirs")
+        _rmdir = self.profiler.inherit(_rmdir)
+        for diritem in roots:
+            pipe.add(diritem, _rmdir, diritem)
+        results = pipe.run()
+        failed = [results[diritem] for diritem in roots if results[diritem]]
+
+        if failed:
+            log(f"Could not delete {len(failed)} of {len(roots)} directories:")
+            for diritem, err in failed[:MAX_CALL_LOG_LINES]:
+                log(f"  '{diritem}'")
+            if len(failed) > MAX_CALL_LOG_LINES:
+                log(f"  ...and {len(failed) - MAX_CALL_LOG_LINES} more. See debug log")
+            for diritem, err in failed:
+                debug(f"rmdirs {diritem!r}: {err}")
 
     def upload_curr(self, curr):
         """Upload 'curr.json.gz'"""
@@ -553,47 +824,45 @@ class Rclone:
             str(new_curr_list),
             utils.pathjoin(self.destpath.logs, "curr.json.gz"),
         ]
-        self.call(cmd)
+        self.call(cmd, phase="metadata")
         debug("Uploaded 'curr.json.gz'")
 
     def upload_diffs_backups(self, diffs, backup, prefix=True):
+        """
+        Compress and upload the diffs and the backups (if any) at the same time
+        """
         debug(f"Uploading Diffs {prefix = }")
         p = "INCOMPLETE_BACKUP_" if prefix else ""
-        # Diffs file
-        diffs_file = self.tmpdir / "diffs.json.gz"
-        with gz.open(diffs_file, "wt") as fobj:
-            json.dump(diffs, fobj, indent=1, ensure_ascii=False)
-        cmd = [
-            "copyto",
-            str(diffs_file),
-            utils.pathjoin(self.destpath.logs, f"{p}diffs.json.gz"),
-        ]
-        self.call(cmd)
 
-        # backups. May be an empty dict
-        if not backup:
-            return
+        def _upload(name, obj):
+            path = self.tmpdir / name
+            with gz.open(path, "wt") as fobj:
+                json.dump(obj, fobj, indent=1, ensure_ascii=False)
+            self.call(
+                ["copyto", str(path), utils.pathjoin(self.destpath.logs, f"{p}{name}")],
+                phase="metadata",
+            )
 
-        # We know these will be ordered since we are on later python
-        commented_backup = {
-            "__comments": [
-                f'Files in {repr(utils.pathjoin("back", self.config.now))}',
-                "This information may be incorrect if a prior run did not",
-                "complete. Manually examine files as needed",
-            ],
-            "__metadata": self.metadata,
-        }
-        commented_backup.update(backup)
+        pipe = utils.Pipeline(
+            self.config.max_concurrent_calls, name="diffs", profiler=self.profiler
+        )
+        pipe.add("diffs", _upload, "diffs.json.gz", diffs)
 
-        backup_list = self.tmpdir / "backed_up_files.json.gz"
-        with gz.open(backup_list, "wt") as fobj:
-            json.dump(commented_backup, fobj, indent=1, ensure_ascii=False)
-        cmd = [
-            "copyto",
-            str(backup_list),
-            utils.pathjoin(self.destpath.logs, f"{p}backed_up_files.json.gz"),
-        ]
-        self.call(cmd)
+        # backups. May be an empty dict
+        if backup:
+            # We know these will be ordered since we are on later python
+            commented_backup = {
+                "__comments": [
+                    f'Files in {repr(utils.pathjoin("back", self.config.now))}',
+                    "This information may be incorrect if a prior run did not",
+                    "complete. Manually examine files as needed",
+                ],
+                "__metadata": self.metadata,
+            }
+            commented_backup.update(backup)
+            pipe.add("backups", _upload, "backed_up_files.json.gz", commented_backup)
+
+        pipe.run()
 
     def remove_prefix_diffs_backups(self, *, backup):
         """Remove the 'INCOMPLETE_BACKUP_' prefix"""
@@ -604,7 +873,7 @@ class Rclone:
             utils.pathjoin(self.destpath.logs, f"{p}diffs.json.gz"),
             utils.pathjoin(self.destpath.logs, "diffs.json.gz"),
         ]
-        self.call(cmd)
+        self.call(cmd, phase="metadata")
 
         if not backup:
             return
@@ -614,7 +883,23 @@ class Rclone:
             utils.pathjoin(self.destpath.logs, f"{p}backed_up_files.json.gz"),
             utils.pathjoin(self.destpath.logs, "backed_up_files.json.gz"),
         ]
-        self.call(cmd)
+        self.call(cmd, phase="metadata")
+
+    def file_log(self, line):
+        """Append a raw JSON log line to the file log (FILE_LOG_NAME in the tmpdir)"""
+        with self._file_log_lock:
+            if self._file_log is None:
+                self._file_log = gz.open(self.tmpdir / FILE_LOG_NAME, "at")
+            self._file_log.write(line + "\n")
+
+    def close_file_log(self):
+        """Close the file log. Returns its path or None if nothing was written"""
+        with self._file_log_lock:
+            if self._file_log is None:
+                return
+            self._file_log.close()
+            self._file_log = None
+        return self.tmpdir / FILE_LOG_NAME
 
     def copylog(self, logfile, logdest):
         cmd = [
@@ -622,7 +907,7 @@ class Rclone:
             str(logfile),
             str(logdest),
         ]
-        self.call(cmd)
+        self.call(cmd, phase="metadata")
 
     def empty_dir_support(self, remote=None):
         """
@@ -634,10 +919,188 @@ class Rclone:
         config = self.config
         if not remote:
             remote = self.config.dst
-        features = json.loads(self.call(["backend", "features", remote], stream=False))
+        features = self.backend_features(remote)
 
         return features.get("Features", {}).get("CanHaveEmptyDirectories", True)
 
+    def modtime_update_support(self):
+        """
+        Return whether rclone can update just the ModTime of a file with the same
+        content on the destination. It needs a hash in common with the source to
+        verify the content and a destination that can set the ModTime. Otherwise it
+        does a regular transfer (with a backup).
+        """
+        try:
+            src_features = self.backend_features(self.config.src)
+            dst_features = self.backend_features(self.config.dst)
+        except (subprocess.CalledProcessError, ValueError):
+            debug("Could not get the backend features. Assuming no ModTime updates")
+            return False
+
+        src_hashes = src_features.get("Hashes") or []
+        dst_hashes = dst_features.get("Hashes") or []
+        precision = dst_features.get("Precision", MODTIME_NOT_SUPPORTED)
+        return bool(set(src_hashes) & set(dst_hashes)) and (
+            precision < MODTIME_NOT_SUPPORTED
+        )
+
+    def backend_features(self, remote):
+        """
+        Return the `rclone backend features` of remote. Cached for the run and in
+        `<rclone cache dir>/rirb/features/` for FEATURES_CACHE_TTL (or
+        ECONOMY_FEATURES_CACHE_TTL with economy)
+        """
+        # Steps that run at the same time (e.g. hash_type and features) may want the
+        # same remote. Only one calls rclone and writes the cache
+        with self._features_lock:
+            lock = self._features_locks.setdefault(remote, Lock())
+        with lock:
+            return self._backend_features(remote)
+
+    def _backend_features(self, remote):
+        try:
+            return self._features[remote]
+        except KeyError:
+            pass
+
+        cachefile = None
+        if cdir := self.local_cache_dir():
+            # The flags may include the config file so they are part of the key
+            key = json.dumps([remote, self.config.rclone_flags]).encode()
+            key = hashlib.sha1(key).hexdigest()[:16]
+            cachefile = Path(cdir) / "rirb" / "features" / f"{key}.json"
+            try:
+                cached = json.loads(cachefile.read_text())
+                ttl = FEATURES_CACHE_TTL
+                if self.config.economy:
+                    ttl = ECONOMY_FEATURES_CACHE_TTL
+                if time.time() - cached["time"] < ttl:
+                    debug(f"Using cached features of {remote!r} from {cachefile}")
+                    self._features[remote] = cached["features"]
+                    return cached["features"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+        features = json.loads(self.call(["backend", "features", remote], stream=False))
+        self._features[remote] = features
+
+        if cachefile:
+            cachefile.parent.mkdir(exist_ok=True, parents=True)
+            cached = {"remote": remote, "time": time.time(), "features": features}
+            cachefile.write_text(json.dumps(cached))
+        return features
+
+    def dst_features(self):
+        """Return the backend features of the destination or None if they fail"""
+        try:
+            return self.backend_features(self.config.dst)
+        except (subprocess.CalledProcessError, ValueError):
+            debug("Could not get the destination backend features")
+            return None
+
+    def plan(self, listing):
+        """
+        Set up the planner from the destination features and listing (the files
+        currently in curr)
+        """
+        self.planner = Planner(
+            self.dst_features(),
+            listing,
+            user_flags=self.config.rclone_flags,
+            list_cost=ECONOMY_LIST_COST if self.config.economy else 1,
+        )
+
+    def auto_hash_type(self):
+        """
+        Pick the cheapest hash type supported by both the source and destination.
+
+        Returns (hash_type, common). If there is no common hash, hash_type is the
+        cheapest of the source (or None if it has none) and common is False.
+
+        The decision is cached in `<rclone cache dir>/rirb/hash_type/<_uuid>.json` so
+        that the hash type is stable between runs (changing it means stored hashes
+        can't be compared).
+        """
+        config = self.config
+        key = {"src": config.src, "dst": config.dst}
+
+        cachefile = None
+        if cdir := self.local_cache_dir():
+            cachefile = Path(cdir) / "rirb" / "hash_type" / f"{config._uuid}.json"
+            try:
+                cached = json.loads(cachefile.read_text())
+                if all(cached.get(k) == v for k, v in key.items()):
+                    debug(f"Using cached hash_type decision from {cachefile}")
+                    return cached["hash_type"], cached["common"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+        src_features = self.backend_features(config.src)
+        dst_features = self.backend_features(config.dst)
+        src_hashes = src_features.get("Hashes") or []
+        dst_hashes = dst_features.get("Hashes") or []
+        debug(f"{src_hashes = }, {dst_hashes = }")
+
+        common = [h for h in src_hashes if h in dst_hashes]
+
+        # Local hashes are computed by rclone on this machine so the relative costs
+        # can be measured rather than assumed.
+        bench = None
+        if src_features.get("Name") == "local":
+            bench = utils.hash_benchmark(common or src_hashes)
+            debug(f"Hash benchmark (s/GiB): {bench}")
+
+        ranked = utils.rank_hashes(common or src_hashes, benchmark=bench)
+        hash_type = ranked[0] if ranked else None
+
+        log(
+            f"Automatic hash_type: {hash_type!r} "
+            f"({'common to src and dst' if common else 'NOT supported by dst'})"
+        )
+
+        if cachefile:
+            cachefile.parent.mkdir(exist_ok=True, parents=True)
+            key.update({"hash_type": hash_type, "common": bool(common)})
+            cachefile.write_text(json.dumps(key, indent=1))
+
+        return hash_type, bool(common)
+
+    ### Cancellation. For failing fast with concurrent calls
+    def cancel(self, reason):
+        """
+        Stop all running rclone calls and refuse to start new ones. They raise
+        RunCancelled
+        """
+        with self._procs_lock:
+            if self.cancelled:
+                return
+            self.cancelled = reason
+            procs = list(self._procs)
+
+        log(f"Cancelling: {reason}. Stopping {len(procs)} running rclone call(s)")
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(timeout=CANCEL_GRACE)
+            except subprocess.TimeoutExpired:
+                debug(f"Killing rclone (pid {proc.pid})")
+                proc.kill()
+
+    def clear_cancel(self):
+        """Allow calls again. Used to upload the logs of a failed run"""
+        self.cancelled = None
+
+    def sleep(self, dt):
+        """Sleep that ends early (with RunCancelled) if cancelled"""
+        t0 = time.time()
+        while time.time() - t0 < dt:
+            if self.cancelled:
+                raise RunCancelled(self.cancelled)
+            time.sleep(min(0.1, dt))
+        if self.cancelled:
+            raise RunCancelled(self.cancelled)
+
     ### Interruption Checks. These are here since we use the rclone cache dir
     def init_check_interupt(self):
         """create the file and return whether or not it already exists"""
@@ -655,15 +1118,133 @@ class Rclone:
         statfile.unlink(missing_ok=True)
         debug(f"unlinking interupt test file: {statfile}")
 
+        self.journal_path().unlink(missing_ok=True)
+        debug(f"unlinking journal: {self.journal_path()}")
+
     ### /Interruption Checks
 
-    def call(self, cmd, stream=False, logstderr=True, display_error=True):
+    ### Journal. Records the completed work so an interrupted run can be resumed.
+    # It is a JSON-lines file with the following events:
+    #
+    #   start : Start of the run with its settings
+    #   begin : Start of a stage (or transfer batch) that modifies the remote
+    #   batch : Completed transfer batch with the transfered file data
+    #   done  : Completed stage with what was done (renames and deletes)
+    #
+    # It is kept locally and, after every completed batch, uploaded to
+    # logs/<now>/journal.jsonl.
+    def journal_path(self):
+        return self.local_cache_dir() / f"rirb/journal/{self.config._uuid}.jsonl"
+
+    def journal_start(self, carry=()):
+        """Start a new journal, carrying over the entries of a resumed one"""
+        path = self.journal_path()
+        path.parent.mkdir(exist_ok=True, parents=True)
+        path.unlink(missing_ok=True)
+        debug(f"Starting journal: {path}")
+
+        self.journal(
+            "start",
+            now=self.config.now,
+            src=self.config.src,
+            dst=self.config.dst,
+            dst_list=bool(self.config.cliconfig.dst_list),
+        )
+        for entry in carry:
+            self.journal(**entry)
+
+    def journal(self, event, upload=False, **entry):
+        """Add an entry to the journal. Optionally upload the journal"""
+        entry = {"event": event, **entry}
+        path = self.journal_path()
+        with self._journal_lock:
+            with open(path, mode="at") as fobj:
+                fobj.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                fobj.flush()
+                os.fsync(fobj.fileno())
+
+            if upload:
+                cmd = [
+                    "copyto",
+                    str(path),
+                    utils.pathjoin(self.destpath.logs, "journal.jsonl"),
+                ]
+                self.call(cmd, phase="metadata")
+
+    def read_journal(self):
+        """
+        Read the journal of the previous run. Uses the local copy, otherwise
+        tries the most recent logs directory. Returns None if there isn't one
+        """
+        path = self.journal_path()
+        if not path.exists():
+            debug(f"No local journal at {path}. Pulling")
+            path = self.tmpdir / "prev_journal.jsonl"
+            try:
+                rdir = self.latest_log_dir()
+                rjournal = utils.pathjoin(self.destpath.log_base, rdir, "journal.jsonl")
+                cmd = ["copyto", rjournal, str(path), "--retries", "1"]
+                self.call(
+                    cmd, display_error=False, logstderr=False, phase="metadata"
+                )
+            except (subprocess.CalledProcessError, IndexError):
+                debug("No remote journal")
+                return
+
+        entries = []
+        with open(path, "rt") as fobj:
+            for line in fobj:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:  # Likely cut off by the interruption
+                    debug(f"Skipped journal line {line!r}")
+        return entries
+
+    ### /Journal
+
+    def call(
+        self,
+        cmd,
+        stream=False,
+        logstderr=True,
+        display_error=True,
+        json_log=False,
+        flags=None,
+        phase="other",
+        on_line=None,
+    ):
         """
         Call rclone. If streaming, will write stdout & stderr to
         log. If logstderr, will always send stderr to log (default)
+
+        If json_log (must also stream), rclone uses its JSON log which is parsed
+        back into regular log lines. Returns a Bunch with the output (out), the last
+        log event per file (outcomes) and the last stats (stats). If the call
+        fails, the CalledProcessError will have it as the `result` attribute. With
+        rclone_log = "summary", the per-file lines go to the file log (see
+        file_log()) and only their counts by message are logged.
+
+        Streamed output only keeps the last MAX_STREAM_OUT_LINES lines.
+
+        flags are added after rclone_flags so that they take precedence.
+
+        If on_line (must also stream), each line is passed to on_line() instead.
+        It returns the text to log (if any) and the lines are not in the output.
+
+        The call is stopped if it runs longer than the `call_timeouts` of its phase
+        or, with json_log, goes the `stall_timeouts` of its phase without progress.
+        Either raises CallTimeout.
         """
         config = self.config
+        timeout = (config.call_timeouts or {}).get(phase)
+        stall = (config.stall_timeouts or {}).get(phase) if json_log else None
+        if json_log:
+            cmd = cmd + ["--use-json-log"]
+            result = utils.Bunch(outcomes={}, stats={})
+        if stall:  # Need the stats often enough to see the progress
+            cmd = cmd + ["--stats", f"{max(1, int(stall / 4))}s"]
         cmd = [self.config.rclone_exe] + cmd + self.config.rclone_flags + self.add_args
+        cmd += flags or []
         debug("rclone:call", cmd)
 
         env = os.environ.copy()
@@ -684,23 +1265,62 @@ class Rclone:
             stderr = open(f"{config.tmpdir}/std.{tns}.err", mode="wb")
 
         t0 = time.time()
-        proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, env=env)
+        with self._procs_lock:
+            if self.cancelled:
+                raise RunCancelled(self.cancelled)
+            proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, env=env)
+            self._procs.add(proc)
+
+        watchdog = None
+        if timeout or stall:
+            watchdog = Watchdog(proc, timeout=timeout, stall=stall, name=cmd[1])
 
         if stream:
-            out = []
+            out = deque(maxlen=MAX_STREAM_OUT_LINES)
+            counts = Counter() if json_log and config.rclone_log == "summary" else None
             with proc.stdout:
                 for line in iter(proc.stdout.readline, b""):
                     line = line.decode(
                         errors="backslashreplace"
                     )  # Allow for bad encoding
                     line = line.rstrip()
+                    if on_line:
+                        if (line := on_line(line)) is not None:
+                            log(line, __prefix="rclone")
+                        continue
+                    if json_log:
+                        raw, line = line, parse_json_log(line, result, counts=counts)
+                        if watchdog:
+                            watchdog.progress(progress_state(result))
+                        if line is None:  # per-file line. Only counted
+                            self.file_log(raw)
+                            continue
                     log(line, __prefix="rclone")
                     out.append(line)
+            for msg, count in (counts or Counter()).most_common():
+                log(f"{count} file(s): {msg}", __prefix="rclone")
             out = "\n".join(out)
             err = ""  # Piped to stderr
 
         proc.wait()
-        self.rclonetime += time.time() - t0
+        dt = time.time() - t0
+        self.rclonetime += dt
+        self.profiler.trace(
+            f"rclone {cmd[1]}",
+            t0,
+            dt,
+            cat="rclone",
+            args={
+                "cmd": shlex.join(cmd)[:TRACE_CMD_LENGTH],
+                "pid": proc.pid,
+                "returncode": proc.returncode,
+                "phase": phase,
+            },
+        )
+        with self._procs_lock:
+            self._procs.discard(proc)
+        if watchdog:
+            watchdog.stop()
 
         if not stream:
             stdout.close()
@@ -712,6 +1332,17 @@ class Rclone:
             if err and logstderr:
                 log(err, __prefix="rclone.stderr")
 
+        stats = result.stats if json_log else None
+        api = perf.api_calls(cmd[1:], dst=config.dst, stats=stats, nout=out.count("\n"))
+        self.profiler.record_call(dt, stats, api=api)
+
+        if proc.returncode and self.cancelled:
+            raise RunCancelled(self.cancelled)
+        if proc.returncode and watchdog and watchdog.reason:
+            if json_log:
+                result.out = out
+            raise CallTimeout(watchdog.reason, result=result if json_log else None)
+
         if proc.returncode:
             if display_error:
                 log("RCLONE ERROR", __prefix="rclone")
@@ -734,9 +1365,190 @@ class Rclone:
                         )
                     else:
                         log(err.strip(), __prefix="rclone.stderr")
-            raise subprocess.CalledProcessError(
+            error = subprocess.CalledProcessError(
                 proc.returncode, cmd, output=out, stderr=err
             )
+            if json_log:
+                result.out = out
+                error.result = result
+            raise error
         if not logstderr:
             out = out + "\n" + err
+        if json_log:
+            result.out = out
+            return result
         return out
+
+    def call_files(self, cmd, files=None, *, name, flags=None, phase="other"):
+        """
+        Call rclone with JSON logging. If files are given, they are passed with
+        `--files-from` and, if some fail (or the call fails with no record of
+        them), only those are retried. Without files, the whole call is retried.
+        Retries are up to `file_retries` times with a doubling backoff starting at
+        `file_retry_backoff` seconds. A call stopped
+        by the watchdog (see call()) is retried for the files it did not finish.
+
+        Returns a Bunch of the outcomes ({file: outcome}) and the rclone stats of the
+        first attempt. If files still fail after the retries, the last
+        CalledProcessError is raised with the outcomes as the `outcomes` attribute.
+        """
+        retries = self.config.file_retries or 0
+        files = list(files) if files is not None else None
+
+        outcomes = {}
+        stats = None
+        for attempt in range(retries + 1):
+            fcmd = cmd
+            if files is not None:
+                flistpath = self.tmpdir / f"{name}.{attempt}.txt"
+                flistpath.write_text("\n".join(files))
+                fcmd = cmd + ["--files-from", str(flistpath)]
+
+            try:
+                res = self.call(
+                    fcmd, stream=True, json_log=True, flags=flags, phase=phase
+                )
+                failed = {}
+                error = None
+            except CallTimeout as err:
+                error = err
+                res = err.result
+                failed = {}
+                for file in files if files is not None else [name]:
+                    if res.outcomes.get(file, ("", ""))[0] != "info":  # not done
+                        failed[file] = f"failed: {err.reason}"
+            except subprocess.CalledProcessError as err:
+                error = err
+                res = getattr(err, "result", utils.Bunch(outcomes={}, stats={}))
+                if files is None:
+                    failed = {name: f"failed: returncode {err.returncode}"}
+                else:
+                    failed = {}
+                    for file in files:
+                        level, msg = res.outcomes.get(file, ("", ""))
+                        if level in {"error", "critical"}:
+                            failed[file] = f"failed: {msg}"
+                        elif file not in res.outcomes:
+                            # The call failed and there is no record of it. Do not
+                            # assume it was done
+                            failed[file] = "failed: unknown (no record)"
+                    if not failed:  # Not something that can be fixed by a retry
+                        raise
+
+            if stats is None:
+                stats = res.stats
+
+            for file in files if files is not None else [name]:
+                if file in failed:
+                    outcomes[file] = failed[file]
+                elif attempt:
+                    outcomes[file] = f"ok (retry {attempt})"
+                else:
+                    outcomes[file] = "ok"
+
+            if not failed:
+                break
+
+            if attempt == retries:
+                log(f"{len(failed)} file(s) failed after {retries} retries:")
+                for file, outcome in sorted(failed.items()):
+                    log(f"  {file!r}: {outcome}")
+                error.outcomes = outcomes
+                raise error
+
+            dt = (self.config.file_retry_backoff or 0) * 2**attempt
+            log(
+                f"{len(failed)} file(s) failed. Retrying them in {dt:0.1f} s "
+                f"({attempt + 1}/{retries})"
+            )
+            self.sleep(dt)
+            if files is not None:
+                files = list(failed)
+
+        retried = {f: o for f, o in outcomes.items() if o != "ok"}
+        if retried:
+            log("Final outcome of retried file(s):")
+            for file, outcome in sorted(retried.items()):
+                log(f"  {file!r}: {outcome}")
+        return utils.Bunch(outcomes=outcomes, stats=stats)
+
+
+class Watchdog:
+    """
+    Watch a running rclone call and stop it if it takes longer than timeout seconds
+    or if it goes stall seconds without progress (see progress()). Either may be
+    None. The reason it was stopped (if it was) is in `reason`
+    """
+
+    def __init__(self, proc, *, timeout=None, stall=None, name=""):
+        self.proc = proc
+        self.timeout = timeout
+        self.stall = stall
+        self.name = name
+        self.reason = None
+
+        self.t0 = self.tlast = time.time()
+        self.state = None
+        self._done = Event()
+        Thread(target=self._watch, daemon=True).start()
+
+    def progress(self, state):
+        """Reset the stall clock if state (anything comparable) has changed"""
+        if state != self.state:
+            self.state = state
+            self.tlast = time.time()
+
+    def stop(self):
+        self._done.set()
+
+    def _watch(self):
+        while not self._done.wait(WATCHDOG_INTERVAL):
+            now = time.time()
+            if self.timeout and now - self.t0 > self.timeout:
+                reason = f"timed out after {utils.time_format(self.timeout)}"
+            elif self.stall and now - self.tlast > self.stall:
+                reason = f"stalled (no progress for {utils.time_format(self.stall)})"
+            else:
+                continue
+
+            self.reason = reason
+            log(f"Watchdog: rclone {self.name!r} {reason}. Stopping it")
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=CANCEL_GRACE)
+            except subprocess.TimeoutExpired:
+                log(f"Watchdog: Killing rclone {self.name!r} (pid {self.proc.pid})")
+                self.proc.kill()
+            return
+
+
+def progress_state(result):
+    """What is compared by the Watchdog for progress of a JSON log call"""
+    return len(result.outcomes), tuple(result.stats.get(k) for k in PROGRESS_STATS)
+
+
+def parse_json_log(line, result, counts=None):
+    """
+    Parse a line of rclone's JSON log into result (from Rclone.call) and return the
+    text to log. Lines that are not JSON are returned as is.
+
+    If counts is a Counter, per-file lines that are not errors or warnings are only
+    counted by their message and None is returned.
+    """
+    try:
+        entry = json.loads(line)
+        level = entry["level"]
+    except (ValueError, TypeError, KeyError):
+        return line
+
+    msg = entry.get("msg", "").strip()
+    if "stats" in entry:
+        result.stats = entry["stats"]
+
+    if obj := entry.get("object"):
+        result.outcomes[obj] = (level, msg)
+        if counts is not None and level in {"info", "debug"}:
+            counts[msg] += 1
+            return None
+        return f"{level.upper():<6}: {obj}: {msg}"
+    return f"{level.upper():<6}: {msg}"
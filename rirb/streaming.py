@@ -0,0 +1,162 @@
+"""
+Transfer new files while the source is still being listed
+"""
+import time
+from queue import Queue, Empty
+from threading import Lock
+
+from . import log, debug
+from . import utils
+
+MAX_WAIT = 60  # seconds a listed file waits for its batch to fill before it is sent
+
+
+class NewFileStream:
+    """
+    Queue new files for transfer as soon as they are listed.
+
+    Only files that can't be in the previous list and can't be part of a rename are
+    eligible. That is, not in prev and, if tracking renames, no previous file has the
+    same size (since size must always match for a rename). Everything else is left
+    for the regular transfer after the comparison.
+
+    Files are batched as with transfer_batch_size and transfer_batch_bytes (or when
+    the batch has waited MAX_WAIT seconds) and sent one batch at a time by a worker
+    thread. The same guarantees for an interrupted backup are kept:
+
+      - on_begin() is called before the first batch. It sets the interrupt marker
+        and starts the journal.
+      - Before each batch, the diffs (with all of the streamed files so far as
+        "new") are uploaded so they are always ahead of the data. The full diffs
+        replace them later.
+      - Each batch is recorded in the journal like any other transfer batch.
+
+    rclone : Rclone object
+    prev : The previous file list
+    on_begin : Called (once) before anything is changed on the remote
+    """
+
+    def __init__(self, rclone, prev, *, on_begin):
+        self.rclone = rclone
+        self.config = config = rclone.config
+        self.on_begin = on_begin
+
+        self.prev = prev
+        self.prev_sizes = None
+        if config.renames:
+            self.prev_sizes = {file.get("Size", -1) for file in prev.values()}
+
+        self.maxnum = config.transfer_batch_size or float("inf")
+        self.maxbytes = config.transfer_batch_bytes or float("inf")
+
+        self.files = {}  # All eligible files
+        self.streamed = []  # Sent (or being sent) to the destination
+        self.pending, self.pending_bytes, self.t0 = [], 0, None
+        self.lock = Lock()
+        self.queue = Queue()
+        self.closed = False
+        self.nbatches = 0
+
+        self.worker = utils.ReturnThread(
+            target=self._work, name="stream", daemon=True
+        ).start()
+
+    def eligible(self, path, file):
+        if path in self.prev:
+            return False
+        if self.prev_sizes is not None and file.get("Size", -1) in self.prev_sizes:
+            return False  # May be a rename
+        return True
+
+    def add(self, path, file):
+        """Add a listed file. Ignored if it isn't eligible"""
+        if not self.eligible(path, file):
+            return
+
+        with self.lock:
+            if self.closed or not self.worker.is_alive():
+                return
+            self.files[path] = file
+            self.pending.append(path)
+            self.pending_bytes += file.get("Size", 0)
+            self.t0 = self.t0 or time.time()
+
+            if (
+                len(self.pending) >= self.maxnum
+                or self.pending_bytes >= self.maxbytes
+                or time.time() - self.t0 >= MAX_WAIT
+            ):
+                self._flush()
+
+    def close(self):
+        """No more files. Sends what is left"""
+        with self.lock:
+            if self.closed:
+                return
+            self._flush()
+            self.closed = True
+            self.queue.put(None)
+
+    def finish(self):
+        """Close and wait for all of the batches. Returns the streamed paths"""
+        self.close()
+        self.worker.join()
+        if self.streamed:
+            log(
+                f"Streamed {len(self.streamed)} new files in {self.nbatches} "
+                "batch(es) while listing"
+            )
+        return list(self.streamed)
+
+    def _flush(self):
+        # Must hold the lock
+        if self.pending:
+            self.queue.put(self.pending)
+        self.pending, self.pending_bytes, self.t0 = [], 0, None
+
+    def _work(self):
+        try:
+            with self.rclone.profiler.phase("stream"):
+                self._work_batches()
+        except Exception as err:
+            # Fail fast. The listing is stopped and finish() raises this error
+            self.rclone.cancel(f"streamed transfer failed ({err!r})")
+            raise
+
+    def _next_batch(self):
+        """
+        Return the next batch (None once closed). A partial batch is sent once it
+        has waited MAX_WAIT even if the listing stalls and no more files are added
+        """
+        while True:
+            with self.lock:
+                if self.t0 and time.time() - self.t0 >= MAX_WAIT:
+                    self._flush()
+                wait = MAX_WAIT - (time.time() - self.t0) if self.t0 else MAX_WAIT
+            try:
+                return self.queue.get(timeout=max(wait, 0.01))
+            except Empty:
+                pass
+
+    def _work_batches(self):
+        while (batch := self._next_batch()) is not None:
+            self.on_begin()
+            self.nbatches += 1
+            self.streamed.extend(batch)
+            log(f"Streaming batch {self.nbatches}: {len(batch)} new files")
+
+            # The diffs are always ahead of the data
+            self.rclone.upload_diffs_backups(
+                {"new": sorted(self.streamed)},
+                {},
+                prefix=self.config.prefix_incomplete_backups,
+            )
+
+            cmd = self.rclone.transfer_cmd() + ["--size-only"]
+            cmd += self.rclone.planner.traversal(
+                batch, name=f"stream batch {self.nbatches}"
+            )
+            self.rclone._transfer_batch(
+                cmd, batch, self.files, name=f"stream_{self.nbatches}"
+            )
+        debug(f"Stream worker done after {self.nbatches} batch(es)")
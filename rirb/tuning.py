@@ -0,0 +1,108 @@
+"""
+Adaptive tuning of rclone's transfer concurrency from its stats
+"""
+import json
+import hashlib
+from pathlib import Path
+
+from . import log, debug
+
+# Batches smaller than this are too noisy to learn from
+MIN_BATCH_BYTES = 1024**2
+MIN_BATCH_TIME = 5.0  # seconds
+
+IMPROVEMENT = 1.05  # Must be at least 5% better to keep going
+
+
+class TransferTuner:
+    """
+    Hill-climb the number of `--transfers` (with `--checkers` at twice that) between
+    batches.
+
+    The number is doubled (or halved) as long as the throughput keeps improving.
+    When it doesn't, it goes back to the best so far and tries the other direction.
+    After that also fails, it stays at the best. Any errors (including retries)
+    immediately halve it since that is usually the remote throttling.
+
+    lo,hi : Range of --transfers
+    start : Starting point. Usually the best of the previous run
+    """
+
+    def __init__(self, lo, hi, start=None, name=""):
+        self.lo, self.hi = lo, hi
+        self.name = name
+        self.n = self._clamp(start if start else 4)  # 4 is rclone's default
+        self.direction = 1
+        self.reversals = 0
+        self.best = (self.n, 0.0)  # transfers, throughput
+        self.last = None
+
+    def flags(self):
+        return ["--transfers", str(self.n), "--checkers", str(2 * self.n)]
+
+    def update(self, stats, dt):
+        """Update from the stats of a batch (from rclone's JSON log) that took dt sec"""
+        nbytes = stats.get("bytes", 0)
+        errors = stats.get("errors", 0) + int(bool(stats.get("retryError", False)))
+
+        if errors:
+            log(f"Adaptive{self.name}: {errors} error(s) at --transfers {self.n}")
+            self.reversals = 2  # Do not climb back into the throttling
+            self.best = (self._clamp(self.n // 2), 0.0)
+            self._set(self.n // 2)
+            return
+
+        if nbytes < MIN_BATCH_BYTES or dt < MIN_BATCH_TIME:
+            debug(f"Adaptive{self.name}: batch too small to measure. {nbytes = }")
+            return
+
+        rate = nbytes / dt
+        debug(f"Adaptive{self.name}: --transfers {self.n} at {rate:0.0f} B/s")
+        if rate > self.best[1]:
+            self.best = (self.n, rate)
+
+        if self.last is not None and rate < self.last * IMPROVEMENT:
+            # Go back to the best and try the other direction
+            self.reversals += 1
+            self.direction *= -1
+            self.last = self.best[1]
+            base = self.best[0]
+        else:
+            self.last = rate
+            base = self.n
+
+        if self.reversals >= 2:  # Tried both ways. Stay at the best
+            self._set(self.best[0])
+            return
+
+        self._set(base * 2 if self.direction > 0 else base // 2)
+
+    def _set(self, n):
+        n = self._clamp(n)
+        if n != self.n:
+            log(f"Adaptive{self.name}: --transfers {self.n} --> {n}")
+        self.n = n
+
+    def _clamp(self, n):
+        return min(max(n, self.lo), self.hi)
+
+
+def tuning_path(cachedir, dst):
+    """Path of the remembered tuning for dst"""
+    key = hashlib.sha1(dst.encode()).hexdigest()[:16]
+    return Path(cachedir) / "rirb" / "tuning" / f"{key}.json"
+
+
+def load_tuning(path):
+    """Return the remembered {class: transfers} or {}"""
+    try:
+        return json.loads(Path(path).read_text())["transfers"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def save_tuning(path, dst, transfers):
+    path = Path(path)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    path.write_text(json.dumps({"dst": dst, "transfers": transfers}, indent=1))
+    debug(f"Saved tuning {transfers} to {path}")
@@ -1,7 +1,14 @@
 import datetime
 import os
+import hashlib
+import zlib
+import shutil
+import gzip as gz
+import bz2
+import lzma
 from threading import Thread
 from queue import Queue
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import time
 
 from . import log, debug, LOCK
@@ -75,6 +82,87 @@ def pathjoin(*args):
     return path
 
 
+def root_dirs(dirs):
+    """
+    Return the dirs that are not inside any of the others.
+
+    Sorting by the path parts (rather than the string where "a-b" would come between
+    "a" and "a/b") puts every subdirectory right after its root so it is a single
+    pass.
+    """
+    roots = []
+    last = None
+    for parts in sorted(tuple(d.split("/")) for d in dirs):
+        if last is not None and parts[: len(last)] == last:
+            continue
+        roots.append("/".join(parts))
+        last = parts
+    return roots
+
+
+# Rough relative cost of computing rclone's hashes (lower is cheaper). Used when they
+# can't be measured. Unknown hashes get DEFAULT_HASH_COST
+HASH_COSTS = {
+    "crc32": 1,
+    "xxh3": 1,
+    "xxh128": 1,
+    "quickxor": 2,
+    "blake3": 2,
+    "sha1": 4,
+    "hidrive": 4,  # sha1 based
+    "mailru": 4,  # sha1 based
+    "md5": 5,
+    "sha512": 6,
+    "sha256": 8,
+    "dropbox": 8,  # sha256 based
+    "whirlpool": 20,
+}
+DEFAULT_HASH_COST = 10
+
+
+def hash_benchmark(names, size=8 * 1024**2, repeat=3):
+    """
+    Time the hashes in names that have a Python implementation (plus md5 as the
+    reference). Returns {name: seconds per GiB}.
+
+    Python uses the OpenSSL and zlib implementations which are a reasonable proxy
+    for the (also accelerated) ones in rclone.
+    """
+    funcs = {
+        "crc32": zlib.crc32,
+        "md5": lambda b: hashlib.md5(b).digest(),
+        "sha1": lambda b: hashlib.sha1(b).digest(),
+        "sha256": lambda b: hashlib.sha256(b).digest(),
+        "sha512": lambda b: hashlib.sha512(b).digest(),
+    }
+    buf = os.urandom(size)
+    res = {}
+    for name in set(names).union({"md5"}):
+        if name not in funcs:
+            continue
+        best = float("inf")
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            funcs[name](buf)
+            best = min(best, time.perf_counter() - t0)
+        res[name] = best * 1024**3 / size
+    return res
+
+
+def rank_hashes(names, benchmark=None):
+    """
+    Return names sorted from cheapest to most expensive. If a benchmark (from
+    hash_benchmark) is given, the measured hashes are scaled relative to md5
+    """
+    costs = HASH_COSTS.copy()
+    if benchmark and benchmark.get("md5"):
+        ref = benchmark["md5"]
+        for name, dt in benchmark.items():
+            costs[name] = HASH_COSTS["md5"] * dt / ref
+
+    return sorted(names, key=lambda name: (costs.get(name, DEFAULT_HASH_COST), name))
+
+
 def bytes2human(byte_count, base=1024, short=True):
     """
     Return a value,label tuple
@@ -157,7 +245,8 @@ class Bunch(dict):
 class ReturnThread(Thread):
     """
     Like a regular thread except when you `join`, it returns the function
-    result. And .start() will return itself to enable cleaner code.
+    result (or raises its exception). And .start() will return itself to enable
+    cleaner code.
 
         >>> mythread = ReturnThread(...).start() # instantiate and start
 
@@ -168,19 +257,131 @@ class ReturnThread(Thread):
         self.target = target
         super().__init__(target=self._target, **kwargs)
         self._res = None
+        self._exc = None
 
     def start(self, *args, **kwargs):
         super().start(*args, **kwargs)
         return self
 
     def _target(self, *args, **kwargs):
-        self._res = self.target(*args, **kwargs)
+        try:
+            self._res = self.target(*args, **kwargs)
+        except BaseException as exc:
+            self._exc = exc
 
     def join(self, *args, **kwargs):
         super().join(*args, **kwargs)
+        if self._exc is not None:
+            raise self._exc
         return self._res
 
 
+class Pipeline:
+    """
+    Run steps that depend on each other. Each step starts as soon as the steps it
+    runs `after` are done so independent steps run at the same time (up to
+    max_workers). With max_workers=1, they run in the order added.
+
+    If a step fails, no new steps are started, on_error(reason) is called (e.g. to
+    cancel the running rclone calls), and the first error is raised once the running
+    ones finish. With keep_going, the steps that are not after a failed one are
+    still run and the first error is raised once they are all done.
+
+    If a profiler (perf.Profiler) is given, each step is a phase inside the phase
+    that runs the pipeline.
+
+        >>> pipe = Pipeline(max_workers=4)
+        >>> pipe.add("a", func_a, arg)
+        >>> pipe.add("b", func_b, after=["a"], kw=val)
+        >>> results = pipe.run() # {name: return value}
+    """
+
+    def __init__(
+        self,
+        max_workers=4,
+        name="pipeline",
+        on_error=None,
+        profiler=None,
+        keep_going=False,
+    ):
+        self.max_workers = max(1, max_workers or 1)
+        self.name = name
+        self.on_error = on_error
+        self.profiler = profiler
+        self.keep_going = keep_going
+        self.steps = {}
+
+    def add(self, name, func, *args, after=(), **kwargs):
+        if name in self.steps:
+            raise ValueError(f"Duplicate step {name!r}")
+        missing = set(after) - set(self.steps)
+        if missing:  # Also prevents cycles
+            raise ValueError(f"Step {name!r} is after unknown steps {missing}")
+        self.steps[name] = (func, args, kwargs, set(after))
+        return self
+
+    def run(self):
+        pending = dict(self.steps)
+        running = {}  # future: name
+        done = {}
+        failed = set()
+        error = None
+        parent = self.profiler.current() if self.profiler else None
+
+        with ThreadPoolExecutor(self.max_workers, thread_name_prefix=self.name) as pool:
+            while pending or running:
+                for name, (func, args, kwargs, after) in list(pending.items()):
+                    if error and not self.keep_going:
+                        break
+                    if len(running) >= self.max_workers:
+                        break
+                    if after & failed:
+                        log(f"{self.name}: skipping {name!r} after failed steps")
+                        failed.add(name)
+                        del pending[name]
+                        continue
+                    if after.issubset(done):
+                        debug(f"{self.name}: start {name!r}")
+                        if self.profiler:
+                            func = self.profiler.wrap(name, func, parent=parent)
+                        running[pool.submit(func, *args, **kwargs)] = name
+                        del pending[name]
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        done[name] = future.result()
+                        debug(f"{self.name}: done {name!r}")
+                    except Exception as exc:
+                        log(f"{self.name}: {name!r} failed: {exc!r}")
+                        failed.add(name)
+                        if error is None and self.on_error:
+                            self.on_error(f"{self.name} step {name!r} failed")
+                        error = error or exc
+
+        if error:
+            raise error
+        return done
+
+
+COMPRESSORS = {  # codec: (open, suffix)
+    "gzip": (lambda path, mode: gz.open(path, mode, compresslevel=6), ".gz"),
+    "bz2": (bz2.open, ".bz2"),
+    "xz": (lzma.open, ".xz"),
+}
+
+
+def compress_file(src, dst, codec):
+    """Compress src to dst with codec (a key of COMPRESSORS)"""
+    opener, _ = COMPRESSORS[codec]
+    with open(src, "rb") as fin, opener(dst, "wb") as fout:
+        shutil.copyfileobj(fin, fout, 1024**2)
+
+
 def locked_pause(dt=1e-6):
     """
     Lock threads for a very short amount of time. Useful to make sure time_ns()
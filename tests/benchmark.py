@@ -0,0 +1,302 @@
+"""
+Micro-benchmarks of the pure-Python hot paths on synthetic file lists (see
+synthetic.py). No rclone needed.
+
+    $ python benchmark.py --files 1000000 --output bench.json
+    $ python benchmark.py --files 1000000 --baseline bench.json --max-slowdown 1.2
+
+Each benchmark is timed `--repeat` times (setup is not timed) and the best is kept.
+With --baseline, any benchmark whose best time per item is more than --max-slowdown
+times that of the baseline is a regression and the exit code is 1.
+"""
+import os, sys
+import argparse
+import contextlib
+import copy
+import gzip as gz
+import json
+import platform
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import synthetic
+
+p = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if p not in sys.path:
+    sys.path.insert(0, p)
+
+import rirb
+import rirb.main
+import rirb.perf
+import rirb.rclone
+from rirb import utils
+from rirb.planner import group_renames
+
+BENCHMARKS = {}  # name: function(data) -> (setup, run, nitems)
+
+
+def benchmark(func):
+    """Register a bench_<name> function"""
+    BENCHMARKS[func.__name__[len("bench_") :]] = func  # Not removeprefix() for 3.8
+    return func
+
+
+def make_rirb(data, **config):
+    """A RIRB with just what compare(), renames(), summary(), etc. need"""
+    defaults = utils.Bunch(
+        compare="mtime",
+        dst_compare=None,
+        renames="hash",
+        metadata_only_updates=False,
+        dir_moves=False,
+        dt=1.1,
+        cliconfig=utils.Bunch(dst_list=False, dry_run=False),
+    )
+    obj = rirb.main.RIRB(utils.Bunch(defaults, **config))
+    obj.t0 = time.time()
+    obj.rclone = utils.Bunch(profiler=rirb.perf.Profiler())
+    obj.prev = obj.loc_prev = data.prev
+    obj.curr = data.curr
+    return obj
+
+
+def compared(data):
+    """RIRB after compare() and renames()"""
+    obj = make_rirb(data)
+    obj.compare()
+    obj.renames()
+    return obj
+
+
+@benchmark
+def bench_file_list2dict(data):
+    entries = synthetic.lsjson(data.curr)
+    return (
+        lambda: copy.deepcopy(entries),  # It pops from the entries
+        lambda entries: rirb.rclone.Rclone.file_list2dict(None, entries),
+        len(entries),
+    )
+
+
+@benchmark
+def bench_compare(data):
+    return lambda: make_rirb(data), lambda obj: obj.compare(), len(data.curr)
+
+
+@benchmark
+def bench_compare_hash(data):
+    def setup():
+        return make_rirb(data, compare="hash")
+
+    return setup, lambda obj: obj.compare(), len(data.curr)
+
+
+@benchmark
+def bench_renames(data):
+    def setup():
+        obj = make_rirb(data)
+        obj.compare()
+        return obj
+
+    return setup, lambda obj: obj.renames(), len(data.curr)
+
+
+@benchmark
+def bench_build_backup_file_lists(data):
+    obj = compared(data)
+    return lambda: obj, lambda obj: obj.build_backup_file_lists(), len(data.curr)
+
+
+@benchmark
+def bench_summary(data):
+    obj = compared(data)
+    return lambda: obj, lambda obj: obj.summary(), len(data.curr)
+
+
+@benchmark
+def bench_group_renames(data):
+    renamed = compared(data).renamed
+    return lambda: renamed, group_renames, len(renamed)
+
+
+@benchmark
+def bench_root_dirs(data):
+    # Worst case: every directory is removed (e.g. a mass delete)
+    dirs = {os.path.dirname(path) for path in data.prev}
+    return lambda: dirs, utils.root_dirs, len(dirs)
+
+
+@benchmark
+def bench_RFC3339_to_unix(data):
+    times = [file["ModTime"] for file in data.curr.values()]
+
+    def run(times):
+        for t in times:
+            utils.RFC3339_to_unix(t)
+
+    return lambda: times, run, len(times)
+
+
+@benchmark
+def bench_curr_dump(data):
+    # As Rclone.upload_curr
+    path = Path(data.tmpdir) / "curr.json.gz"
+
+    def run(curr):
+        with gz.open(path, "wt") as fobj:
+            json.dump(curr, fobj, indent=1, ensure_ascii=False)
+
+    return lambda: data.curr, run, len(data.curr)
+
+
+@benchmark
+def bench_curr_load(data):
+    # As Rclone.pull_prev_list
+    path = Path(data.tmpdir) / "prev.json.gz"
+    with gz.open(path, "wt") as fobj:
+        json.dump(data.prev, fobj, indent=1, ensure_ascii=False)
+
+    def run(path):
+        with gz.open(path) as fobj:
+            return json.load(fobj)
+
+    return lambda: path, run, len(data.prev)
+
+
+def log_lines(data):
+    """A streamed rclone line for every file"""
+    return [f"INFO  : {path}: Copied (new)" for path in data.curr]
+
+
+def write_log(lines):
+    with open(os.devnull, "wt") as null, contextlib.redirect_stdout(null):
+        for line in lines:
+            rirb.log(line, __prefix="rclone")
+        rirb.log.flush()
+
+
+@benchmark
+def bench_log_write(data):
+    # The background writer. One open of the log per batch of lines
+    lines = log_lines(data)
+    return lambda: lines, write_log, len(lines)
+
+
+@benchmark
+def bench_log_write_sync(data):
+    # Without the writer, every line opens the log (as before the writer)
+    lines = log_lines(data)
+
+    def run(lines):
+        writer, rirb.log.writer = rirb.log.writer, None
+        try:
+            write_log(lines)
+        finally:
+            rirb.log.writer = writer
+
+    return lambda: lines, run, len(lines)
+
+
+def run_benchmark(name, data, repeat):
+    setup, run, nitems = BENCHMARKS[name](data)
+    times = []
+    for _ in range(repeat):
+        arg = setup()
+        t0 = time.perf_counter()
+        run(arg)
+        times.append(time.perf_counter() - t0)
+    best = min(times)
+    return {
+        "items": nitems,
+        "best": best,
+        "median": statistics.median(times),
+        "repeat": repeat,
+        "per_item_us": best / max(nitems, 1) * 1e6,
+    }
+
+
+def regressions(results, baseline, max_slowdown):
+    """Return messages for the results slower than max_slowdown times the baseline"""
+    msgs = []
+    for name, res in results.items():
+        if not (base := baseline.get(name)) or not base["per_item_us"]:
+            continue
+        ratio = res["per_item_us"] / base["per_item_us"]
+        if ratio > max_slowdown:
+            msgs.append(
+                f"{name}: {res['per_item_us']:0.3f} us/item vs "
+                f"{base['per_item_us']:0.3f} baseline ({ratio:0.2f}x)"
+            )
+    return msgs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--files", type=int, default=100_000, help="[%(default)s]")
+    parser.add_argument("--repeat", type=int, default=3, help="[%(default)s]")
+    parser.add_argument("--seed", type=int, default=0, help="[%(default)s]")
+    parser.add_argument(
+        "--only", action="append", choices=list(BENCHMARKS), help="Can repeat"
+    )
+    parser.add_argument("--output", metavar="FILE", help="Write the results as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare to these results")
+    parser.add_argument(
+        "--max-slowdown",
+        type=float,
+        default=1.25,
+        help="Allowed ratio to the baseline. [%(default)s]",
+    )
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rirb.log._init(tmpdir=tmpdir)
+
+        t0 = time.time()
+        prev = synthetic.file_tree(args.files, seed=args.seed)
+        curr, counts = synthetic.mutate(prev, seed=args.seed + 1)
+        data = utils.Bunch(prev=prev, curr=curr, tmpdir=tmpdir)
+        print(
+            f"Generated {len(prev)} files ({dict(counts)}) in "
+            f"{time.time() - t0:0.1f} s",
+            file=sys.stderr,
+        )
+
+        results = {}
+        for name in args.only or BENCHMARKS:
+            results[name] = res = run_benchmark(name, data, args.repeat)
+            print(
+                f"{name:<24} {res['best']:9.4f} s {res['per_item_us']:9.3f} us/item "
+                f"({res['items']} items)",
+                file=sys.stderr,
+            )
+        rirb.log.flush()
+
+    out = {
+        "rirb": rirb.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "files": args.files,
+        "seed": args.seed,
+        "results": results,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(out, indent=1))
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        if baseline["files"] != args.files:
+            print("WARNING: the baseline has a different number of files")
+        if msgs := regressions(results, baseline["results"], args.max_slowdown):
+            print("REGRESSIONS:")
+            for msg in msgs:
+                print(f"  {msg}")
+            return 1
+        print(f"No regressions (max slowdown {args.max_slowdown})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
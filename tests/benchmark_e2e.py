@@ -0,0 +1,234 @@
+"""
+End-to-end benchmarks. Full runs on a generated tree against local stand-ins for
+remotes: a local directory, `rclone serve webdav`, and `rclone serve sftp`. Needs
+rclone.
+
+    $ python benchmark_e2e.py --files 5000 --output e2e.json
+    $ python benchmark_e2e.py --backend webdav --override "dir_moves = True"
+
+Each backend runs the scenarios in order on the same tree:
+
+    init         --init of the whole tree
+    noop         Nothing changed
+    incremental  New, modified, deleted, and renamed files (see synthetic.RATES)
+    mass_rename  About half of the tree moved to new directories
+    mass_delete  Half of the files deleted
+    dst_list     A few changes with --dst-list (as after an interrupted run)
+
+The wall time and the rclone calls, time, bytes, and files (total and by top-level
+phase) of each run are recorded. Compare strategies by running with different
+--override options (rirb config, e.g. "economy = True") and a --label.
+"""
+import os, sys
+import argparse
+import json
+import platform
+import random
+import time
+from pathlib import Path
+
+CWD = os.getcwd()  # testutils changes it
+
+import synthetic
+import testutils
+
+import rirb
+
+BACKENDS = ("local", "webdav", "sftp")
+SCENARIOS = ("init", "noop", "incremental", "mass_rename", "mass_delete", "dst_list")
+PORTS = {"webdav": 45690, "sftp": 45691}
+
+
+def write_file(path, size, rng, mtime=None):
+    path = Path("src") / path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Not rng.randbytes() which is Python 3.9+. getrandbits(0) also needs 3.9+
+    data = rng.getrandbits(8 * size).to_bytes(size, "little") if size else b""
+    path.write_bytes(data)
+    if mtime:
+        os.utime(path, (mtime, mtime))
+
+
+def src_files():
+    return [os.path.relpath(file, "src") for file in testutils.tree("src")]
+
+
+def init(args, rng):
+    # In the past so that later changes are always newer (see the `dt` config)
+    mtime = time.time() - 24 * 60 * 60
+    for path, file in synthetic.file_tree(args.files, seed=args.seed).items():
+        write_file(path, min(file["Size"], args.max_size), rng, mtime=mtime)
+    return ["--init"]
+
+
+def noop(args, rng):
+    return []
+
+
+def incremental(args, rng):
+    files = src_files()
+    rng.shuffle(files)
+    n = {k: int(rate * len(files)) for k, rate in synthetic.RATES.items()}
+
+    deleted = files[: n["deleted"]]
+    renamed = files[len(deleted) : len(deleted) + n["renamed"]]
+    start = len(deleted) + len(renamed)
+    modified = files[start : start + n["modified"]]
+
+    for path in deleted:
+        os.unlink(Path("src") / path)
+    for ii, path in enumerate(renamed):
+        dirname, name = os.path.split(path)
+        os.renames(Path("src") / path, Path("src") / dirname / f"renamed_{ii}_{name}")
+    for path in modified:
+        size = min(synthetic.size(rng), args.max_size)
+        write_file(path, size, rng)
+    dirs = sorted({os.path.dirname(path) for path in files})
+    for ii in range(n["new"]):
+        write_file(os.path.join(rng.choice(dirs), f"new_{ii}.bin"), 1024, rng)
+    return []
+
+
+def mass_rename(args, rng):
+    # The largest top-level directories until about half of the files are moved
+    counts = {}
+    for path in src_files():
+        top = path.split("/")[0]
+        counts[top] = counts.get(top, 0) + 1
+    total, moved = sum(counts.values()), 0
+    for top, count in sorted(counts.items(), key=lambda tc: -tc[1]):
+        if moved >= total / 2 or not os.path.isdir(Path("src") / top):
+            continue
+        os.rename(Path("src") / top, Path("src") / f"moved_{top}")
+        moved += count
+    return []
+
+
+def mass_delete(args, rng):
+    for path in rng.sample(src_files(), k=len(src_files()) // 2):
+        os.unlink(Path("src") / path)
+    return []
+
+
+def dst_list(args, rng):
+    for path in rng.sample(src_files(), k=min(10, len(src_files()))):
+        write_file(path, 1024, rng)
+    return ["--dst-list"]
+
+
+def record(obj, wall):
+    profiler = obj.rclone.profiler
+    total = profiler.total
+    return {
+        "wall": wall,
+        "rclone_calls": total.rclone_calls,
+        "rclone_time": total.rclone_time,
+        "bytes": total.bytes,
+        "files": total.files,
+        "api": dict(total.api),
+        "phases": {
+            name: {k: v for k, v in phase.items() if k != "api"}
+            for name, phase in profiler.top_phases().items()
+        },
+    }
+
+
+def run_backend(backend, args):
+    test = testutils.Tester(name=f"benchmark_e2e_{backend}", seed=args.seed)
+    os.makedirs("dst")
+
+    server = None
+    if backend == "webdav":
+        server = testutils.WebDAV("dst", port=PORTS[backend])
+    elif backend == "sftp":
+        server = testutils.SFTP("dst", port=PORTS[backend])
+    if server:  # Served from the local dst so compare_tree() still works
+        test.dst = test.config["dst"] = server.remote
+    test.write_config()
+
+    rng = random.Random(args.seed)
+    overrides = [arg for override in args.override for arg in ("--override", override)]
+    results = []
+    try:
+        for scenario in args.scenario or SCENARIOS:
+            flags = globals()[scenario](args, rng)
+            t0 = time.time()
+            obj = test.cli("config.py", *flags, *overrides)
+            res = {"backend": backend, "scenario": scenario}
+            res.update(record(obj, time.time() - t0))
+            if args.verify:
+                res["verified"] = test.compare_tree() == set()
+            results.append(res)
+            print(
+                f"{backend:<7} {scenario:<12} {res['wall']:8.2f} s "
+                f"{res['rclone_calls']:5d} rclone calls "
+                f"{res['bytes'] / 1024**2:9.2f} MiB {res['files']:7d} files",
+                file=sys.stderr,
+            )
+    finally:
+        if server:
+            server.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--files", type=int, default=2000, help="[%(default)s]")
+    parser.add_argument(
+        "--max-size",
+        type=int,
+        default=256 * 1024,
+        help="Cap on the (log-normal) file sizes in bytes. [%(default)s]",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="[%(default)s]")
+    parser.add_argument(
+        "--backend", action="append", choices=BACKENDS, help="Can repeat. [all]"
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=SCENARIOS,
+        help="Can repeat. Run in the order given. Include init. [all]",
+    )
+    parser.add_argument(
+        "--override",
+        action="append",
+        default=[],
+        metavar="'OPTION = VALUE'",
+        help="Passed to rirb's --override. Can repeat",
+    )
+    parser.add_argument("--no-verify", action="store_false", dest="verify")
+    parser.add_argument("--label", default="", help="Saved with the results")
+    parser.add_argument("--output", metavar="FILE", help="Write the results as JSON")
+    args = parser.parse_args(argv)
+
+    output = os.path.join(CWD, args.output) if args.output else None
+
+    results = []
+    for backend in args.backend or BACKENDS:
+        results.extend(run_backend(backend, args))
+    os.chdir(testutils.PWD0)
+
+    out = {
+        "rirb": rirb.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "label": args.label,
+        "files": args.files,
+        "max_size": args.max_size,
+        "seed": args.seed,
+        "override": args.override,
+        "results": results,
+    }
+    if output:
+        Path(output).write_text(json.dumps(out, indent=1))
+
+    if not all(res.get("verified", True) for res in results):
+        print("ERROR: The destination does not match the source", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""
+Synthetic file lists for benchmarks. Lists are like rclone's (and rirb's curr):
+{path: {"Size", "ModTime", "MimeType", "Hashes"}}
+"""
+import os
+import random
+import datetime
+import hashlib
+from collections import Counter
+
+EXTENSIONS = [".jpg", ".txt", ".pdf", ".py", ".json", ".mp4", ".docx", ".csv", ""]
+MIMETYPES = {
+    ".jpg": "image/jpeg",
+    ".txt": "text/plain; charset=utf-8",
+    ".pdf": "application/pdf",
+    ".py": "text/x-python; charset=utf-8",
+    ".json": "application/json",
+    ".mp4": "video/mp4",
+    ".docx": "application/octet-stream",
+    ".csv": "text/csv; charset=utf-8",
+    "": "application/octet-stream",
+}
+WORDS = ["photo", "report", "notes", "data", "draft", "scan", "backup", "final", "IMG"]
+
+FILES_PER_DIR = 20  # On average
+MAX_DEPTH = 10
+
+# Log-normal sizes. The median is ~8 KiB with a long tail into the GiBs
+SIZE_MU = 9.0
+SIZE_SIGMA = 3.0
+MAX_SIZE = 50 * 1024**3
+
+T0 = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+T1 = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+
+# Fraction of the files changed between runs (see mutate())
+RATES = {"new": 0.02, "modified": 0.01, "deleted": 0.01, "renamed": 0.01}
+
+
+def directories(ndirs, rng):
+    """
+    Return ndirs directory paths. Each new directory goes in a random existing one
+    (or the root) so the tree is wide near the top with a long tail of depth.
+    """
+    dirs = [""]
+    depths = [0]
+    for ii in range(ndirs):
+        jj = rng.randrange(len(dirs))
+        if depths[jj] >= MAX_DEPTH:
+            jj = 0
+        name = f"{rng.choice(WORDS)}_dir{ii}"
+        dirs.append(f"{dirs[jj]}/{name}" if dirs[jj] else name)
+        depths.append(depths[jj] + 1)
+    return dirs
+
+
+def modtime(rng):
+    """A random RFC3339 ModTime with nanoseconds and a timezone, like rclone"""
+    t = rng.uniform(T0, T1)
+    tz = datetime.timezone(datetime.timedelta(hours=rng.choice([-7, -5, 0, 1, 9])))
+    dt = datetime.datetime.fromtimestamp(int(t), tz=tz)
+    return f"{dt:%Y-%m-%dT%H:%M:%S}.{rng.randrange(10**9):09d}{dt.isoformat()[19:]}"
+
+
+def size(rng):
+    return min(int(rng.lognormvariate(SIZE_MU, SIZE_SIGMA)), MAX_SIZE)
+
+
+def hashes(rng):
+    data = rng.getrandbits(64).to_bytes(8, "little")
+    return {
+        "sha1": hashlib.sha1(data).hexdigest(),
+        "md5": hashlib.md5(data).hexdigest(),
+    }
+
+
+def file_tree(nfiles, *, seed=0):
+    """Return a synthetic file list of nfiles"""
+    rng = random.Random(seed)
+    dirs = directories(max(1, nfiles // FILES_PER_DIR), rng)
+    files = {}
+    for ii in range(nfiles):
+        ext = rng.choice(EXTENSIONS)
+        path = os.path.join(rng.choice(dirs), f"{rng.choice(WORDS)}_{ii}{ext}")
+        files[path] = new_file(ext, rng)
+    return files
+
+
+def new_file(ext, rng):
+    return {
+        "Size": size(rng),
+        "MimeType": MIMETYPES[ext],
+        "ModTime": modtime(rng),
+        "Hashes": hashes(rng),
+    }
+
+
+def mutate(prev, *, rates=None, seed=1):
+    """
+    Return (curr, counts) where curr is prev after a run's worth of changes at
+    rates (fraction of prev by kind, see RATES). Half of the modified files keep
+    their size. Renamed files are unchanged other than the path, some in the same
+    directory and some moved to another one.
+    """
+    rates = {**RATES, **(rates or {})}
+    rng = random.Random(seed)
+    n = len(prev)
+    paths = list(prev)
+    rng.shuffle(paths)
+
+    counts = Counter({k: int(rate * n) for k, rate in rates.items()})
+    deleted = paths[: counts["deleted"]]
+    renamed = paths[len(deleted) : len(deleted) + counts["renamed"]]
+    start = len(deleted) + len(renamed)
+    modified = paths[start : start + counts["modified"]]
+
+    curr = dict(prev)
+    for path in deleted:
+        del curr[path]
+
+    dirs = sorted({os.path.dirname(path) for path in prev})
+    for ii, path in enumerate(renamed):
+        file = curr.pop(path)
+        dirname, name = os.path.split(path)
+        if ii % 2:
+            dirname = rng.choice(dirs)
+        curr[os.path.join(dirname, f"renamed_{ii}_{name}")] = file
+
+    for ii, path in enumerate(modified):
+        file = curr[path] = dict(curr[path])
+        if ii % 2:
+            file["Size"] = size(rng)
+        file["ModTime"] = modtime(rng)
+        file["Hashes"] = hashes(rng)
+
+    for ii in range(counts["new"]):
+        ext = rng.choice(EXTENSIONS)
+        path = os.path.join(rng.choice(dirs), f"new_{ii}{ext}")
+        curr[path] = new_file(ext, rng)
+
+    return curr, counts
+
+
+def lsjson(files):
+    """The files as `rclone lsjson` output (before file_list2dict)"""
+    return [
+        {
+            "Path": path,
+            "Name": os.path.basename(path),
+            "IsDir": False,
+            "ID": str(ii),
+            "Tier": "STANDARD",
+            **file,
+        }
+        for ii, (path, file) in enumerate(files.items())
+    ]
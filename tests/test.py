@@ -4,10 +4,15 @@
 import os, sys
 from pathlib import Path
 import gzip as gz
+import lzma
 import json
 import shutil
 import textwrap
+from collections import Counter
 import re
+import time
+import threading
+import subprocess
 
 
 p = os.path.abspath("../")
@@ -19,6 +24,10 @@ import testutils
 
 # tool itself
 import rirb.main
+import rirb.planner
+import rirb.history
+import rirb.perf
+import rirb.streaming
 from rirb.config_example import dst as _  # This is just to test it for coverage
 
 
@@ -135,6 +144,51 @@ def test_main():
     rirb.cli.cli(["new.py", "--new"])
 
 
+def test_metadata_only_updates():
+    """
+    Test that files with only a changed ModTime are not transfered or backed up
+    """
+    test = testutils.Tester(name="metadata_only")
+
+    test.config["compare"] = "mtime"
+    test.config["metadata_only_updates"] = True
+    test.write_config()
+
+    test.write_pre("src/touch.txt", "touch me")
+    test.write_pre("src/mod.txt", "modify me")
+    test.write_pre("src/untouched.txt", "leave me")
+    test.cli("--init", "config.py")
+    assert test.compare_tree() == set()
+
+    test.write_post("src/touch.txt", "touch me")  # Same content. New ModTime
+    test.write_post("src/mod.txt", "modify mE")
+    test.cli("config.py")
+    assert test.compare_tree() == set()
+
+    # Only updated the ModTime
+    assert os.stat("src/touch.txt").st_mtime == pytest.approx(
+        os.stat("dst/curr/touch.txt").st_mtime, abs=1
+    )
+    assert "Computing hashes for 2 files" in test.logs[-1][0]
+
+    backup_dir = test.backup_dirs()[-1]
+    assert set(os.listdir(backup_dir)) == {"mod.txt"}
+
+    diffspath = Path(test.log_dirs()[-1]) / "diffs.json.gz"
+    with gz.open(diffspath) as fobj:
+        diffs = json.load(fobj)
+    assert diffs == {
+        "new": [],
+        "modified": ["mod.txt"],
+        "touched": ["touch.txt"],
+        "deleted": [],
+        "renamed": [],
+    }
+
+    # And it shows in the summary
+    assert "Touched: 1 file" in test.logs[-1][0]
+
+
 def test_missing_local_list():
     test = testutils.Tester(name="missingloc")
 
@@ -229,6 +283,63 @@ def test_dst_list(attrib):
     assert test.logs[-1][1].count("--fast-list") == 2  # config and call
 
 
+def test_auto_hash_type():
+    """Test hash_type = 'auto' and failing early without a common hash"""
+    test = testutils.Tester(name="auto_hash")
+
+    test.config["compare"] = "hash"
+    test.config["hash_type"] = "auto"
+    test.config["_uuid"] = "UUID"
+    test.write_config()
+
+    test.write_pre("src/file1.txt", "file1")
+    test.cli("--init", "config.py")
+    assert test.compare_tree() == set()
+
+    with gz.open(Path(test.log_dirs()[-1]) / "curr.json.gz", "rb") as fobj:
+        files = json.load(fobj)
+    htypes = set(files["file1.txt"]["Hashes"])
+    assert len(htypes) == 1
+
+    cached = json.loads(Path("cache/rirb/hash_type/UUID.json").read_text())
+    assert {cached["hash_type"]} == htypes
+    assert cached["common"]
+
+    # Uses the cache the second time
+    test.write_post("src/file1.txt", "file1.")
+    test.cli("config.py")
+    assert "Using cached hash_type decision" in test.logs[-1][1]
+    assert test.compare_tree() == set()
+
+    # WebDAV (without a vendor) doesn't support hashes.
+    dport = 56790
+    test = testutils.Tester(
+        name="auto_hash_webdav", dst=f":webdav,url='http://localhost:{dport}':"
+    )
+    test.config["compare"] = "hash"
+    test.config["hash_type"] = "auto"
+    test.write_config()
+    test.write_pre("src/file1.txt", "file1")
+    dwebdav = testutils.WebDAV("dst", port=dport)
+
+    try:
+        # Nothing to compare on --init
+        test.cli("--init", "config.py", "--debug")
+        assert test.compare_tree() == set()
+
+        test.write_post("src/file1.txt", "file1.")
+        try:
+            test.cli("config.py", "--dst-list")
+            assert False, "Expected failure!"
+        except rirb.main.NoCommonHashError:
+            pass
+    finally:
+        dwebdav.close()
+
+    # Never got to the transfer
+    assert test.compare_tree() == {("disagree", "file1.txt")}
+
+
 def test_automatic_dst_list_and_prefix():
     """Test that automatic dst_list works in various ways"""
     test = testutils.Tester(name="auto-dst-list")
@@ -320,6 +431,656 @@ def test_automatic_dst_list_and_prefix():
     assert test.compare_tree() == set()
 
 
+def test_resume_journal():
+    """Test resuming an interrupted run from the journal without --dst-list"""
+    test = testutils.Tester(name="resume")
+
+    test.config["compare"] = "mtime"
+    test.config["_uuid"] = "myuuid"
+    test.config["transfer_batch_size"] = 1
+    test.config["resume_interrupted"] = True
+    test.write_config()
+
+    test.write_pre("src/a.txt", "a")
+    test.write_pre("src/b.txt", "b")
+    test.write_pre("src/c.txt", "c")
+    test.cli("config.py", "--init")
+    assert test.compare_tree() == set()
+
+    # Modify all three but fail after the first batch
+    test.write_post("src/a.txt", "a.")
+    test.write_post("src/b.txt", "b.")
+    test.write_post("src/c.txt", "c.")
+    test.write_pre("dst/curr/newtxt", "should not be here")
+    try:
+        rirb.rclone._TEST_FAIL_LOC = "transfer_batch"
+        test.cli("config.py", "--debug")  # use --debug so we can catch it
+    except ValueError:
+        pass
+    finally:
+        rirb.rclone._TEST_FAIL_LOC = None
+
+    assert test.compare_tree() == {
+        ("disagree", "b.txt"),
+        ("disagree", "c.txt"),
+        ("missing_in_src", "newtxt"),
+    }
+    journal = Path("cache/rirb/journal/myuuid.jsonl").read_text()
+    assert journal == (Path(test.log_dirs()[-1]) / "journal.jsonl").read_text()
+
+    # Resume. Should NOT use --dst-list so newtxt remains
+    test.cli("config.py")
+    log = test.logs[-1][0]
+    assert "Previous run did not complete. Resuming from its journal" in log
+    assert "Replayed journal: 1 transfered files" in log
+    assert test.compare_tree() == {("missing_in_src", "newtxt")}
+
+    # a.txt was backed up by the first run, the others by the second
+    back0, back1 = test.backup_dirs()
+    assert set(os.listdir(back0)) == {"a.txt"}
+    assert set(os.listdir(back1)) == {"b.txt", "c.txt"}
+    assert test.read(os.path.join(back1, "b.txt")) == "b"
+
+    assert not Path("cache/rirb/journal/myuuid.jsonl").exists()
+
+
+def test_profile():
+    """Test that the phases are profiled and uploaded"""
+    test = testutils.Tester(name="profile")
+    test.config["transfer_batch_size"] = 1
+    test.write_config()
+
+    test.write_pre("src/file1.txt", "file1")
+    test.write_pre("src/file2.txt", "file2")
+    test.cli("config.py", "--init")
+
+    log = test.logs[-1][0]
+    assert "Profile:" in log
+    assert "Total rclone time:" in log
+
+    profile = json.loads((Path(test.log_dirs()[-1]) / "profile.json").read_text())
+    assert not profile["failed"]
+    phases = {phase["name"]: phase for phase in profile["phases"]}
+    for name in ["list_src", "list_dst", "compare", "diffs", "transfer", "curr"]:
+        assert name in phases, name
+    assert "log upload" not in phases  # Uploaded with the logs so written before
+
+    # Batches are inside the transfer and counted in it
+    batches = [p for p in profile["phases"] if p["name"].startswith("batch ")]
+    assert len(batches) == 2
+    assert all(p["parent"] == "transfer" for p in batches)
+    assert phases["transfer"]["files"] == 2
+    assert phases["transfer"]["rclone_calls"] >= sum(
+        p["rclone_calls"] for p in batches
+    )
+    assert phases["list_src"]["files"] == 2
+
+
+def test_trace():
+    """Test the --trace timeline"""
+    test = testutils.Tester(name="trace")
+    test.write_config()
+
+    test.write_pre("src/file1.txt", "file1")
+    test.cli("config.py", "--init", "--trace", "trace.json")
+
+    trace = json.loads(Path("trace.json").read_text())
+    events = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+    calls = [e for e in events if e["cat"] == "rclone"]
+    phases = {e["name"]: e for e in events if e["cat"] == "phase"}
+
+    names = {e["name"] for e in calls}
+    assert {"rclone lsjson", "rclone copy", "rclone copyto"} <= names
+    assert all(e["args"]["returncode"] == 0 and e["args"]["pid"] for e in calls)
+    assert {"list_src", "transfer"} <= set(phases)  # Written before the log upload
+
+    # The transfer call is inside of the transfer phase on the same thread
+    (copy,) = [e for e in calls if e["name"] == "rclone copy"]
+    transfer = phases["transfer"]
+    assert copy["tid"] == transfer["tid"]
+    assert transfer["ts"] <= copy["ts"] <= transfer["ts"] + transfer["dur"]
+
+    names = {e["args"]["name"] for e in trace["traceEvents"] if e["ph"] == "M"}
+    assert "MainThread" in names
+    assert any(name.startswith("backup") for name in names)
+
+
+def test_prometheus():
+    """Test the Prometheus metrics for a successful and a failed run"""
+    test = testutils.Tester(name="prometheus")
+    os.makedirs("metrics")
+    test.config["prometheus_textfile"] = "metrics"
+    test.config["_uuid"] = "myuuid"
+    test.write_config()
+
+    test.write_pre("src/file1.txt", "file1")
+    test.write_pre("src/file2.txt", "file2")
+    test.cli("config.py", "--init")
+
+    path = Path("metrics/rirb_myuuid.prom")
+    text = path.read_text()
+    labels = f'uuid="myuuid",src="{test.src}",dst="{test.dst}"'
+    assert f"rirb_success{{{labels}}} 1.0" in text
+    assert f'rirb_files{{{labels},kind="total"}} 2.0' in text
+    assert f'rirb_files{{{labels},kind="new"}} 2.0' in text
+    assert f'rirb_bytes{{{labels},kind="new"}} 10.0' in text
+    assert f'rirb_phase_duration_seconds{{{labels},phase="transfer"}}' in text
+    assert "# TYPE rirb_rclone_calls gauge" in text
+    assert os.listdir("metrics") == ["rirb_myuuid.prom"]  # No temp files
+
+    test.write_post("src/file3.txt", "file3")
+    try:
+        rirb.rclone._TEST_FAIL_LOC = "transfer"
+        test.cli("config.py", "--debug")
+    except ValueError:
+        pass
+    finally:
+        rirb.rclone._TEST_FAIL_LOC = None
+    assert f"rirb_success{{{labels}}} 0.0" in path.read_text()
+
+
+def test_prometheus_unreachable():
+    """Test that the metrics and trace are written even if nothing can be uploaded"""
+    test = testutils.Tester(name="prometheus_unreachable")
+    os.makedirs("metrics")
+    Path("rclone").write_text("#!/bin/sh\nexit 1\n")
+    os.chmod("rclone", 0o755)
+    test.config["rclone_exe"] = os.path.abspath("rclone")
+    test.config["prometheus_textfile"] = "metrics"
+    test.config["_uuid"] = "myuuid"
+    test.write_config()
+
+    test.write_pre("src/file1.txt", "file1")
+    with pytest.raises(subprocess.CalledProcessError):
+        test.cli("config.py", "--init", "--trace", "trace.json")
+
+    trace = json.loads(Path("trace.json").read_text())
+    assert trace["otherData"]["failed"]
+
+    text = Path("metrics/rirb_myuuid.prom").read_text()
+    assert re.search(r'^rirb_success\{uuid="myuuid",.*\} 0\.0$', text, flags=re.M)
+
+
+def test_history():
+    """Test the run history, regressions, and the --dry-run prediction"""
+    test = testutils.Tester(name="history")
+    test.config["run_history"] = True
+    test.write_config()
+
+    test.write_pre("src/big.bin", os.urandom(2 * 1024**2), mode="wb")
+    test.cli("config.py", "--init")
+    store = rirb.history.History("cache/rirb/history.sqlite")
+    (run,) = store.baseline(test.dst)
+    assert run["files"] == 1
+    assert run["transfer_bytes"] == 2 * 1024**2
+    assert "transfer" in run["phases"]
+
+    test.write_post("src/big2.bin", os.urandom(1024**2), mode="wb")
+    test.cli("config.py", "--dry-run")
+    assert "Predicted transfer time:" in test.logs[-1][0]
+    assert len(store.baseline(test.dst)) == 1  # dry runs are not added
+
+    # Regressions need a baseline and only count when the work did not grow
+    def _run(wall, files):
+        phase = {"wall": wall, "rclone_calls": 1, "files": files, "bytes": 0}
+        return {"files": files, "phases": {"list_src": phase}}
+
+    baseline = [_run(10, 1000) for _ in range(5)]
+    assert not rirb.history.regressions(_run(40, 1000), _run(40, 1000)["phases"], [])
+    (msg,) = rirb.history.regressions(
+        _run(40, 1000), _run(40, 1000)["phases"], baseline
+    )
+    assert "Phase 'list_src' took" in msg
+    assert not rirb.history.regressions(
+        _run(40, 2000), _run(40, 2000)["phases"], baseline
+    )
+    assert not rirb.history.regressions(
+        _run(20, 1000), _run(20, 1000)["phases"], baseline
+    )
+
+
+def test_economy():
+    """Test the API call estimates and economy"""
+    test = testutils.Tester(name="economy")
+    test.config["economy"] = True
+    test.write_config()
+
+    for ii in range(5):
+        test.write_pre(f"src/sub/file{ii}.txt", f"file{ii}")
+    test.cli("--init", "config.py")
+    assert test.compare_tree() == set()
+
+    # Listing calls cost 10x so, unlike test_planner, this isn't traversed
+    log = test.logs[-1][0]
+    assert "Plan transfer batch 1: no-traverse (est. 5 API calls vs traverse: 2)" in log
+    assert "API Calls (est.): list" in log
+
+    # Only uploaded after deletes and renames
+    assert not (Path(test.log_dirs()[-1]) / "journal.jsonl").exists()
+
+    profile = json.loads((Path(test.log_dirs()[-1]) / "profile.json").read_text())
+    phases = {phase["name"]: phase for phase in profile["phases"]}
+    assert phases["transfer"]["api"]["write"] == 5
+
+    # Estimates by command
+    api = rirb.perf.api_calls(["lsf", "dst:a"], dst="dst:", nout=2500)
+    assert api == Counter(list=3)
+    api = rirb.perf.api_calls(["lsf", "src:a"], dst="dst:", nout=2500)
+    assert not api
+    stats = {"transfers": 3, "checks": 4, "renames": 1}
+    api = rirb.perf.api_calls(["move", "src:", "dst:"], dst="dst:", stats=stats)
+    assert api == Counter(write=5, read=4)
+
+
+def test_stream_new_files():
+    """Test that new files that can't be renames are streamed while listing"""
+    test = testutils.Tester(name="stream")
+
+    test.config["renames"] = "size"
+    test.config["stream_new_files"] = True
+    test.config["transfer_batch_size"] = 1
+    test.config["_uuid"] = "myuuid"
+    test.write_config()
+
+    test.write_pre("src/mod.txt", "modify me")
+    test.write_pre("src/move.txt", "move me")
+    test.cli("config.py", "--init")
+    assert test.compare_tree() == set()
+    assert "Streaming new files while listing" not in test.logs[-1][0]  # --dst-list
+
+    test.write_post("src/mod.txt", "modified!")
+    test.move("src/move.txt", "src/moved.txt")
+    test.write_post("src/new1.txt", "new file 1")
+    test.write_post("src/sub/new2.txt", "new file number 2")
+    test.write_post("src/same.txt", "same me")  # Same size as move.txt. Not streamed
+    test.cli("config.py")
+    assert test.compare_tree() == set()
+
+    log = test.logs[-1][0]
+    assert "Streamed 2 new files in 2 batch(es) while listing" in log
+    assert "Plan stream batch 1: no-traverse (est. 1 API calls" in log
+    assert "Move 'move.txt' --> 'moved.txt'" in log
+
+    with gz.open(Path(test.log_dirs()[-1]) / "diffs.json.gz") as fobj:
+        diffs = json.load(fobj)
+    assert set(diffs["new"]) == {"new1.txt", "sub/new2.txt", "same.txt"}
+    assert diffs["renamed"] == [["move.txt", "moved.txt"]]
+
+    # Every streamed batch is journaled
+    journal = (Path(test.log_dirs()[-1]) / "journal.jsonl").read_text()
+    assert journal.count('"event": "batch"') == 4  # Two streamed, two regular
+
+
+def test_stream_max_wait():
+    """Test that a partial streamed batch is sent after MAX_WAIT without more files"""
+    testutils.Tester(name="stream_max_wait")
+    rirb.log._init(tmpdir="tmp")
+
+    sent = []
+    rclone = rirb.utils.Bunch(
+        config=rirb.utils.Bunch(
+            renames=None,
+            transfer_batch_size=10,
+            transfer_batch_bytes=None,
+            prefix_incomplete_backups=True,
+        ),
+        profiler=rirb.perf.Profiler(),
+        planner=rirb.planner.Planner(None, {}),
+        upload_diffs_backups=lambda *args, **kwargs: None,
+        transfer_cmd=lambda: [],
+        _transfer_batch=lambda cmd, batch, files, name: sent.append(batch),
+    )
+
+    max_wait, rirb.streaming.MAX_WAIT = rirb.streaming.MAX_WAIT, 0.5
+    try:
+        stream = rirb.streaming.NewFileStream(rclone, {}, on_begin=lambda: None)
+        stream.add("file1.txt", {"Size": 1})
+        time.sleep(2)  # The listing stalled
+        assert sent == [["file1.txt"]]
+        assert stream.finish() == ["file1.txt"]
+    finally:
+        rirb.streaming.MAX_WAIT = max_wait
+    rirb.log.flush()
+
+
+@pytest.mark.skipif(os.geteuid() == 0, reason="root can read anything")
+def test_file_retries():
+    """Test that only the failed files get retried"""
+    import subprocess
+
+    test = testutils.Tester(name="file_retries")
+
+    test.config["file_retries"] = 1
+    test.config["file_retry_backoff"] = 0
+    test.write_config()
+
+    test.write_pre("src/file1.txt", "file1")
+    test.cli("--init", "config.py")
+
+    test.write_pre("src/file2.txt", "file2")
+    test.write_pre("src/unreadable.txt", "bad")
+    os.chmod("src/unreadable.txt", 0)
+    try:
+        test.cli("config.py", "--debug")
+        assert False, "Expected failure!"
+    except subprocess.CalledProcessError:
+        pass
+    finally:
+        os.chmod("src/unreadable.txt", 0o644)
+
+    log = Path(rirb.cli.log.log_file).read_text()
+    assert "1 file(s) failed. Retrying them in 0.0 s (1/1)" in log
+    assert "1 file(s) failed after 1 retries:" in log
+    assert "'unreadable.txt': failed:" in log
+    assert test.compare_tree() == {("missing_in_dst", "unreadable.txt")}
+
+
+def test_size_classes():
+    """Test transfering by size class with their own flags"""
+    test = testutils.Tester(name="size_classes")
+
+    test.config["transfer_size_classes"] = [
+        (10, ["--transfers", "1"]),
+        (None, ["--transfers", "2"]),
+    ]
+    test.config["transfer_class_order"] = "large-first"
+    test.config["transfer_parallel_classes"] = True
+    test.write_config()
+
+    test.write_pre("src/small1.txt", "small")
+    test.write_pre("src/small2.txt", "small.")
+    test.write_pre("src/large.txt", "large" * 10)
+    test.cli("--init", "config.py", "--debug")
+    assert test.compare_tree() == set()
+
+    log = test.logs[-1][0]
+    assert "Size class 1 (<= 10.00 B): 1 batches" in log
+    assert "Size class 2 (largest): 1 batches" in log
+    assert "'--transfers', '1', '--order-by', 'size,descending'" in log
+    assert "'--transfers', '2', '--order-by', 'size,descending'" in log
+
+    # Classes without files are not run
+    test.write_post("src/small1.txt", "small!")
+    test.cli("config.py")
+    assert test.compare_tree() == set()
+    log = test.logs[-1][0]
+    assert "Size class 1 (<= 10.00 B): 1 batches" in log
+    assert "Size class 2" not in log
+
+
+def test_adaptive_transfers():
+    """Test that the adaptive transfers are used and remembered"""
+    test = testutils.Tester(name="adaptive_transfers")
+
+    test.config["adaptive_transfers"] = (2, 8)
+    test.config["transfer_batch_size"] = 2
+    test.write_config()
+
+    for ii in range(5):
+        test.write_pre(f"src/file{ii}.txt", f"file{ii}")
+    test.cli("--init", "config.py", "--debug")
+    assert test.compare_tree() == set()
+
+    debuglog = test.logs[-1][1]
+    assert "'--transfers', '4', '--checkers', '8'" in debuglog
+    assert "batch too small to measure" in debuglog
+
+    tuning = list(Path("cache/rirb/tuning").glob("*.json"))
+    assert len(tuning) == 1
+    assert json.loads(tuning[0].read_text())["transfers"] == {"0": 4}
+
+
+def test_planner():
+    """Test that traversal is planned and the backend features are cached"""
+    test = testutils.Tester(name="planner")
+    test.config["renames"] = "hash"
+    test.write_config()
+
+    for ii in range(5):
+        test.write_pre(f"src/sub/file{ii}.txt", f"file{ii}")
+    test.cli("--init", "config.py")
+    assert test.compare_tree() == set()
+
+    # Local has no ListR and this is the first time so there is little to list
+    log = test.logs[-1][0]
+    assert "Plan transfer batch 1: traverse (est. 2 API calls vs no-traverse: 5)" in log
+
+    features = list(Path("cache/rirb/features").glob("*.json"))
+    assert features
+    assert json.loads(features[0].read_text())["features"]["Name"] == "local"
+
+    test.move("src/sub/file1.txt", "src/sub/file1.moved.txt")
+    test.write_post("src/sub/file2.txt", "file2.")
+    test.cli("config.py", "--debug")
+    assert test.compare_tree() == set()
+
+    log = test.logs[-1][0]
+    assert "Plan transfer batch 1: no-traverse" in log
+    assert "Plan rename: server-side move (est. 1 API calls)" in log
+    assert "Using cached features of" in test.logs[-1][1]
+
+
+def test_rename_grouping():
+    """
+    Test that the grouped renames do the same as moving each file by replaying both
+    on a local remote
+    """
+    test = testutils.Tester(name="rename_grouping")
+    test.config["renames"] = "hash"
+    test.write_config()
+
+    for year in (2019, 2020):
+        for sub in "abc":
+            for ii in range(2):
+                test.write_pre(f"src/{year}/{sub}/raw/file{ii}.txt", f"{year}{sub}{ii}")
+    test.write_pre("src/top.txt", "top")
+    test.write_pre("src/x/one.txt", "one")
+    test.cli("--init", "config.py")
+    assert test.compare_tree() == set()
+
+    shutil.copytree("dst/curr", "perfile")
+
+    os.makedirs("src/archive")
+    shutil.move("src/2019", "src/archive/2019")
+    for sub in "abc":
+        shutil.move(f"src/2020/{sub}/raw", f"src/2020/{sub}/processed")
+    test.move("src/top.txt", "src/other/top2.txt")
+    test.move("src/x/one.txt", "src/y/one.txt")
+
+    test.cli("config.py")
+    assert test.compare_tree() == set()
+
+    diffspath = Path(test.log_dirs()[-1]) / "diffs.json.gz"
+    with gz.open(diffspath) as fobj:
+        renames = json.load(fobj)["renamed"]
+    assert len(renames) == 14
+
+    # 2019 is one call. Each 2020 subdir is its own since the middle changed
+    moveto, move = rirb.planner.group_renames(renames)
+    assert len(moveto) == 2
+    assert len(move) == 4
+    assert "Grouped Move '' --> 'archive'" in test.logs[-1][0]
+
+    for src, dst in renames:
+        subprocess.check_call(["rclone", "moveto", f"perfile/{src}", f"perfile/{dst}"])
+
+    grouped = {
+        os.path.relpath(file, "dst/curr"): test.read(file)
+        for file in testutils.tree("dst/curr")
+    }
+    perfile = {
+        os.path.relpath(file, "perfile"): test.read(file)
+        for file in testutils.tree("perfile")
+    }
+    assert grouped == perfile
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_pipeline(workers):
+    """Test that the backup steps keep the order needed for interrupted backups"""
+    test = testutils.Tester(name="pipeline")
+    test.config["renames"] = "hash"
+    test.config["cleanup_empty_dirs"] = True
+    test.config["max_concurrent_calls"] = workers
+    test.config["log_dest"] = ["logs1", "logs2"]
+    test.write_config()
+
+    test.write_pre("src/mod.txt", "modify me")
+    test.write_pre("src/dir/move.txt", "move me")
+    test.write_pre("src/delete.txt", "delete me")
+    test.cli("--init", "config.py")
+    assert test.compare_tree() == set()
+
+    test.write_post("src/mod.txt", "modified me")
+    test.write_post("src/new.txt", "new")
+    test.move("src/dir/move.txt", "src/moved/move.txt")
+    os.unlink("src/delete.txt")
+    test.cli("config.py", "--debug")
+    assert test.compare_tree() == set()
+    assert not Path("dst/curr/dir").exists()
+    assert len(os.listdir("logs1")) == len(os.listdir("logs2")) == 2
+
+    debuglog = test.logs[-1][1]
+
+    def pos(txt):
+        assert txt in debuglog, f"missing {txt}"
+        return debuglog.index(txt)
+
+    for step in ["transfer", "rename", "delete"]:
+        assert pos("backup: done 'diffs'") < pos(f"backup: start '{step}'")
+        assert pos(f"backup: done '{step}'") < pos("backup: start 'curr'")
+        assert pos(f"backup: done '{step}'") < pos("backup: start 'rmdirs'")
+    assert pos("backup: done 'curr'") < pos("backup: start 'prefix'")
+
+    # Hashes are reused once both the source listing and prev list are done
+    assert pos("startup: done 'list_src'") < pos("startup: start 'src_hashes'")
+    assert pos("startup: done 'prev'") < pos("startup: start 'src_hashes'")
+    assert pos("probes: done 'cache_dir'") < pos("startup: start 'prev'")
+
+
+def test_max_run_time():
+    """Test that everything is stopped at the deadline and the logs still upload"""
+    test = testutils.Tester(name="max_run_time")
+    test.config["max_run_time"] = 0.01
+    test.write_config()
+
+    test.write_pre("src/file1.txt", "file1")
+    with pytest.raises(rirb.rclone.RunCancelled):
+        test.cli("--init", "config.py", "--debug")
+
+    assert not Path("dst/curr/file1.txt").exists()
+    failed_log = Path(test.log_dirs()[-1]) / "FAILED_log.log"
+    assert "Cancelling: max_run_time of 0.01s" in failed_log.read_text()
+
+
+def test_watchdog():
+    """Test that the watchdog stops calls that time out or stall but not others"""
+    testutils.Tester(name="watchdog")
+    rirb.log._init(tmpdir="tmp")
+
+    proc = subprocess.Popen(["sleep", "30"])
+    watchdog = rirb.rclone.Watchdog(proc, timeout=1.5, name="timeout")
+    assert proc.wait(timeout=10)  # stopped
+    assert watchdog.reason.startswith("timed out")
+
+    proc = subprocess.Popen(["sleep", "30"])
+    watchdog = rirb.rclone.Watchdog(proc, stall=2, name="stall")
+    for ii in range(3):  # Progress keeps it going
+        time.sleep(1)
+        watchdog.progress(ii)
+    assert proc.poll() is None
+    assert proc.wait(timeout=10)
+    assert watchdog.reason.startswith("stalled")
+
+    proc = subprocess.Popen(["sleep", "1"])
+    watchdog = rirb.rclone.Watchdog(proc, timeout=10, stall=10, name="ok")
+    assert proc.wait() == 0
+    watchdog.stop()
+    assert watchdog.reason is None
+
+
+def test_stall_timeouts_phases():
+    """Test that stall_timeouts only takes the phases that report progress"""
+    test = testutils.Tester(name="stall_phases")
+    test.config["stall_timeouts"] = {"listing": 60}
+    test.write_config()
+    config = rirb.cli.Config("config.py")
+    with pytest.raises(rirb.cli.ConfigError, match="Unsupported phase"):
+        config.parse()
+
+
+def test_log_writer():
+    """Test that the background log writer keeps every line and the order"""
+    testutils.Tester(name="log_writer")
+    rirb.log._init(tmpdir="tmp")
+
+    def _log(name):
+        for ii in range(2000):
+            rirb.log(f"{name} {ii}", __prefix="test")
+        rirb.debug(f"{name} done")
+
+    threads = [threading.Thread(target=_log, args=(f"t{ii}",)) for ii in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    rirb.log("multi\nline", {"not": "str"})
+    rirb.log.flush()
+
+    lines = Path("tmp/log.log").read_text().splitlines()
+    for name in ["t0", "t1", "t2", "t3"]:
+        nums = [int(line.split()[-1]) for line in lines if f": {name} " in line]
+        assert nums == list(range(2000))
+    assert lines[-2].endswith(": multi")
+    assert lines[-1].endswith(": line {'not': 'str'}")
+
+    debug = Path("tmp/debug.log").read_text()
+    assert all(f"DEBUG: t{ii} done" in debug for ii in range(4))
+
+    # Without a running writer, lines are written right away
+    writer, rirb.log.writer = rirb.log.writer, None
+    try:
+        rirb.log("direct \u00fc")
+    finally:
+        rirb.log.writer = writer
+    lines = Path("tmp/log.log").read_text(encoding="utf-8").splitlines()
+    assert lines[-1].endswith(": direct \u00fc")
+
+
+def test_rclone_log_summary():
+    """Test that rclone_log = "summary" only logs counts and keeps the file log"""
+    test = testutils.Tester(name="rclone_log")
+    test.config["rclone_log"] = "summary"
+    test.config["rclone_flags"] = ["-v"]
+    test.write_config()
+
+    for ii in range(3):
+        test.write_pre(f"src/file{ii}.txt", f"file{ii}")
+    test.cli("config.py", "--init")
+    assert test.compare_tree() == set()
+
+    log = test.logs[-1][0]
+    assert "3 file(s): Copied (new)" in log
+    assert "file1.txt: Copied (new)" not in log
+
+    path = Path(test.log_dirs()[-1]) / "rclone_files.jsonl.gz"
+    with gz.open(path, "rt") as fobj:
+        entries = [json.loads(line) for line in fobj]
+    copied = {e["object"] for e in entries if e["msg"].startswith("Copied")}
+    assert copied == {"file0.txt", "file1.txt", "file2.txt"}
+
+    # Errors are always logged
+    result = rirb.utils.Bunch(outcomes={}, stats={})
+    counts = Counter()
+    line = json.dumps({"level": "info", "msg": "Copied (new)", "object": "a"})
+    assert rirb.rclone.parse_json_log(line, result, counts=counts) is None
+    line = json.dumps({"level": "error", "msg": "Failed", "object": "b"})
+    text = rirb.rclone.parse_json_log(line, result, counts=counts)
+    assert text == "ERROR : b: Failed"
+    assert counts == Counter({"Copied (new)": 1})
+    assert result.outcomes == {"a": ("info", "Copied (new)"), "b": ("error", "Failed")}
+
+
 def test_move_attribs():
     """Test unclear moves and make sure they don't happen"""
     test = testutils.Tester(name="unique_moves")
@@ -396,6 +1157,37 @@ def test_log_dests():
     assert gold == next(Path("alt/logs").glob("*.log")).read_text().strip()
 
 
+def test_log_compression():
+    """Test that the log is compressed and a failed log_dest doesn't stop others"""
+    test = testutils.Tester(name="log_compression")
+    test.config["log_compression"] = "xz"
+    test.config["log_dest"] = ["logs1", "logs2"]
+    test.write_config()
+
+    test.write_pre("src/file.txt", "file")
+    test.cli("--init", "config.py")
+
+    gold = test.logs[-1][0].strip()
+    for path in [
+        Path(test.log_dirs()[-1]) / "log.log.xz",
+        *Path("logs1").glob("*.log.xz"),
+        *Path("logs2").glob("*.log.xz"),
+    ]:
+        with lzma.open(path, "rt") as fobj:
+            assert gold == fobj.read().strip()
+    assert not list(Path("logs1").glob("*.log"))
+
+    # The bad destination is first but the others are still saved
+    test.config["log_dest"] = ["nope:logs", "logs1"]
+    test.write_config()
+    test.write_pre("src/file.txt", "file.")
+    with pytest.raises(subprocess.CalledProcessError):
+        test.cli("config.py", "--debug")
+    assert (Path(test.log_dirs()[-1]) / "log.log.xz").exists()
+    assert (Path(test.log_dirs()[-1]) / "profile.json").exists()
+    assert len(list(Path("logs1").glob("*.log.xz"))) == 3  # Includes .FAILED.log.xz
+
+
 def test_shell():
     import subprocess
 
@@ -549,19 +1341,27 @@ def test_dir_cleanup(mode):
     test.write_config()
 
     test.write_pre("src/dir1/file1.txt", "file1")
+    test.write_pre("src/dir1/sub/file3.txt", "file3")
+    test.write_pre("src/dir1-x/file4.txt", "file4")  # Sorts between dir1 and dir1/sub
     test.write_pre("src/dir2/file2.txt", "file2")
 
     test.cli("--init", "config.py")
 
     test.move("src/dir1/file1.txt", "src/dirONE/file1.txt")
+    test.move("src/dir1/sub/file3.txt", "src/dirONE/sub/file3.txt")
+    test.move("src/dir1-x/file4.txt", "src/dirONE/file4.txt")
     test.move("src/dir2/file2.txt", "src/dirTWO/file2.txt")
     test.write_post("dst/curr/dir2/errant file.txt", "aa")
 
     test.cli("config.py")
 
     assert Path("dst/curr/dir1").exists() == (not mode in {"auto", True})
+    assert Path("dst/curr/dir1-x").exists() == (not mode in {"auto", True})
     assert Path("dst/curr/dir2").exists()  # Added an extra file so it will be there
 
+    if mode:  # dir1/sub is done with dir1
+        assert "Removing 3 directories (if empty)" in test.logs[-1][0]
+
 
 def test_no_modtime():
     """
@@ -704,12 +1504,14 @@ def test_links(webdav):
         dwebdav.close()
 
 
-def test_dir_moves():
+@pytest.mark.parametrize("dir_moves", [False, True])
+def test_dir_moves(dir_moves):
     test = testutils.Tester(name="dirmove")
 
     test.config["filter_flags"] = ["--exclude", "*.exc", "--exclude", "no/**"]
     test.config["reuse_hashes"] = False
     test.config["renames"] = "hash"
+    test.config["dir_moves"] = dir_moves
     test.write_config()
 
     test.write_pre("src/dir-move-all/file1.txt", "file.")
@@ -771,15 +1573,62 @@ def test_dir_moves():
         ("missing_in_dst", "dir-MOVED-excdir/no/file10.txt"),
     }
 
+    log = test.logs[-1][0]
+    if not dir_moves:
+        assert "Directory Move" not in log
+        return
+
+    # Only the ones where the whole directory moved (as seen on the dst). Excluded
+    # files are not on the dst so they do not matter.
+    assert "Found 6 directory move(s) for 11 of 15 renames" in log
+    for src, dst in [
+        ("dir-move-all", "dir-MOVED-all"),
+        ("dir-move-exc", "dir-MOVED-exc"),
+        ("dir-move-excdir", "dir-MOVED-excdir"),
+        ("dir-move-withsub", "dir-MOVED-withsub"),
+        ("sub1/sub2/sub3", "sub1/subTwo/subThree"),
+        ("s1/s2/s3/s4/s5", "new/sub"),
+    ]:
+        assert f"Directory Move '{src}' --> '{dst}'" in log
+
+    # Not whole directories
+    assert "Directory Move 'dir-move-all-replace'" not in log
+    assert "Directory Move 'dir-move-some'" not in log
+    assert "Directory Move 'D1" not in log
+
 
 if __name__ == "__main__":
     # test_main()
+    # test_metadata_only_updates()
     # test_missing_local_list()
     # for attrib in ("size", "mtime", "hash", "fail-hash", None):
     #     test_dst_list(attrib)
+    # test_auto_hash_type()
     # test_automatic_dst_list_and_prefix()
+    # test_resume_journal()
+    # test_file_retries()
+    # test_size_classes()
+    # test_adaptive_transfers()
+    # test_planner()
+    # test_rename_grouping()
+    # test_pipeline(1)
+    # test_pipeline(4)
+    # test_max_run_time()
+    # test_watchdog()
+    # test_stall_timeouts_phases()
+    # test_log_writer()
+    # test_rclone_log_summary()
+    # test_stream_new_files()
+    # test_stream_max_wait()
+    # test_profile()
+    # test_trace()
+    # test_prometheus()
+    # test_prometheus_unreachable()
+    # test_history()
+    # test_economy()
     # test_move_attribs()
     # test_log_dests()
+    # test_log_compression()
     # test_shell()
     test_dry_run()
     # for mode in [True, False, "auto"]:
@@ -789,5 +1638,6 @@ if __name__ == "__main__":
     # test_override()
     # test_links(False)
     # test_links(True)
-    # test_dir_moves()
+    # test_dir_moves(False)
+    # test_dir_moves(True)
     print("--- PASSED ---")
@@ -40,6 +40,9 @@ class WebDAV:
             f"localhost:{int(port)}",
         ]
 
+        self.start(cmd)
+
+    def start(self, cmd):
         atexit.register(self.close)  # Make sure it gets shut down
         self.proc = subprocess.Popen(
             cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
@@ -72,6 +75,33 @@ class WebDAV:
         self.proc.send_signal(signal.SIGINT)
 
 
+class SFTP(WebDAV):
+    """`rclone serve sftp` on localhost with a password"""
+
+    def __init__(self, path, port=45679, user="rirb", password="rirb"):
+        self.path = path = os.path.abspath(path)
+        obscured = subprocess.check_output(["rclone", "obscure", password], text=True)
+        self.remote = (
+            f":sftp,host=localhost,port={int(port)},user={user},"
+            f"pass={obscured.strip()}:"
+        )
+
+        cmd = [
+            "rclone",
+            "serve",
+            "sftp",
+            path,
+            "-v",
+            "--addr",
+            f"localhost:{int(port)}",
+            "--user",
+            user,
+            "--pass",
+            password,
+        ]
+        self.start(cmd)
+
+
 class Tester:
     def __init__(self, *, name, src=None, dst=None, seed=1):
         os.chdir(PWD0)